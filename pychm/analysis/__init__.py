@@ -1,5 +1,7 @@
-
-
 import pychm.analysis.delg
+import pychm.analysis.rexdiag
+import pychm.analysis.pipeline
+import pychm.analysis.parallel
+import pychm.analysis.wham
 
-__all__ = ['delg']
+__all__ = ['delg', 'rexdiag', 'pipeline', 'parallel', 'wham']
@@ -5,18 +5,21 @@ DOCME
 # 02/22/2011
 
 
+import hashlib
+import multiprocessing
+import os
+import warnings
 from os import remove
 from os.path import exists
 import numpy as np
 from pychm.tools import Property, walk, lowerKeys, mkdir
 from pychm.io.inp import INPFile
+from pychm.future.io.charmm.crd import open_crd
+from pychm.future.io.charmm.dcd import open_dcd
+from pychm.future.io.charmm.psf import open_psf
 
 
-def load_correlOutput(filename):
-    """
-    Reads a charmm formatted correl output reporting a bondlength as a function
-    of time.  Data is returned as a 1darray.
-    """
+def _slow_correlOutput(filename):
     def gen():
         start_parse = False
         for line in open(filename):
@@ -38,19 +41,309 @@ def load_correlOutput(filename):
     return np.fromiter(gen(), np.float)
 
 
+def load_correlOutput(filename):
+    """
+    Reads a charmm formatted correl output reporting a bondlength as a function
+    of time.  Data is returned as a 1darray.
+
+    Values are read from the second column, starting at the first line whose
+    first column is an integer. The data lines are split in one call and only
+    the second column is converted, files with ragged columns fall back to a
+    line by line parser.
+    """
+    text = open(filename).read()
+    start = 0
+    while start < len(text):
+        stop = text.find('\n', start)
+        if stop < 0:
+            stop = len(text)
+        tokens = text[start:stop].split()
+        if tokens:
+            try:
+                dummy = int(tokens[0])
+                break
+            except ValueError:
+                pass
+        start = stop + 1
+    body = text[start:].rstrip()
+    if not body:
+        return np.zeros(0, dtype=np.float64)
+    nlines = body.count('\n') + 1
+    ncols = len(body[:body.find('\n')].split()) if nlines > 1 else len(body.split())
+    tokens = body.split()
+    if ncols < 2 or len(tokens) != nlines * ncols:
+        return _slow_correlOutput(filename)
+    try:
+        tmp = np.array(tokens[1::ncols], dtype=np.float64)
+    except ValueError:
+        return _slow_correlOutput(filename)
+    if np.isnan(tmp).any():
+        raise AssertionError("parsed NaN in %s" % filename)
+    return tmp
+
+
+def _load_correlRow(filename):
+    try:
+        return load_correlOutput(filename)
+    except IOError:
+        return None
+
+
+def load_correlOutputs(filenames, rowLength, nproc=None, threads=True):
+    """
+    Reads many charmm formatted correl outputs concurrently, with a pool of
+    `nproc` threads (or processes, with ``threads=False``), default one per
+    CPU, into one preallocated (len(filenames), rowLength) 2darray. Returns
+    the array and the list of indices of the files which could not be
+    found, whose rows are left as zeros. Files with more or fewer than
+    `rowLength` values are truncated or zero padded, with a warning.
+    """
+    tmp = np.zeros((len(filenames), rowLength), dtype=np.float64)
+    missing = []
+    if not len(filenames):
+        return tmp, missing
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    nproc = max(min(nproc, len(filenames)), 1)
+    if threads:
+        from multiprocessing.pool import ThreadPool as Pool
+    else:
+        from multiprocessing import Pool
+    pool = Pool(nproc)
+    try:
+        for i, row in enumerate(pool.imap(_load_correlRow, filenames, chunksize=16)):
+            if row is None:
+                missing.append(i)
+                continue
+            if len(row) != rowLength:
+                warnings.warn("correl output %s has %d values, expected %d" % (filenames[i], len(row), rowLength))
+            n = min(len(row), rowLength)
+            tmp[i, :n] = row[:n]
+    finally:
+        pool.close()
+        pool.join()
+    return tmp, missing
+
+
+class ResultCache(object):
+    """
+    A content addressed store of analysis results, in the directory `path`.
+
+    Results are NumPy arrays, stored as ``<key>.npy``, or :class:`dict`
+    objects of arrays, stored as ``<key>.npz``, where `key` is a hash of
+    everything the result depends on, see :meth:`make_key`. A result is
+    thus recomputed only when its inputs change, and stale results are
+    simply never looked up again. They are evicted, least recently used
+    first, once the directory holds more than `maxBytes` (``None`` for no
+    limit). Lookups are counted in ``hits`` and ``misses``.
+    """
+    def __init__(self, path, maxBytes=None):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        mkdir(self.path)
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Returns the hex digest of `parts`, which may nest tuples, lists,
+        dicts, strings, numbers and NumPy arrays.
+        """
+        digest = hashlib.sha1()
+        def feed(part):
+            if isinstance(part, np.ndarray):
+                part = np.ascontiguousarray(part)
+                digest.update('ndarray %s %r ' % (part.dtype.str, part.shape))
+                digest.update(part.view(np.uint8).data)
+            elif isinstance(part, (tuple, list)):
+                digest.update('seq %d ' % len(part))
+                for p in part:
+                    feed(p)
+            elif isinstance(part, dict):
+                digest.update('dict %d ' % len(part))
+                for k in sorted(part):
+                    feed(k)
+                    feed(part[k])
+            else:
+                digest.update('%s %r ' % (type(part).__name__, part))
+        feed(parts)
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_identity(filename):
+        """
+        Returns the (path, size, mtime) identity of a file, or (path, None,
+        None) if it does not exist.
+        """
+        filename = os.path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return (filename, None, None)
+        return (filename, st.st_size, st.st_mtime)
+
+    def _filename(self, key):
+        for ext in ('.npy', '.npz'):
+            filename = os.path.join(self.path, key + ext)
+            if exists(filename):
+                return filename
+        return None
+
+    def get(self, key):
+        """
+        Returns the result stored under `key`, or ``None``.
+        """
+        filename = self._filename(key)
+        if filename is None:
+            self.misses += 1
+            return None
+        try:
+            if filename.endswith('.npz'):
+                # read every member, so the archive can be closed now
+                with np.load(filename) as archive:
+                    tmp = dict( (k, archive[k]) for k in archive.files )
+            else:
+                tmp = np.load(filename)
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(filename, None)
+        self.hits += 1
+        return tmp
+
+    def put(self, key, value):
+        """
+        Stores `value`, an array or a dict of arrays, under `key`, then
+        evicts old results beyond the size limit.
+        """
+        # temporary names are unique per process, and never evicted
+        if isinstance(value, dict):
+            filename = os.path.join(self.path, key + '.npz')
+            tmpname = '%s.%d.tmp.npz' % (filename, os.getpid())
+            np.savez(tmpname, **value)
+        else:
+            filename = os.path.join(self.path, key + '.npy')
+            tmpname = '%s.%d.tmp.npy' % (filename, os.getpid())
+            np.save(tmpname, np.asarray(value))
+        os.rename(tmpname, filename)
+        self.evict()
+
+    def fetch(self, key, build):
+        """
+        Returns the result stored under `key`, calling `build` to compute
+        and store it on a miss.
+        """
+        tmp = self.get(key)
+        if tmp is None:
+            tmp = build()
+            self.put(key, tmp)
+        return tmp
+
+    def discard(self, key):
+        """
+        Removes the result stored under `key`, if any.
+        """
+        filename = self._filename(key)
+        if filename is not None:
+            remove(filename)
+
+    def evict(self, maxBytes=None):
+        """
+        Removes least recently used results until the cache holds no more
+        than `maxBytes`, default ``self.maxBytes``.
+        """
+        if maxBytes is None:
+            maxBytes = self.maxBytes
+        if maxBytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.path):
+            if '.tmp.' in name:
+                # a write in progress
+                continue
+            if name.endswith('.npy') or name.endswith('.npz'):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        entries.sort()
+        total = sum( size for mtime, size, name in entries )
+        for mtime, size, name in entries:
+            if total <= maxBytes:
+                break
+            try:
+                remove(os.path.join(self.path, name))
+            except OSError:
+                # already evicted by another process
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Removes every result.
+        """
+        self.evict(0)
+
+
 class BaseAnalysis(INPFile):
     """
     DOCME
+
+    **Class Attributes:**
+        | ``defaultCachePath``
+        | ``defaultCacheSize``
+
+    **kwargs:**
+        | ``selection`` :: correl atom selection, defaults to 'all'
+        | ``cachepath`` :: directory of the :class:`ResultCache`, defaults
+            to the value in ``defaultCachePath``
+        | ``cachesize`` :: size limit of the cache in bytes, defaults to
+            the value in ``defaultCacheSize``
+    """
+
+    defaultCachePath = '~/.pychm/cache'
+    """
+    If not explicitly specified as a kwarg, this is the directory where
+    analysis results are cached.
+    """
+
+    defaultCacheSize = 2**30
     """
+    If not explicitly specified as a kwarg, this is the size limit of the
+    result cache in bytes, ``None`` for no limit.
+    """
+
     def __init__(self, pdbFilename=None, **kwargs):
         super(BaseAnalysis, self).__init__(pdbFilename, **kwargs)
         # kwargs
         kwargs = lowerKeys(kwargs)
         self.correlAtomSelection = kwargs.get('selection', 'all')
+        self.cachePath = kwargs.get('cachepath', self.__class__.defaultCachePath)
+        self.cacheSize = kwargs.get('cachesize', self.__class__.defaultCacheSize)
         #
         self._correlStart = 0
         self._correlStop = -1
 
+    @Property
+    def cache():
+        doc =\
+        """
+        A read-only ``property`` for the :class:`ResultCache` in
+        ``cachePath``.
+        """
+        def fget(self):
+            path = self.expandPath(self.cachePath)
+            try:
+                if self._cache.path == path:
+                    return self._cache
+            except AttributeError:
+                pass
+            self._cache = ResultCache(path, self.cacheSize)
+            return self._cache
+        return locals()
+
 # File/Path locations
     @Property
     def anlFilename():
@@ -194,6 +487,119 @@ class BaseAnalysis(INPFile):
         String.append('')
         return String
 
+    def get_correlFrames(self):
+        """
+        Returns the (begin, end, stride) dcd frame numbers, `end` inclusive,
+        read by a ``traj`` command over the `correlStart`, `correlStop`,
+        `correlSkip` step window. Frame `k` of the .dcd file holds step
+        ``npriv + k * nsavc``, as written in its header.
+        """
+        dcd = open_dcd(self.dcdFilename)
+        try:
+            npriv, nsavc, nframes = dcd.npriv, dcd.nsavc, dcd.count_frames()
+        finally:
+            dcd.close()
+        nsavc = max(nsavc, 1)
+        begin = max(-(-(self.correlStart - npriv) // nsavc), 0)
+        end = min((self.correlStop - npriv) // nsavc, nframes - 1)
+        stride = max(self.correlSkip // nsavc, 1)
+        return (begin, end, stride)
+
+    def iter_correlBlocks(self, atoms=None, size=256):
+        """
+        A :class:`generator` over (nframes, natoms, 3) float64 coordinate
+        blocks of the frames in the correl window, see `get_correlFrames`,
+        for native (CHARMM free) analysis backends. `atoms` is an optional
+        sequence of 0-based atom indices to read. Blocks are reused, copy
+        them to keep them past the next iteration.
+        """
+        begin, end, stride = self.get_correlFrames()
+        if end < begin:
+            return
+        dcd = open_dcd(self.dcdFilename)
+        try:
+            for block in dcd.iter_block(atoms=atoms, size=size, begin=begin,
+                                        end=end, stride=stride, dtype=np.float64):
+                yield block
+        finally:
+            dcd.close()
+
+    def get_psf(self):
+        """
+        Returns ``psfFilename`` parsed as a :class:`PSFFile`, the parse is
+        cached until ``psfFilename`` changes.
+        """
+        try:
+            if self._psf[0] == self.psfFilename:
+                return self._psf[1]
+        except AttributeError:
+            pass
+        psf = open_psf(self.psfFilename)
+        psf.close()
+        self._psf = (self.psfFilename, psf)
+        return psf
+
+    def get_crdXyz(self):
+        """
+        Returns the (natoms, 3) coordinates of ``crdFilename``, the CHARMM
+        comparison set, cached until ``crdFilename`` changes.
+        """
+        try:
+            if self._crd[0] == self.crdFilename:
+                return self._crd[1]
+        except AttributeError:
+            pass
+        crd = open_crd(self.crdFilename, xyz_only=True)
+        crd.close()
+        self._crd = (self.crdFilename, crd.xyz)
+        return crd.xyz
+
+    def get_correlSelection(self):
+        """
+        Returns the 0-based indices of the atoms selected by
+        ``correlAtomSelection``, either ``'all'`` or a string of one letter
+        segids, as selected in the correl inputs.
+        """
+        psf = self.get_psf()
+        if self.correlAtomSelection == 'all':
+            return np.arange(psf.natoms)
+        return psf.select(segid=list(self.correlAtomSelection.lower()))
+
+    def get_cacheKey(self, name, params=(), files=()):
+        """
+        Returns the :class:`ResultCache` key of the result `name` of this
+        analysis, computed from the input `files` (by path, size and mtime),
+        the correl window and `params`.
+        """
+        try:
+            window = (self.correlStart, self.correlStop, self.correlSkip)
+        except AttributeError:
+            window = None
+        identities = [ ResultCache.file_identity(f) for f in files ]
+        return ResultCache.make_key(self.__class__.__name__, name, identities,
+                                    window, params)
+
+    def get_cached(self, name, build, params=(), files=()):
+        """
+        Returns the result `name` from the cache, see :meth:`get_cacheKey`,
+        calling `build` to compute and store it if the inputs changed.
+        """
+        key = self.get_cacheKey(name, params, files)
+        tmp = self.cache.get(key)
+        if tmp is not None:
+            print 'found cached %s data in: %s' % (name, self.cache.path)
+            return tmp
+        print 'processing %s data' % name
+        tmp = build()
+        self.cache.put(key, tmp)
+        return tmp
+
+    def rm_cache(self):
+        """
+        Removes every result from the cache.
+        """
+        self.cache.clear()
+
     def rm_pickles(self, directory=None):
         """
         Recursively removes .pickle files starting at `directory`.  Defaults
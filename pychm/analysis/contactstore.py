@@ -0,0 +1,177 @@
+"""
+A compressed sparse (frames x pairs) store of the pair contacts of a
+trajectory.
+
+Row `f` of the store lists the pairs in contact in frame `f`, and their
+distances, in the compressed sparse row (CSR) layout: the entries of frame
+`f` are ``indices[indptr[f]:indptr[f+1]]`` and
+``distances[indptr[f]:indptr[f+1]]``. A 300 residue model has ~45k
+sidechain pairs but only a few hundred in contact at any time, so the
+whole time series of a replica fits in one small array triple.
+
+>>> store = ContactStore(npairs)
+>>> for i, j, d in frames:
+...     store.append(pair_id(i, j, n), d)
+>>> store.get_QofT(nativeMask)
+>>> store.save('contacts.npz')
+"""
+
+
+import numpy as np
+from pychm.tools import Property
+
+
+class ContactStore(object):
+    """
+    Frames are added one at a time with :meth:`append`, and are compacted
+    into the CSR arrays the first time they are queried. `cutoff` records
+    the distance used to build the store, queries may use any `rad` up to
+    it.
+    """
+    def __init__(self, npairs, cutoff=None):
+        self.npairs = int(npairs)
+        self.cutoff = cutoff
+        self._indptr = [0]
+        self._indices = []
+        self._distances = []
+        self._compact = None
+
+    @classmethod
+    def fromdict(cls, data):
+        """
+        Rebuilds a store from the arrays returned by :meth:`asdict`.
+        """
+        cutoff = float(data['cutoff'])
+        tmp = cls(int(data['npairs']), cutoff if cutoff >= 0 else None)
+        tmp._compact = (data['indptr'], data['indices'], data['distances'])
+        return tmp
+
+    def asdict(self):
+        """
+        Returns the store as a :class:`dict` of arrays.
+        """
+        indptr, indices, distances = self.compact()
+        cutoff = -1. if self.cutoff is None else self.cutoff
+        return {'npairs': np.array(self.npairs), 'cutoff': np.array(cutoff),
+                'indptr': indptr, 'indices': indices, 'distances': distances}
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads a store written by :meth:`save`.
+        """
+        with np.load(filename) as archive:
+            tmp = dict( (key, archive[key]) for key in archive.files )
+        return cls.fromdict(tmp)
+
+    def save(self, filename):
+        """
+        Writes the store to a .npz file.
+        """
+        np.savez(filename, **self.asdict())
+
+    def append(self, indices, distances):
+        """
+        Adds a frame, given the ids of the pairs in contact and their
+        distances.
+        """
+        indices = np.asarray(indices, dtype=np.int32)
+        distances = np.asarray(distances, dtype=np.float32)
+        if indices.shape != distances.shape:
+            raise ValueError("indices and distances must have equal lengths")
+        if self._compact is not None:
+            indptr, tmpIndices, tmpDistances = self._compact
+            self._indptr = indptr.tolist()
+            self._indices = [tmpIndices]
+            self._distances = [tmpDistances]
+            self._compact = None
+        order = np.argsort(indices)
+        self._indices.append(indices[order])
+        self._distances.append(distances[order])
+        self._indptr.append(self._indptr[-1] + len(indices))
+
+    def compact(self):
+        """
+        Returns the (indptr, indices, distances) arrays of the store.
+        """
+        if self._compact is None:
+            indptr = np.array(self._indptr, dtype=np.int64)
+            if self._indices:
+                indices = np.concatenate(self._indices)
+                distances = np.concatenate(self._distances)
+            else:
+                indices = np.zeros(0, dtype=np.int32)
+                distances = np.zeros(0, dtype=np.float32)
+            self._compact = (indptr, indices, distances)
+            self._indptr, self._indices, self._distances = [], [], []
+        return self._compact
+
+    @Property
+    def nframes():
+        doc =\
+        """
+        The number of frames in the store.
+        """
+        def fget(self):
+            return len(self.compact()[0]) - 1
+        return locals()
+
+    def _entries(self, rad=None):
+        """
+        Returns the frame and pair id of every entry within `rad`.
+        """
+        indptr, indices, distances = self.compact()
+        frames = np.repeat(np.arange(self.nframes), np.diff(indptr))
+        if rad is not None:
+            keep = distances <= rad
+            frames, indices = frames[keep], indices[keep]
+        return frames, indices
+
+    def to_dense(self, rad=None):
+        """
+        Returns the (nframes, npairs) boolean contact matrix.
+        """
+        frames, indices = self._entries(rad)
+        tmp = np.zeros((self.nframes, self.npairs), dtype=np.bool_)
+        tmp[frames, indices] = True
+        return tmp
+
+    def get_QofT(self, mask=None, rad=None):
+        """
+        Returns, for each frame, the fraction of the pairs selected by the
+        boolean `mask` (default, all pairs) which are in contact, that is
+        within `rad` (default, the store's cutoff).
+        """
+        frames, indices = self._entries(rad)
+        if mask is None:
+            return np.bincount(frames, minlength=self.nframes) / float(self.npairs)
+        mask = np.asarray(mask, dtype=np.bool_)
+        if mask.shape != (self.npairs,):
+            raise ValueError("mask must have one element per pair")
+        count = np.bincount(frames[mask[indices]], minlength=self.nframes)
+        return count / float(max(mask.sum(), 1))
+
+    def get_frequency(self, rad=None):
+        """
+        Returns, for each pair, the fraction of frames in which it is in
+        contact.
+        """
+        frames, indices = self._entries(rad)
+        return np.bincount(indices, minlength=self.npairs) / float(max(self.nframes, 1))
+
+    def get_lifetimes(self, rad=None):
+        """
+        Returns the (pairs, lifetimes) arrays of every uninterrupted run of
+        frames in which a pair stays in contact, lifetimes in frames. Runs
+        which touch the first or last frame are truncated by the window.
+        """
+        frames, indices = self._entries(rad)
+        if not len(frames):
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+        order = np.lexsort((frames, indices))
+        frames, indices = frames[order], indices[order]
+        newRun = np.ones(len(frames), dtype=np.bool_)
+        newRun[1:] = (indices[1:] != indices[:-1]) | (frames[1:] != frames[:-1] + 1)
+        starts = np.flatnonzero(newRun)
+        lifetimes = np.diff(np.append(starts, len(frames)))
+        return indices[starts], lifetimes
@@ -6,7 +6,7 @@ DOCME
 
 
 import numpy as np
-from pychm.const.units import BOLTZMANN, AVOGADRO, JOULE2CAL, CAL2JOULE
+from pychm.const.units import BOLTZMANN
 from pychm.tools import Property
 
 
@@ -23,11 +23,19 @@ class DelGError(Exception):
 class DelG(object):
     """
     docstring for DelG
+
+    **Class Attributes:**
+        ``maxBootBlocks``   The largest number of blocks resampled by
+                            :meth:`get_bootstrapCI`.
     """
+    maxBootBlocks = 1000
+
     def __init__(self, timeSeries, temp):
         self.timeSeries = timeSeries
         self.stateDef = {}
         self.stateCount = {}
+        self.stateOrder = []
+        self.stateLabels = None
         self.temp = temp
 
     @Property
@@ -48,16 +56,49 @@ class DelG(object):
         if less > greater:
             less, greater = greater, less
         self.stateDef[name] = (less, greater)
+        self.stateLabels = None
 
     def count(self):
-        # Count state populations
-        for key in self.stateDef.iterkeys():
-            self.stateCount[key] = 0
-        for frame in self.timeSeries:
-            for key, value in self.stateDef.iteritems():
-                if value[0] <= frame <= value[1]:
-                    self.stateCount[key] += 1
-                    break
+        # Count state populations, a frame belongs to the first matching state
+        series = np.asarray(self.timeSeries, dtype=np.float64).ravel()
+        self.stateOrder = list(self.stateDef.iterkeys())
+        labels = np.empty(len(series), dtype=np.int16)
+        labels.fill(-1)
+        for k in xrange(len(self.stateOrder) - 1, -1, -1):
+            less, greater = self.stateDef[self.stateOrder[k]]
+            labels[(less <= series) & (series <= greater)] = k
+        counts = np.bincount(labels[labels >= 0], minlength=len(self.stateOrder))
+        for k, key in enumerate(self.stateOrder):
+            self.stateCount[key] = int(counts[k])
+        self.stateLabels = labels
+
+    def _to_kcal(self, x):
+        # Convert -ln(count0 / count1) to KCal / mol
+        return x * BOLTZMANN * self.temp
+
+    def _get_indicators(self, state0, state1):
+        """
+        Returns the boolean time series of membership in `state0` and
+        `state1`.
+        """
+        if self.stateLabels is None:
+            self.count()
+        for state in (state0, state1):
+            if state not in self.stateDef:
+                raise DelGError('unknown state: %r' % state)
+        return (self.stateLabels == self.stateOrder.index(state0),
+                self.stateLabels == self.stateOrder.index(state1))
+
+    def _delG_of_counts(self, count0, count1):
+        """
+        Vectorized :meth:`get_DelG` of arrays of state counts.
+        """
+        count0 = np.asarray(count0, dtype=np.float64)
+        count1 = np.asarray(count1, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tmp = self._to_kcal(-1 * np.log(count0 / count1))
+        tmp[(count0 == 0) | (count1 == 0)] = np.inf
+        return tmp
 
     def get_DelG(self, state0, state1):
         if not self.temp:
@@ -66,10 +107,99 @@ class DelG(object):
         count0 = float(self.stateCount[state0])
         count1 = float(self.stateCount[state1])
         try:
-            energy =  -1 * np.log(count0 / count1) / BETA  # Joule
+            energy =  -1 * np.log(count0 / count1) / BETA  # KCal / mol
         except ZeroDivisionError:
             energy = np.inf
-        energy = energy / 1000.                 # Kilo Joule
-        energy = energy * AVOGADRO              # Joule * Mole**-1
-        energy = energy * JOULE2CAL             # KCal / mol
         return energy
+
+    def get_autocorrTime(self, state0, state1, window=5.):
+        """
+        Returns the integrated autocorrelation time, in frames, of the
+        fluctuation of ln(count0 / count1), that is of the time series
+        in0 / p0 - in1 / p1, where in0 and p0 are the indicator and the
+        population of `state0`. The autocorrelation function is computed by
+        FFT, and summed up to the first lag M with M >= `window` * tau(M).
+        The variance of :meth:`get_DelG` is tau times its uncorrelated
+        value.
+        """
+        in0, in1 = self._get_indicators(state0, state1)
+        p0, p1 = in0.mean(), in1.mean()
+        if not p0 or not p1:
+            return np.nan
+        x = in0 / p0 - in1 / p1
+        x -= x.mean()
+        n = len(x)
+        size = 1
+        while size < 2 * n:
+            size *= 2
+        f = np.fft.rfft(x, size)
+        acf = np.fft.irfft(f * f.conjugate(), size)[:n]
+        if acf[0] <= 0:
+            return np.nan
+        acf /= acf[0]
+        tau = 2 * np.cumsum(acf) - 1
+        lags = np.flatnonzero(np.arange(n) >= window * tau)
+        if lags.size:
+            return max(tau[lags[0]], 1.)
+        return max(tau[-1], 1.)
+
+    def _block_counts(self, state0, state1, blockSize):
+        """
+        Returns the counts of `state0` and `state1` in each consecutive
+        block of `blockSize` frames, dropping the incomplete last block.
+        """
+        in0, in1 = self._get_indicators(state0, state1)
+        nblocks = len(in0) // blockSize
+        if nblocks < 2:
+            raise DelGError('too few frames for blocks of %d frames' % blockSize)
+        n = nblocks * blockSize
+        return (in0[:n].reshape(nblocks, blockSize).sum(axis=1),
+                in1[:n].reshape(nblocks, blockSize).sum(axis=1))
+
+    def get_blockError(self, state0, state1, nblocks=10):
+        """
+        Returns the standard error of :meth:`get_DelG`, in KCal / mol, from
+        the scatter of the state populations over `nblocks` consecutive
+        blocks of the time series (propagated to ln(p0 / p1) to first
+        order). Blocks must be longer than the autocorrelation time, see
+        :meth:`get_autocorrTime`.
+        """
+        in0, in1 = self._get_indicators(state0, state1)
+        c0, c1 = self._block_counts(state0, state1, max(len(in0) // nblocks, 1))
+        c0 = c0.astype(np.float64)
+        c1 = c1.astype(np.float64)
+        if not c0.sum() or not c1.sum():
+            return np.inf
+        x = c0 / c0.mean() - c1 / c1.mean()
+        return self._to_kcal(x.std(ddof=1) / np.sqrt(len(x)))
+
+    def get_bootstrapCI(self, state0, state1, nboot=1000, confidence=0.95,
+                        blockSize=None, seed=None):
+        """
+        Returns the (lower, upper) bounds, in KCal / mol, of the `confidence`
+        percentile interval of :meth:`get_DelG`, from `nboot` block bootstrap
+        resamples. Blocks are `blockSize` frames long, by default twice the
+        autocorrelation time, or longer if needed to keep at most
+        `maxBootBlocks` blocks, but no longer than half the series; all
+        resamples are drawn and counted at once.
+        """
+        in0, in1 = self._get_indicators(state0, state1)
+        if blockSize is None:
+            tau = self.get_autocorrTime(state0, state1)
+            if not np.isfinite(tau):
+                tau = 1.
+            blockSize = max(int(np.ceil(2 * tau)),
+                            -(-len(in0) // self.maxBootBlocks), 1)
+            # a replica which barely crosses still gets two blocks
+            blockSize = min(blockSize, max(len(in0) // 2, 1))
+        c0, c1 = self._block_counts(state0, state1, blockSize)
+        rng = np.random.RandomState(seed)
+        tmp = np.empty(nboot)
+        step = max(self.maxBootBlocks * 1000 // len(c0), 1)
+        for begin in xrange(0, nboot, step):
+            k = min(step, nboot - begin)
+            pick = rng.randint(0, len(c0), size=(k, len(c0)))
+            tmp[begin:begin+k] = self._delG_of_counts(c0[pick].sum(axis=1),
+                                                    c1[pick].sum(axis=1))
+        alpha = 100. * (1. - confidence) / 2.
+        return tuple(np.percentile(tmp, [alpha, 100. - alpha]))
@@ -0,0 +1,165 @@
+"""
+Vectorized geometry kernels for trajectory analysis.
+
+Every kernel works on a block of frames, a (nframes, natoms, 3) array as
+returned by :meth:`pychm.future.io.charmm.dcd.DCDFile.iter_block`, and
+returns one value per frame (or per frame and pair), so a trajectory is
+processed with one call per block instead of one per frame.
+"""
+
+
+import numpy as np
+
+
+def pair_distances(xyz, i, j, out=None):
+    """
+    Returns the (nframes, npairs) distances between atoms `i[p]` and `j[p]`
+    of each frame of the (nframes, natoms, 3) block `xyz`. `i` and `j` are
+    0-based atom indices into the block.
+    """
+    xyz = np.asarray(xyz)
+    i = np.asarray(i, dtype=np.intp)
+    j = np.asarray(j, dtype=np.intp)
+    if i.shape != j.shape or i.ndim != 1:
+        raise ValueError("i and j must be 1d arrays of equal length")
+    if out is None:
+        out = np.empty((len(xyz), len(i)), dtype=np.float64)
+    d = xyz[:, i] - xyz[:, j]
+    np.einsum('fpk,fpk->fp', d, d, out=out, dtype=np.float64)
+    return np.sqrt(out, out=out)
+
+
+# half shell of neighbouring cells, each unordered pair of cells is visited once
+_HALF_SHELL = np.array([ (x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1)
+                        for z in (-1, 0, 1) if (x, y, z) > (0, 0, 0) ],
+                        dtype=np.intp)
+
+
+def _expand_ranges(begin, end):
+    """
+    Returns the owner and value of every element of the ranges
+    [begin[k], end[k]), concatenated.
+    """
+    counts = end - begin
+    total = counts.sum()
+    owner = np.repeat(np.arange(len(begin)), counts)
+    value = np.arange(total) - np.repeat(np.cumsum(counts) - counts - begin, counts)
+    return owner, value
+
+
+def cell_list_pairs(xyz, cutoff):
+    """
+    Returns the (i, j, distance) arrays of every pair of atoms i < j of the
+    single frame `xyz`, a (natoms, 3) array, which are no more than
+    `cutoff` apart. Atoms are binned into cubic cells of side `cutoff`, and
+    only atoms of the same or neighbouring cells are compared, so the cost
+    grows with the number of atoms rather than the number of pairs.
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    if cutoff <= 0:
+        raise ValueError("cutoff must be positive")
+    cell = np.floor((xyz - xyz.min(axis=0)) / cutoff).astype(np.intp)
+    shape = cell.max(axis=0) + 1
+    cellId = np.ravel_multi_index(cell.T, shape)
+    order = np.argsort(cellId, kind='mergesort')
+    sortedId = cellId[order]
+    ncells = np.prod(shape)
+    start = np.searchsorted(sortedId, np.arange(ncells), side='left')
+    stop = np.searchsorted(sortedId, np.arange(ncells), side='right')
+    sortedCell = cell[order]
+    atoms = np.arange(len(order))
+    # same cell, later atoms only
+    a, b = _expand_ranges(atoms + 1, stop[sortedId])
+    pairs = [(a, b)]
+    for offset in _HALF_SHELL:
+        other = sortedCell + offset
+        ok = ((other >= 0) & (other < shape)).all(axis=1)
+        otherId = np.ravel_multi_index(other[ok].T, shape)
+        a, b = _expand_ranges(start[otherId], stop[otherId])
+        pairs.append((atoms[ok][a], b))
+    a = np.concatenate([ p[0] for p in pairs ])
+    b = np.concatenate([ p[1] for p in pairs ])
+    d = xyz[order[a]] - xyz[order[b]]
+    d = np.sqrt(np.einsum('pk,pk->p', d, d))
+    keep = d <= cutoff
+    i, j = order[a[keep]], order[b[keep]]
+    swap = i > j
+    i[swap], j[swap] = j[swap], i[swap]
+    return i, j, d[keep]
+
+
+def pair_id(i, j, n):
+    """
+    Returns the index of the pair (i, j), i < j, among all pairs of `n`
+    atoms enumerated as (0, 1), (0, 2), ..., (0, n-1), (1, 2), ...
+    """
+    i = np.asarray(i, dtype=np.intp)
+    j = np.asarray(j, dtype=np.intp)
+    return i * n - i * (i + 1) // 2 + j - i - 1
+
+
+def _weights(masses, natoms):
+    if masses is None:
+        return np.ones(natoms, dtype=np.float64)
+    masses = np.asarray(masses, dtype=np.float64)
+    if masses.shape != (natoms,):
+        raise ValueError("masses must have one value per atom")
+    return masses
+
+
+def radius_of_gyration(xyz, masses=None):
+    """
+    Returns the (nframes,) radius of gyration of each frame of the
+    (nframes, natoms, 3) block `xyz`, weighted by `masses` (default,
+    unweighted).
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    w = _weights(masses, xyz.shape[1])
+    com = np.einsum('a,fak->fk', w, xyz) / w.sum()
+    d = xyz - com[:, np.newaxis]
+    return np.sqrt(np.einsum('a,fak,fak->f', w, d, d) / w.sum())
+
+
+def kabsch_rmsd(xyz, ref, masses=None):
+    """
+    Returns the (nframes,) RMSD of each frame of the (nframes, natoms, 3)
+    block `xyz` from the (natoms, 3) reference `ref`, after optimally
+    superimposing each frame onto it, as CHARMM ``rms mass orient`` does
+    when `masses` are given. The rotations of all frames are found at once,
+    by a stacked singular value decomposition of their 3x3 covariance
+    matrices (Kabsch).
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    ref = np.asarray(ref, dtype=np.float64)
+    if ref.shape != xyz.shape[1:]:
+        raise ValueError("ref must be a (natoms, 3) array")
+    w = _weights(masses, len(ref))
+    wsum = w.sum()
+    ref = ref - np.dot(w, ref) / wsum
+    x = xyz - (np.einsum('a,fak->fk', w, xyz) / wsum)[:, np.newaxis]
+    cov = np.einsum('a,fai,aj->fij', w, x, ref)
+    u, s, vt = np.linalg.svd(cov)
+    # a reflection is not a rotation, flip the smallest singular value
+    sign = np.sign(np.linalg.det(u) * np.linalg.det(vt))
+    s[:, -1] *= sign
+    e0 = np.einsum('a,fak,fak->f', w, x, x) + np.einsum('a,ak,ak->', w, ref, ref)
+    msd = (e0 - 2 * s.sum(axis=1)) / wsum
+    return np.sqrt(np.maximum(msd, 0.))
+
+
+def dihedral_angles(xyz, i, j, k, l):
+    """
+    Returns the (nframes, nquads) dihedral angles i-j-k-l, in degrees in
+    (-180, 180], of each frame of the (nframes, natoms, 3) block `xyz`,
+    with the IUPAC sign convention used by CHARMM.
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    b0 = xyz[:, np.asarray(j, dtype=np.intp)] - xyz[:, np.asarray(i, dtype=np.intp)]
+    b1 = xyz[:, np.asarray(k, dtype=np.intp)] - xyz[:, np.asarray(j, dtype=np.intp)]
+    b2 = xyz[:, np.asarray(l, dtype=np.intp)] - xyz[:, np.asarray(k, dtype=np.intp)]
+    n0 = np.cross(b0, b1)
+    n1 = np.cross(b1, b2)
+    m = np.cross(b1 / np.sqrt(np.einsum('fpk,fpk->fp', b1, b1))[..., np.newaxis], n0)
+    x = np.einsum('fpk,fpk->fp', n0, n1)
+    y = np.einsum('fpk,fpk->fp', m, n1)
+    return np.degrees(np.arctan2(y, x))
@@ -0,0 +1,143 @@
+"""
+Parallel map-reduce analysis of DCD trajectories over a process pool.
+
+The frames of one or more trajectories (for example the per replica .dcd
+files of a REX run) are split into ranges of `chunkSize` frames, and each
+range is handed to a worker process, which opens its own memory mapped
+:class:`DCDView` of the file and calls the analysis function on the
+(nframes, natoms, 3) block of the range. Frames are independent, so the
+work scales with the number of processes until the disk saturates.
+
+Results are either gathered in frame order, one array per file:
+
+>>> rg = map_frames(rg_of_block, dcdFilenames, atoms=ca, nproc=16)
+
+or folded, in frame order, by a combiner, for histograms and averages:
+
+>>> hist = map_frames(hist_of_block, dcdFilenames, reduce=np.add)
+
+The analysis function and the combiner are sent to the workers by pickling,
+so they must be defined at module level.
+"""
+
+
+import multiprocessing
+import numpy as np
+from pychm.future.io.charmm.dcd import open_dcd
+
+
+_views = {}
+"""
+The memory mapped views opened by the current (worker) process, by file name.
+"""
+
+
+def _get_view(dcdFilename):
+    try:
+        return _views[dcdFilename]
+    except KeyError:
+        pass
+    dcd = open_dcd(dcdFilename)
+    try:
+        _views[dcdFilename] = dcd.memmap(dtype=np.float64)
+    finally:
+        dcd.close()
+    return _views[dcdFilename]
+
+
+def _run_task(task):
+    """
+    Runs `func` over one frame range, in a worker process.
+    """
+    func, dcdFilename, atoms, begin, stop, stride = task
+    view = _get_view(dcdFilename)
+    if atoms is None:
+        xyz = view[begin:stop:stride]
+    else:
+        xyz = view[begin:stop:stride, atoms]
+    return func(xyz)
+
+
+def split_frames(nframes, chunkSize, begin=0, end=None, stride=1):
+    """
+    Returns the (begin, stop, stride) slices, `stop` exclusive, which split
+    frames `begin` to `end` (inclusive, default the last frame), every
+    `stride` frames, into ranges of at most `chunkSize` frames.
+    """
+    if chunkSize < 1 or stride < 1:
+        raise ValueError("chunkSize and stride must be positive")
+    if end is None or end >= nframes:
+        end = nframes - 1
+    step = chunkSize * stride
+    return [ (start, min(start + step, end + 1), stride)
+            for start in xrange(begin, end + 1, step) ]
+
+
+def map_frames(func, dcdFilenames, atoms=None, nproc=None, chunkSize=1024,
+            begin=0, end=None, stride=1, reduce=None, initial=None):
+    """
+    Calls `func` on (nframes, natoms, 3) float64 coordinate blocks of the
+    frames `begin` to `end` (inclusive), every `stride` frames, of each
+    file in `dcdFilenames`, in a pool of `nproc` processes (default, one per
+    CPU, ``nproc=1`` runs in this process). `atoms` optionally selects the
+    0-based atom indices to read.
+
+    Without `reduce`, `func` must return one value (or row) per frame, and
+    the results are concatenated in frame order: one array for a single
+    file name, a list of arrays, one per file, for a sequence of them.
+
+    With `reduce`, a function of two partial results, the results of every
+    block of every file are folded in frame order, starting from `initial`
+    if given, and the final value is returned.
+    """
+    single = isinstance(dcdFilenames, basestring)
+    if single:
+        dcdFilenames = [dcdFilenames]
+    if atoms is not None:
+        atoms = np.asarray(atoms, dtype=np.intp).ravel()
+    tasks = []
+    owners = []
+    for k, dcdFilename in enumerate(dcdFilenames):
+        dcd = open_dcd(dcdFilename)
+        try:
+            nframes = dcd.count_frames()
+        finally:
+            dcd.close()
+        for frames in split_frames(nframes, chunkSize, begin, end, stride):
+            tasks.append((func, dcdFilename, atoms) + frames)
+            owners.append(k)
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    nproc = max(min(nproc, len(tasks)), 1)
+    if nproc == 1:
+        pool = None
+        results = ( _run_task(task) for task in tasks )
+    else:
+        pool = multiprocessing.Pool(nproc)
+        results = pool.imap(_run_task, tasks)
+    try:
+        if reduce is not None:
+            tmp = initial
+            for i, result in enumerate(results):
+                if i == 0 and tmp is None:
+                    tmp = result
+                else:
+                    tmp = reduce(tmp, result)
+            return tmp
+        tmp = [ [] for dcdFilename in dcdFilenames ]
+        for k, result in zip(owners, results):
+            tmp[k].append(np.asarray(result))
+        tmp = [ np.concatenate(parts) if parts else np.zeros(0)
+                for parts in tmp ]
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _views.clear()
+    if single:
+        return tmp[0]
+    return tmp
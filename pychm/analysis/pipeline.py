@@ -0,0 +1,227 @@
+"""
+A single pass, multi-observable trajectory analysis pipeline.
+
+Observables are registered with a :class:`Pipeline`, the trajectory is then
+streamed exactly once, in blocks of frames holding only the atoms some
+observable needs, and each observable writes its per frame values into its
+own preallocated output array.
+
+>>> pipe = Pipeline('rep_00.dcd')
+>>> pipe.add(Gyration('rg', atoms, masses))
+>>> pipe.add(RMSD('bbrmsd', bb, ref[bb], masses[bb]))
+>>> pipe.add(NativeQ('q', i, j, 8.))
+>>> pipe.add(Custom('zmax', lambda xyz: xyz[..., 2].max(axis=1)))
+>>> data = pipe.run(*taco.get_correlFrames())
+>>> data['rg'], pipe.timing
+"""
+
+
+import time
+import numpy as np
+from pychm.future.io.charmm.dcd import open_dcd
+from pychm.analysis.geometry import (dihedral_angles, kabsch_rmsd,
+                                    pair_distances, radius_of_gyration)
+
+
+class PipelineError(Exception):
+    """
+    Exception to raise when errors occur involving the Pipeline class.
+    """
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class Observable(object):
+    """
+    The base class of per frame observables. `atoms` are the 0-based indices
+    of the atoms the observable reads, `None` for all atoms, and `shape` is
+    the shape of its value for one frame. Subclasses implement
+    :meth:`compute`, which receives a (nframes, len(atoms), 3) block and
+    fills `out`, a (nframes,) + `shape` array.
+    """
+    def __init__(self, name, atoms=None, shape=(), dtype=np.float64):
+        self.name = name
+        if atoms is not None:
+            atoms = np.asarray(atoms, dtype=np.intp).ravel()
+        self.atoms = atoms
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+    def compute(self, xyz, out):
+        raise NotImplementedError
+
+
+class Gyration(Observable):
+    """
+    The radius of gyration of `atoms`, weighted by `masses`.
+    """
+    def __init__(self, name, atoms=None, masses=None):
+        super(Gyration, self).__init__(name, atoms)
+        self.masses = masses
+
+    def compute(self, xyz, out):
+        out[:] = radius_of_gyration(xyz, self.masses)
+
+
+class RMSD(Observable):
+    """
+    The RMSD of `atoms` from `ref`, after optimal superposition, weighted by
+    `masses`.
+    """
+    def __init__(self, name, atoms, ref, masses=None):
+        super(RMSD, self).__init__(name, atoms)
+        self.ref = np.asarray(ref, dtype=np.float64)
+        self.masses = masses
+
+    def compute(self, xyz, out):
+        out[:] = kabsch_rmsd(xyz, self.ref, self.masses)
+
+
+class Distances(Observable):
+    """
+    The distances between atoms `i[p]` and `j[p]`.
+    """
+    def __init__(self, name, i, j):
+        i = np.asarray(i, dtype=np.intp)
+        j = np.asarray(j, dtype=np.intp)
+        atoms, pos = np.unique(np.concatenate((i, j)), return_inverse=True)
+        super(Distances, self).__init__(name, atoms, shape=(len(i),))
+        self._i, self._j = pos[:len(i)], pos[len(i):]
+
+    def compute(self, xyz, out):
+        pair_distances(xyz, self._i, self._j, out=out)
+
+
+class NativeQ(Distances):
+    """
+    The fraction of the pairs (`i[p]`, `j[p]`) no more than `rad` apart.
+    """
+    def __init__(self, name, i, j, rad):
+        super(NativeQ, self).__init__(name, i, j)
+        self.shape = ()
+        self.rad = rad
+
+    def compute(self, xyz, out):
+        d = pair_distances(xyz, self._i, self._j)
+        out[:] = (d <= self.rad).mean(axis=1)
+
+
+class Dihedrals(Observable):
+    """
+    The dihedral angles, in degrees, of the (nquads, 4) atom indices
+    `quads`.
+    """
+    def __init__(self, name, quads):
+        quads = np.asarray(quads, dtype=np.intp).reshape(-1, 4)
+        atoms, pos = np.unique(quads, return_inverse=True)
+        super(Dihedrals, self).__init__(name, atoms, shape=(len(quads),))
+        self._quads = pos.reshape(-1, 4)
+
+    def compute(self, xyz, out):
+        q = self._quads
+        out[:] = dihedral_angles(xyz, q[:, 0], q[:, 1], q[:, 2], q[:, 3])
+
+
+class Custom(Observable):
+    """
+    Wraps a callable `func`, which takes a (nframes, len(atoms), 3) block
+    and returns a (nframes,) + `shape` array.
+    """
+    def __init__(self, name, func, atoms=None, shape=(), dtype=np.float64):
+        super(Custom, self).__init__(name, atoms, shape, dtype)
+        self.func = func
+
+    def compute(self, xyz, out):
+        out[:] = self.func(xyz)
+
+
+class Pipeline(object):
+    """
+    Streams the .dcd file `dcdFilename` once, in blocks of `blockSize`
+    frames, through every registered :class:`Observable`. After
+    :meth:`run`, ``timing`` holds the seconds spent reading (``'read'``)
+    and in each observable, by name.
+    """
+    def __init__(self, dcdFilename, blockSize=256):
+        self.dcdFilename = dcdFilename
+        self.blockSize = blockSize
+        self.observables = []
+        self.timing = {}
+
+    def add(self, observable):
+        """
+        Registers an :class:`Observable`, and returns it.
+        """
+        if not isinstance(observable, Observable):
+            raise PipelineError('add: expected an Observable, got %r' % observable)
+        if observable.name in [ obs.name for obs in self.observables ]:
+            raise PipelineError('add: duplicate observable name %r' % observable.name)
+        self.observables.append(observable)
+        return observable
+
+    def _plan(self, natoms):
+        """
+        Returns the atoms to read, and for each observable the positions of
+        its atoms within them, `None` where it takes the whole block.
+        """
+        if any( obs.atoms is None for obs in self.observables ):
+            atoms = np.arange(natoms)
+        else:
+            atoms = np.unique(np.concatenate([ obs.atoms for obs in self.observables ]))
+        if len(atoms) and (atoms[0] < 0 or atoms[-1] >= natoms):
+            raise PipelineError('observable atom index out of range')
+        tmp = []
+        for obs in self.observables:
+            if obs.atoms is None or (len(obs.atoms) == len(atoms) and
+                                    (obs.atoms == atoms).all()):
+                tmp.append(None)
+            else:
+                tmp.append(np.searchsorted(atoms, obs.atoms))
+        return atoms, tmp
+
+    def run(self, begin=0, end=None, stride=1):
+        """
+        Computes every observable over frames `begin` to `end` (inclusive,
+        default the last frame) every `stride` frames, and returns a
+        :class:`dict` of their output arrays, by name.
+        """
+        if not self.observables:
+            raise PipelineError('run: no observables registered')
+        dcd = open_dcd(self.dcdFilename)
+        try:
+            nframes = dcd.count_frames()
+            if end is None or end >= nframes:
+                end = nframes - 1
+            nout = max(len(xrange(begin, end + 1, stride)), 0)
+            atoms, positions = self._plan(dcd.natoms)
+            out = dict( (obs.name, np.empty((nout,) + obs.shape, dtype=obs.dtype))
+                        for obs in self.observables )
+            self.timing = dict( (obs.name, 0.) for obs in self.observables )
+            self.timing['read'] = 0.
+            if not nout:
+                return out
+            if len(atoms) == dcd.natoms:
+                atoms = None
+            blocks = dcd.iter_block(atoms=atoms, size=self.blockSize,
+                                    begin=begin, end=end, stride=stride,
+                                    dtype=np.float64)
+            n = 0
+            while 1:
+                t0 = time.time()
+                try:
+                    block = blocks.next()
+                except StopIteration:
+                    break
+                self.timing['read'] += time.time() - t0
+                k = len(block)
+                for obs, pos in zip(self.observables, positions):
+                    t0 = time.time()
+                    xyz = block if pos is None else block[:, pos]
+                    obs.compute(xyz, out[obs.name][n:n+k])
+                    self.timing[obs.name] += time.time() - t0
+                n += k
+        finally:
+            dcd.close()
+        return out
@@ -0,0 +1,233 @@
+"""
+Replica exchange (REX) efficiency diagnostics, computed from the replica
+permutation arrays of an exchange log.
+
+>>> from pychm.future.scripts.hfrex import ExchangeLog
+>>> diag = RexDiag(ExchangeLog('rex.exch'))
+>>> diag.get_acceptanceMatrix().diagonal(1)     # neighbour acceptance
+>>> diag.get_roundTrips()                       # per replica, in exchanges
+>>> diag.get_flowFraction()                     # f(T)
+>>> diag.get_autocorrTimes()                    # per replica, in exchanges
+>>> diag.get_ladder()                           # suggested temperatures
+"""
+
+
+import numpy as np
+
+
+class RexDiagError(Exception):
+    """
+    Exception to raise when errors occur involving the RexDiag class.
+    """
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class RexDiag(object):
+    """
+    Takes an :class:`ExchangeLog`, or any object with an `index` attribute
+    holding the (nexchanges, nreplicas) 1-based replica index at each
+    temperature and a `temp_array` attribute holding the temperatures.
+
+    Internally the log is inverted into `position`, the (nexchanges,
+    nreplicas) temperature index of each replica, and every statistic is
+    computed with whole array operations, in chunks of `chunkSize` exchanges
+    where the temporaries would otherwise be large.
+    """
+    chunkSize = 65536
+
+    def __init__(self, rexlog, attemptFraction=1.):
+        index = np.asarray(rexlog.index)
+        if index.ndim != 2 or not index.size:
+            raise RexDiagError('index: must be a non-empty 2d array')
+        self.temp = np.asarray(rexlog.temp_array, dtype=np.float64)
+        self.nexchanges, self.nreplicas = index.shape
+        if len(self.temp) != self.nreplicas:
+            raise RexDiagError('temp_array: must have one temperature per replica')
+        self.attemptFraction = attemptFraction
+        dtype = self.nreplicas < 128 and np.int8 or np.int16
+        self.position = np.empty(index.shape, dtype=dtype, order='F')
+        slots = np.arange(self.nreplicas, dtype=dtype)
+        for begin in xrange(0, self.nexchanges, self.chunkSize):
+            chunk = index[begin:begin+self.chunkSize] - 1
+            if chunk.min() < 0 or chunk.max() >= self.nreplicas:
+                raise RexDiagError('index: replica index out of range')
+            # a repeated replica leaves some slot unset
+            tmp = self.position[begin:begin+self.chunkSize]
+            tmp.fill(-1)
+            tmp[np.arange(len(chunk))[:, np.newaxis], chunk] = slots
+            if (tmp < 0).any():
+                raise RexDiagError('index: each row must be a permutation of the replicas')
+        self._flow = None
+
+    def get_acceptanceMatrix(self):
+        """
+        Returns the (nreplicas, nreplicas) temperature transition matrix,
+        element [i, j] is the fraction of exchanges at which a replica at
+        temperature i moved to temperature j. The first off-diagonals hold
+        the neighbour acceptance ratios, divided by `attemptFraction`, the
+        fraction of exchanges at which each neighbour pair is attempted (0.5
+        when even and odd pairs alternate).
+        """
+        n = self.nreplicas
+        counts = np.zeros(n * n, dtype=np.int64)
+        for begin in xrange(0, self.nexchanges - 1, self.chunkSize):
+            chunk = self.position[begin:begin+self.chunkSize+1].astype(np.int32)
+            counts += np.bincount((chunk[:-1] * n + chunk[1:]).ravel(), minlength=n * n)
+        counts = counts.reshape(n, n).astype(np.float64)
+        total = counts.sum(axis=1)[:, np.newaxis]
+        total[total == 0] = 1.
+        tmp = counts / total
+        neighbours = np.arange(n - 1)
+        tmp[neighbours, neighbours + 1] /= self.attemptFraction
+        tmp[neighbours + 1, neighbours] /= self.attemptFraction
+        return tmp
+
+    def get_neighbourAcceptance(self):
+        """
+        Returns the (nreplicas - 1) acceptance ratios of neighbouring
+        temperature pairs, averaged over both directions.
+        """
+        tmp = self.get_acceptanceMatrix()
+        return 0.5 * (tmp.diagonal(1) + tmp.diagonal(-1))
+
+    def _extremes(self, replica):
+        """
+        Returns the exchange numbers at which `replica` first reaches the
+        lowest or the highest temperature after having been at the other,
+        and a boolean array, True where that extreme is the highest.
+        """
+        column = self.position[:, replica]
+        visits = np.flatnonzero((column == 0) | (column == self.nreplicas - 1))
+        if not len(visits):
+            return visits, np.zeros(0, dtype=np.bool_)
+        top = column[visits] == self.nreplicas - 1
+        keep = np.concatenate(([True], top[1:] != top[:-1]))
+        return visits[keep], top[keep]
+
+    def get_roundTrips(self):
+        """
+        Returns a list with one array per replica, of the durations, in
+        exchanges, of the complete round trips from the lowest temperature to
+        the highest and back.
+        """
+        tmp = []
+        for replica in xrange(self.nreplicas):
+            visits, top = self._extremes(replica)
+            tmp.append(np.diff(visits[~top]))
+        return tmp
+
+    def get_meanRoundTrip(self):
+        """
+        Returns the mean round trip time in exchanges over all replicas, or
+        `np.inf` if no replica completed a round trip.
+        """
+        tmp = np.concatenate(self.get_roundTrips())
+        if not len(tmp):
+            return np.inf
+        return tmp.mean()
+
+    def get_flowFraction(self):
+        """
+        Returns f(T), for each temperature the fraction of the labelled
+        replicas which are moving up, that is which have visited the lowest
+        temperature more recently than the highest. An efficient ladder has
+        f falling linearly from 1 to 0.
+        """
+        if self._flow is None:
+            n = self.nreplicas
+            counts = np.zeros(2 * n, dtype=np.int64)
+            for replica in xrange(n):
+                visits, top = self._extremes(replica)
+                if not len(visits):
+                    continue
+                # label each exchange with the direction set by the last extreme
+                last = np.zeros(self.nexchanges, dtype=np.intp)
+                last[visits] = np.arange(1, len(visits) + 1)
+                np.maximum.accumulate(last, out=last)
+                begin = visits[0]
+                up = (~top)[last[begin:] - 1]
+                column = self.position[begin:, replica].astype(np.intp)
+                counts += np.bincount(2 * column + up, minlength=2 * n)
+            self._flow = counts.reshape(n, 2)
+        total = self._flow.sum(axis=1).astype(np.float64)
+        total[total == 0] = np.nan
+        return self._flow[:, 1] / total
+
+    def get_autocorrTimes(self, window=5.):
+        """
+        Returns the integrated autocorrelation time, in exchanges, of the
+        temperature index of each replica. The autocorrelation function is
+        computed by FFT, and summed up to the first lag M with
+        M >= `window` * tau(M).
+        """
+        n = self.nexchanges
+        size = 1
+        while size < 2 * n:
+            size *= 2
+        tmp = np.empty(self.nreplicas)
+        for replica in xrange(self.nreplicas):
+            x = self.position[:, replica].astype(np.float64)
+            x -= x.mean()
+            f = np.fft.rfft(x, size)
+            acf = np.fft.irfft(f * f.conjugate(), size)[:n]
+            if acf[0] <= 0:
+                tmp[replica] = np.nan
+                continue
+            acf /= acf[0]
+            tau = 2 * np.cumsum(acf) - 1
+            lags = np.flatnonzero(np.arange(n) >= window * tau)
+            if lags.size:
+                tmp[replica] = tau[lags[0]]
+            else:
+                tmp[replica] = tau[-1]
+        return tmp
+
+    def get_ladder(self, method='auto'):
+        """
+        Suggests an adjusted temperature ladder, with the same end points and
+        number of replicas.
+
+        With `method='flow'`, the temperatures are redistributed following
+        the feedback optimization of Katzgraber et al. (J. Stat. Mech. 2006,
+        P03018), so that the replica density goes as sqrt(df/dT / dT). With
+        `method='acceptance'`, the temperatures are redistributed in inverse
+        temperature so that every neighbour pair has the same acceptance
+        ratio, assuming -ln(acceptance) grows as the square of the inverse
+        temperature spacing. The default uses the flow when every interior
+        temperature has a flow fraction, and acceptance otherwise.
+        """
+        if method not in ('auto', 'flow', 'acceptance'):
+            raise RexDiagError('method: must be "auto", "flow" or "acceptance"')
+        temp = self.temp
+        if (np.diff(temp) <= 0).any():
+            raise RexDiagError('temp_array: must be in increasing order')
+        if method in ('auto', 'flow'):
+            f = self.get_flowFraction()
+            if method == 'flow' or not np.isnan(f).any():
+                # intervals carry weight sqrt(df / dT^2) * dT
+                df = np.abs(np.diff(f))
+                df[~np.isfinite(df)] = 0.
+                df = np.maximum(df, 1e-3 * max(df.max(), 1e-12))
+                weight = np.sqrt(df)
+                return self._redistribute(temp, weight)
+        acc = self.get_neighbourAcceptance()
+        acc = np.clip(acc, 1e-6, 1.)
+        beta = 1. / temp
+        # -ln(acc) ~ dbeta^2, so each interval carries sqrt(-ln(acc))
+        weight = np.sqrt(-np.log(acc))
+        weight = np.maximum(weight, 1e-3 * max(weight.max(), 1e-12))
+        return 1. / self._redistribute(beta, weight)
+
+    @staticmethod
+    def _redistribute(x, weight):
+        """
+        Places len(x) points between x[0] and x[-1], so that each interval
+        carries the same share of the piecewise uniform `weight` assigned to
+        the intervals of x.
+        """
+        cumulative = np.concatenate(([0.], np.cumsum(weight)))
+        targets = np.linspace(0., cumulative[-1], len(x))
+        return np.interp(targets, cumulative, x)
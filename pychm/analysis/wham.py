@@ -0,0 +1,305 @@
+"""
+Multi-temperature reweighting of replica exchange (REX) data by the
+weighted histogram analysis method (WHAM).
+
+The potential energies sampled at every temperature of the ladder are
+pooled into one energy histogram, and the dimensionless free energies `f`
+of the temperatures are solved for by Newton's method on the (convex) WHAM
+likelihood, with every sum over states or bins taken in log space. Any
+observable recorded alongside the energies can then be averaged at any
+temperature, between or beyond the simulated ones.
+
+>>> from pychm.scripts.getprop import getProp
+>>> props = [ getProp(open(outFile), 'dynaener', 'avertemp')
+...         for outFile in outFileList ]
+>>> wham = Wham.fromProps(props)
+>>> T = np.linspace(250., 400., 151)
+>>> wham.get_Cv(T), wham.get_Tm(T)
+>>> wham.get_DelG(natQ, (0., 0.5), (0.5, 1.), T)   # natQ aligned with energies
+
+Energies are in kcal/mol and temperatures in K.
+"""
+
+
+import numpy as np
+from pychm.const.units import BOLTZMANN
+
+
+class WhamError(Exception):
+    """
+    Exception to raise when errors occur involving the Wham class.
+    """
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+def logsumexp(a, axis=None):
+    """
+    Returns log(sum(exp(a), axis)), without overflow.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    amax = np.max(a, axis=axis, keepdims=True)
+    amax[~np.isfinite(amax)] = 0.
+    tmp = np.log(np.sum(np.exp(a - amax), axis=axis, keepdims=True)) + amax
+    if axis is None:
+        return tmp.item()
+    return np.squeeze(tmp, axis=axis)
+
+
+class Wham(object):
+    """
+    Takes `energies`, a sequence of 1d arrays of the potential energies
+    sampled at each temperature of `temps`, not necessarily of equal
+    lengths. The energies are binned into `nbins` bins, of which only the
+    occupied ones are kept, each represented by the mean energy of its
+    samples.
+
+    Observables passed to the ``get_*`` methods are sequences of 1d arrays
+    aligned, sample for sample, with `energies`.
+
+    **Class Attributes:**
+        ``tol``         The convergence threshold on the free energies.
+        ``maxIter``     The largest number of Newton iterations.
+    """
+    tol = 1e-10
+    maxIter = 100
+
+    def __init__(self, energies, temps, nbins=1000):
+        self.temps = np.asarray(temps, dtype=np.float64).ravel()
+        if len(energies) != len(self.temps):
+            raise WhamError('energies: must have one array per temperature')
+        if (self.temps <= 0).any():
+            raise WhamError('temps: must be specified in K, and greater than 0')
+        self.beta = 1. / (BOLTZMANN * self.temps)
+        energies = [ np.asarray(e, dtype=np.float64).ravel() for e in energies ]
+        self.nsamples = np.array([ len(e) for e in energies ], dtype=np.float64)
+        if not self.nsamples.all():
+            raise WhamError('energies: every temperature must have samples')
+        self._means = np.array([ e.mean() for e in energies ])
+        lo = min( e.min() for e in energies )
+        hi = max( e.max() for e in energies )
+        if not np.isfinite([lo, hi]).all():
+            raise WhamError('energies: must be finite')
+        scale = nbins / max(hi - lo, 1e-12)
+        dtype = nbins <= 32767 and np.int16 or np.int32
+        counts = np.zeros(nbins)
+        sumE = np.zeros(nbins)
+        sumE2 = np.zeros(nbins)
+        bins = []
+        # one scratch buffer, fresh temporaries per temperature are costly
+        buf = np.empty(max(len(e) for e in energies))
+        for e in energies:
+            tmp = buf[:len(e)]
+            np.subtract(e, lo, out=tmp)
+            tmp *= scale
+            np.minimum(tmp, nbins - 1, out=tmp)
+            b = tmp.astype(dtype)
+            counts += np.bincount(b, minlength=nbins)
+            sumE += np.bincount(b, e, minlength=nbins)
+            np.multiply(e, e, out=tmp)
+            sumE2 += np.bincount(b, tmp, minlength=nbins)
+            bins.append(b)
+        occupied = np.flatnonzero(counts)
+        # renumber the samples over the occupied bins only
+        remap = np.zeros(nbins, dtype=dtype)
+        remap[occupied] = np.arange(len(occupied))
+        self._bins = [ remap[b] for b in bins ]
+        self.counts = counts[occupied]
+        self._sumE = sumE[occupied]
+        self._sumE2 = sumE2[occupied]
+        self.binEnergy = self._sumE / self.counts
+        self._f = None
+
+    @classmethod
+    def fromProps(cls, props, temps=None, energyProp='dynaener',
+                tempProp='avertemp', nbins=1000):
+        """
+        Builds a :class:`Wham` from the dictionaries returned by
+        :func:`pychm.scripts.getprop.getProp`, one per temperature. The
+        temperatures default to the mean of each `tempProp`.
+        """
+        energies = [ prop[energyProp] for prop in props ]
+        if temps is None:
+            temps = [ np.mean(prop[tempProp]) for prop in props ]
+        return cls(energies, temps, nbins)
+
+    def _binSums(self, observable):
+        """
+        Returns the sum over the samples of each bin of `observable`.
+        """
+        if len(observable) != len(self._bins):
+            raise WhamError('observable: must have one array per temperature')
+        tmp = np.zeros(len(self.counts))
+        for b, o in zip(self._bins, observable):
+            o = np.asarray(o, dtype=np.float64).ravel()
+            if o.shape != b.shape:
+                raise WhamError('observable: must be aligned with the energies')
+            tmp += np.bincount(b, o, minlength=len(tmp))
+        return tmp
+
+    def _logDenominator(self, f):
+        """
+        Returns, for each bin, log(sum_k N_k exp(f_k - beta_k E_b)) and the
+        log exponents.
+        """
+        tmp = (np.log(self.nsamples) + f)[:, np.newaxis] - \
+                np.outer(self.beta, self.binEnergy)
+        return logsumexp(tmp, axis=0), tmp
+
+    def _objective(self, f):
+        denom, tmp = self._logDenominator(f)
+        return np.dot(self.counts, denom) - np.dot(self.nsamples, f)
+
+    def solve(self):
+        """
+        Solves the WHAM equations, and returns the dimensionless free
+        energies `f` of the temperatures, with f[0] = 0. Newton steps on
+        the negative log likelihood are backtracked until it decreases, and
+        iterations stop when the largest change of `f` falls below `tol`.
+        """
+        n = self.nsamples
+        # df / dbeta = <E>, integrated by the trapezoidal rule
+        means = self._means
+        f = np.zeros(len(self.temps))
+        f[1:] = np.cumsum(np.diff(self.beta) * 0.5 * (means[1:] + means[:-1]))
+        obj = self._objective(f)
+        for i in xrange(self.maxIter):
+            denom, tmp = self._logDenominator(f)
+            # r[k, b], the share of temperature k in the samples of bin b
+            r = np.exp(tmp - denom)
+            nr = r * self.counts
+            grad = nr.sum(axis=1) - n
+            hess = np.diag(nr.sum(axis=1)) - np.dot(nr, r.T)
+            step = np.zeros_like(f)
+            step[1:] = np.linalg.solve(hess[1:, 1:], -grad[1:])
+            scale = 1.
+            while 1:
+                trial = f + scale * step
+                tmpObj = self._objective(trial)
+                if tmpObj <= obj or scale < 1e-8:
+                    break
+                scale *= 0.5
+            f, obj = trial, tmpObj
+            if np.abs(scale * step).max() < self.tol:
+                break
+        else:
+            raise WhamError('solve: no convergence in %d iterations' % self.maxIter)
+        self._f = f
+        return f
+
+    def get_freeEnergies(self):
+        """
+        Returns the dimensionless free energies `f` of the temperatures,
+        solving the WHAM equations on the first call.
+        """
+        if self._f is None:
+            self.solve()
+        return self._f
+
+    def _logWeights(self, temps):
+        """
+        Returns the (ntemps, nbins) log of the normalized weight of one
+        sample of each bin at each of `temps`.
+        """
+        beta = 1. / (BOLTZMANN * np.asarray(temps, dtype=np.float64).ravel())
+        denom = self._logDenominator(self.get_freeEnergies())[0]
+        tmp = -np.outer(beta, self.binEnergy) - denom
+        norm = logsumexp(tmp + np.log(self.counts), axis=1)
+        return tmp - norm[:, np.newaxis]
+
+    def _average(self, binSums, temps):
+        return np.dot(np.exp(self._logWeights(temps)), binSums)
+
+    def get_average(self, observable, temps):
+        """
+        Returns the average of `observable` at each of `temps`.
+        """
+        return self._average(self._binSums(observable), temps)
+
+    def get_energy(self, temps):
+        """
+        Returns the average potential energy at each of `temps`.
+        """
+        return self._average(self._sumE, temps)
+
+    def get_Cv(self, temps):
+        """
+        Returns the heat capacity, in kcal/mol/K, at each of `temps`, from
+        the fluctuation of the potential energy.
+        """
+        temps = np.asarray(temps, dtype=np.float64).ravel()
+        w = np.exp(self._logWeights(temps))
+        e = np.dot(w, self._sumE)
+        e2 = np.dot(w, self._sumE2)
+        return (e2 - e * e) / (BOLTZMANN * temps * temps)
+
+    def get_populations(self, observable, states, temps):
+        """
+        Returns the (ntemps, nstates) populations of `states`, a sequence of
+        (less, greater) ranges of `observable`, at each of `temps`. Like
+        :meth:`pychm.analysis.delg.DelG.count`, a sample belongs to the
+        first state whose range includes it.
+        """
+        nbins = len(self.counts)
+        if len(observable) != len(self._bins):
+            raise WhamError('observable: must have one array per temperature')
+        sums = np.zeros((len(states) + 1) * nbins)
+        for b, o in zip(self._bins, observable):
+            o = np.asarray(o, dtype=np.float64).ravel()
+            if o.shape != b.shape:
+                raise WhamError('observable: must be aligned with the energies')
+            labels = np.empty(len(o), dtype=np.intp)
+            labels.fill(len(states))
+            for k in xrange(len(states) - 1, -1, -1):
+                less, greater = sorted(states[k])
+                labels[(less <= o) & (o <= greater)] = k
+            labels *= nbins
+            labels += b
+            sums += np.bincount(labels, minlength=len(sums))
+        sums = sums.reshape(len(states) + 1, nbins)[:-1]
+        return self._average(sums.T, temps)
+
+    def get_DelG(self, observable, state0, state1, temps):
+        """
+        Returns the free energy, in kcal/mol, of `state0` relative to
+        `state1`, -kT ln(p0 / p1), at each of `temps`, where the states are
+        (less, greater) ranges of `observable`; `np.inf` where either
+        population vanishes.
+        """
+        temps = np.asarray(temps, dtype=np.float64).ravel()
+        p = self.get_populations(observable, [state0, state1], temps)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tmp = -BOLTZMANN * temps * np.log(p[:, 0] / p[:, 1])
+        tmp[(p[:, 0] <= 0) | (p[:, 1] <= 0)] = np.inf
+        return tmp
+
+    def get_Tm(self, temps, observable=None, state0=None, state1=None):
+        """
+        Returns the melting temperature on the grid `temps` (in increasing
+        order). Given `observable` and the two states, it is the first
+        temperature at which :meth:`get_DelG` changes sign, by linear
+        interpolation; otherwise the peak of :meth:`get_Cv`, refined by a
+        parabola through the grid points around it. Returns `np.nan` if
+        there is no crossing or the peak lies on the edge of the grid.
+        """
+        temps = np.asarray(temps, dtype=np.float64).ravel()
+        if observable is not None:
+            g = self.get_DelG(observable, state0, state1, temps)
+            ok = np.isfinite(g)
+            t, g = temps[ok], g[ok]
+            cross = np.flatnonzero(np.sign(g[1:]) != np.sign(g[:-1]))
+            if not cross.size:
+                return np.nan
+            k = cross[0]
+            return t[k] - g[k] * (t[k+1] - t[k]) / (g[k+1] - g[k])
+        cv = self.get_Cv(temps)
+        k = np.argmax(cv)
+        if k == 0 or k == len(temps) - 1:
+            return np.nan
+        x, y = temps[k-1:k+2], cv[k-1:k+2]
+        a, b, c = np.polyfit(x, y, 2)
+        if a >= 0:
+            return temps[k]
+        return -b / (2 * a)
@@ -5,10 +5,11 @@
 
 
 import os
-import cPickle as pickle
+import numpy as np
 from numpy import ndarray
 from pychm.tools import Property, lowerKeys
 from pychm.analysis.baseanalysis import BaseAnalysis, load_correlOutput
+from pychm.analysis.geometry import kabsch_rmsd
 
 
 class BBRMSD(BaseAnalysis):
@@ -25,31 +26,68 @@ class BBRMSD(BaseAnalysis):
     def data():
         doc =\
         """
-        A numpy array representing the backbone RMSD as a function of time.
+        A numpy array representing the backbone RMSD as a function of
+        time. It is read from the correl output ``anlFilename`` when it
+        exists, and computed from ``dcdFilename`` otherwise, through the
+        result cache, so it is only rebuilt when its inputs change.
         """
         def fget(self):
-            filename = '%s.pickle' % self.anlFilename
-            try:
-                self._data = pickle.load(open(filename))
-                print 'found pickled data in: %s' % filename
-                return self._data
-            except IOError:
-                print 'processing data in %s:' % self.anlFilename
-                self._data = load_correlOutput('%s' % self.anlFilename)
-                pickle.dump(self._data ,open(filename, 'w'))
-                return self._data
+            name, build, params, files = self._dataSource()
+            self._data = self.get_cached(name, build, params, files)
+            return self._data
         def fset(self, value):
             assert isinstance(value,ndarray)
             self._data = value
         def fdel(self):
-            filename = '%s.pickle' % self.anlFilename
-            del self._data
+            name, build, params, files = self._dataSource()
+            self.cache.discard(self.get_cacheKey(name, params, files))
             try:
-                os.remove(filename)
-            except IOError:
+                del self._data
+            except AttributeError:
                 pass
         return locals()
 
+    def _dataSource(self):
+        """
+        Returns the cache name, builder, parameters and input files of
+        ``data``.
+        """
+        if os.path.exists(self.anlFilename):
+            return ('bbrmsd.correl', lambda: load_correlOutput(self.anlFilename),
+                    (), [self.anlFilename])
+        return self._nativeSource()
+
+    def _nativeSource(self):
+        return ('bbrmsd.native', self.calc_bbrmsd, (),
+                [self.dcdFilename, self.psfFilename, self.crdFilename])
+
+# Native processing
+    def calc_bbrmsd(self, blockSize=256):
+        """
+        Computes the mass weighted, oriented RMSD of the backbone atoms
+        (type b) from the coordinates of ``crdFilename``, for each frame of
+        the correl window of ``dcdFilename``, without CHARMM.
+        """
+        psf = self.get_psf()
+        atoms = psf.select(atomType='b')
+        masses = psf.atom['mass'][atoms]
+        ref = self.get_crdXyz()[atoms]
+        tmp = [ kabsch_rmsd(block, ref, masses) for block in
+                self.iter_correlBlocks(atoms=atoms, size=blockSize) ]
+        if not tmp:
+            return np.zeros(0, dtype=np.float64)
+        return np.concatenate(tmp)
+
+    def do_native(self, **kwargs):
+        """
+        Computes the backbone RMSD time series without CHARMM, through
+        the result cache.
+        """
+        kwargs = lowerKeys(kwargs)
+        blockSize = kwargs.get('blocksize', 256)
+        name, build, params, files = self._nativeSource()
+        self.data = self.get_cached(name, lambda: build(blockSize), params, files)
+
 # Charmm input creation
     def do_correl(self, **kwargs):
         """
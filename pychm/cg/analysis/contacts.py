@@ -2,11 +2,12 @@
 
 import os
 import numpy as np
-import cPickle as pickle
 from copy import deepcopy
 from pychm.tools import Property, mkdir, lowerKeys, grouper
 from pychm.lib.bond import Bond
-from pychm.analysis.baseanalysis import BaseAnalysis, load_correlOutput
+from pychm.analysis.baseanalysis import BaseAnalysis, load_correlOutputs
+from pychm.analysis.contactstore import ContactStore
+from pychm.analysis.geometry import cell_list_pairs, pair_id
 from pychm.io.pdb import PDBFile
 from pychm.cg.ktgo import KTGo
 
@@ -30,30 +31,77 @@ class Contacts(BaseAnalysis):
     def data():
         doc =\
         """
+        The full contact distance matrix, see ``build_contactMatrix``, read
+        from the correl outputs in ``anlPathname`` through the result cache,
+        so it is only rebuilt when they change.
         """
         def fget(self):
-            filename = '%s/contacts.pickle' % self.anlPathname
-            try:
-                self._data = pickle.load(open(filename))
-                print 'found pickled data in: %s' % filename
-                return self._data
-            except IOError:
-                print 'processing data in: %s' % self.anlPathname
-                self._data = self.build_contactMatrix()
-                pickle.dump(self._data, open(filename, 'w'))
-                return self._data
+            files = self.get_correlFilenames()
+            self._data = self.get_cached('contacts.correl', self.build_contactMatrix,
+                                        (), files)
+            return self._data
         def fset(self, value):
             assert isinstance(value, np.ndarray)
             self._data = value
         def fdel(self):
-            filename = '%s/contacts.pickle' % self.anlPathname
-            del self._data
+            files = self.get_correlFilenames()
+            self.cache.discard(self.get_cacheKey('contacts.correl', (), files))
             try:
-                os.remove(filename)
-            except IOError:
+                del self._data
+            except AttributeError:
                 pass
         return locals()
 
+    @Property
+    def store():
+        doc =\
+        """
+        The :class:`ContactStore` of every sidechain pair within
+        ``nativeRad``, computed from ``dcdFilename`` by :meth:`do_native`
+        through the result cache, so it is only rebuilt when the trajectory,
+        ``nativeRad`` or the correl window change.
+        """
+        def fget(self):
+            return self._get_store()
+        def fset(self, value):
+            assert isinstance(value, ContactStore)
+            self._store = (self._get_storeKey(), value)
+        def fdel(self):
+            self.cache.discard(self._get_storeKey())
+            try:
+                del self._store
+            except AttributeError:
+                pass
+        return locals()
+
+    def _storeParams(self):
+        index, native = self.get_sidechainIndex()
+        return (index, native, self.nativeRad)
+
+    def _get_storeKey(self):
+        return self.get_cacheKey('contacts.native', self._storeParams(),
+                                [self.dcdFilename])
+
+    def _get_store(self, blockSize=256):
+        key = self._get_storeKey()
+        try:
+            if self._store[0] == key:
+                return self._store[1]
+        except AttributeError:
+            pass
+        build = lambda: self.calc_contactStore(blockSize).asdict()
+        tmp = self.get_cached('contacts.native', build, self._storeParams(),
+                            [self.dcdFilename])
+        self._store = (key, ContactStore.fromdict(tmp))
+        return self._store[1]
+
+    def get_correlFilenames(self):
+        """
+        Returns the names of the correl outputs, one per contact.
+        """
+        return [ '%s/contact%04d.anl' % (self.anlPathname, i) for i in
+                xrange(len(self.contacts)) ]
+
     @Property
     def inpPathname():
         doc =\
@@ -101,6 +149,43 @@ class Contacts(BaseAnalysis):
                 contact.native = False
         return tmp
 
+    def get_sidechainIndex(self):
+        """
+        Returns the 0-based atom indices of the sidechain beads, and a
+        boolean array which is ``True`` for the native pairs, in the pair
+        order of :meth:`get_contacts` and :func:`pair_id`.
+        """
+        try:
+            return self._sidechainIndex
+        except AttributeError:
+            pass
+        sidechains = [ atom for atom in self.cg if atom.atomType == 's' ]
+        position = dict( (atom.atomNum, k) for k, atom in enumerate(sidechains) )
+        n = len(sidechains)
+        native = np.zeros(n * (n - 1) // 2, dtype=np.bool_)
+        for contact in self.cg.get_nativeSCSC():
+            i, j = position[contact.i.atomNum], position[contact.j.atomNum]
+            native[pair_id(min(i, j), max(i, j), n)] = True
+        index = np.array([ atom.atomNum for atom in sidechains ], dtype=np.intp) - 1
+        self._sidechainIndex = (index, native)
+        return self._sidechainIndex
+
+    def calc_contactStore(self, blockSize=256):
+        """
+        Finds every sidechain pair within ``nativeRad`` in each frame of the
+        correl window of ``dcdFilename`` with a cell list, without CHARMM,
+        and returns them as a :class:`ContactStore`.
+        """
+        index, native = self.get_sidechainIndex()
+        n = len(index)
+        tmp = ContactStore(len(native), self.nativeRad)
+        for block in self.iter_correlBlocks(atoms=index, size=blockSize):
+            for frame in block:
+                i, j, d = cell_list_pairs(frame, self.nativeRad)
+                tmp.append(pair_id(i, j, n), d)
+        tmp.compact()
+        return tmp
+
     def build_contactMatrix(self):
         """
         Builds a 2D numpy array from available correl output files. The first
@@ -111,14 +196,10 @@ class Contacts(BaseAnalysis):
         """
         print "Building full contact matrix."
         rowLength = (self.correlStop - self.correlStart) / self.correlSkip + 1
-        tmp = []
-        for i in xrange(len(self.contacts)):
-            try:
-                tmp.append(load_correlOutput('%s/contact%04d.anl' % (self.anlPathname, i)))
-            except IOError:
-                tmp.append(np.zeros(rowLength))
-                print "Can't find correl output for contact number: %04d." % i
-        return np.array(tmp, dtype=np.float64)
+        tmp, missing = load_correlOutputs(self.get_correlFilenames(), rowLength)
+        for i in missing:
+            print "Can't find correl output for contact number: %04d." % i
+        return tmp
 
     def get_nativeContactMatrix(self):
         """
@@ -137,6 +218,53 @@ class Contacts(BaseAnalysis):
         tmp[nativeContacts > self.nativeRad] = 0
         return tmp.mean(axis=0)
 
+    def get_QofT(self, native=True, rad=None):
+        """
+        Returns the fraction of native (or, with ``native=False``,
+        non-native) sidechain pairs in contact in each frame, from
+        ``store``. `rad` defaults to ``nativeRad``.
+        """
+        mask = self.get_sidechainIndex()[1]
+        if not native:
+            mask = ~mask
+        return self.store.get_QofT(mask, rad)
+
+    def get_contactFrequency(self, rad=None):
+        """
+        Returns the symmetric (nsidechain, nsidechain) map of the fraction of
+        frames in which each sidechain pair is in contact, from ``store``.
+        """
+        freq = self.store.get_frequency(rad)
+        n = int(round((1 + np.sqrt(1 + 8 * len(freq))) / 2))
+        tmp = np.zeros((n, n), dtype=np.float64)
+        i, j = np.triu_indices(n, 1)
+        tmp[i, j] = freq
+        tmp[j, i] = freq
+        return tmp
+
+    def get_contactLifetimes(self, native=None, rad=None):
+        """
+        Returns the (pairs, lifetimes) of every uninterrupted contact, with
+        lifetimes in frames of the correl window, from ``store``. Set
+        `native` to ``True`` or ``False`` to keep only native or non-native
+        pairs.
+        """
+        pairs, lifetimes = self.store.get_lifetimes(rad)
+        if native is not None:
+            keep = self.get_sidechainIndex()[1][pairs] == native
+            pairs, lifetimes = pairs[keep], lifetimes[keep]
+        return pairs, lifetimes
+
+# Native processing
+    def do_native(self, **kwargs):
+        """
+        Builds the :class:`ContactStore` without CHARMM, through the result
+        cache.
+        """
+        kwargs = lowerKeys(kwargs)
+        blockSize = kwargs.get('blocksize', 256)
+        return self._get_store(blockSize)
+
 # Charmm input creation
     def do_correl(self, **kwargs):
         self.write_correlInput(**kwargs)
@@ -2,11 +2,11 @@
 
 import os
 import numpy as np
-import cPickle as pickle
 from copy import deepcopy
 from pychm.tools import Property, mkdir, lowerKeys, grouper
 from pychm.lib.bond import Bond
-from pychm.analysis.baseanalysis import BaseAnalysis, load_correlOutput
+from pychm.analysis.baseanalysis import BaseAnalysis, load_correlOutputs
+from pychm.analysis.geometry import pair_distances
 from pychm.io.pdb import PDBFile
 from pychm.cg.ktgo import KTGo
 
@@ -30,30 +30,50 @@ class NatQ(BaseAnalysis):
     def data():
         doc =\
         """
+        The native contact distance matrix, see
+        ``build_nativeContactMatrix``. It is read from the correl outputs in
+        ``anlPathname`` when they exist, and computed from ``dcdFilename``
+        otherwise, through the result cache, so it is only rebuilt when
+        its inputs change.
         """
         def fget(self):
-            filename = '%s/natq.pickle' % self.anlPathname
-            try:
-                self._data = pickle.load(open(filename))
-                print 'found pickled data in: %s' % filename
-                return self._data
-            except IOError:
-                print 'processing data in: %s' % self.anlPathname
-                self._data = self.build_nativeContactMatrix()
-                pickle.dump(self._data, open(filename, 'w'))
-                return self._data
+            name, build, params, files = self._dataSource()
+            self._data = self.get_cached(name, build, params, files)
+            return self._data
         def fset(self, value):
             assert isinstance(value, np.ndarray)
             self._data = value
         def fdel(self):
-            filename = '%s/natq.pickle' % self.anlPathname
-            del self._data
+            name, build, params, files = self._dataSource()
+            self.cache.discard(self.get_cacheKey(name, params, files))
             try:
-                os.remove(filename)
-            except IOError:
+                del self._data
+            except AttributeError:
                 pass
         return locals()
 
+    def _dataSource(self):
+        """
+        Returns the cache name, builder, parameters and input files of
+        ``data``.
+        """
+        filenames = self.get_correlFilenames()
+        if filenames and os.path.exists(filenames[0]):
+            return ('natq.correl', self.build_nativeContactMatrix, (),
+                    filenames)
+        return self._nativeSource()
+
+    def _nativeSource(self):
+        return ('natq.native', self.calc_nativeContactMatrix,
+                self.get_contactIndex(), [self.dcdFilename])
+
+    def get_correlFilenames(self):
+        """
+        Returns the names of the correl outputs, one per native contact.
+        """
+        return [ '%s/natq%04d.anl' % (self.anlPathname, i) for i in
+                xrange(len(self.nativeContacts)) ]
+
     @Property
     def inpPathname():
         doc =\
@@ -90,14 +110,52 @@ class NatQ(BaseAnalysis):
         """
         print "Building native contact matrix."
         rowLength = (self.correlStop - self.correlStart) / self.correlSkip + 1
+        tmp, missing = load_correlOutputs(self.get_correlFilenames(), rowLength)
+        for i in missing:
+            print "Can't find correl output for natq number: %04d." % i
+        return tmp
+
+    def get_contactIndex(self):
+        """
+        Returns the sorted 0-based indices of the atoms involved in native
+        contacts, and the (i, j) positions of each contact's atoms within
+        them, for reading only those atoms from the .dcd file.
+        """
+        i = np.array([ contact.i.atomNum for contact in self.nativeContacts ], dtype=np.intp) - 1
+        j = np.array([ contact.j.atomNum for contact in self.nativeContacts ], dtype=np.intp) - 1
+        atoms, pos = np.unique(np.concatenate((i, j)), return_inverse=True)
+        return atoms, pos[:len(i)], pos[len(i):]
+
+    def calc_nativeContactMatrix(self, blockSize=256):
+        """
+        Computes the native contact distance matrix from ``self.dcdFilename``
+        without CHARMM, in the layout of ``build_nativeContactMatrix``: the
+        first index references the contact number, the second the frames of
+        the correl window.
+        """
+        atoms, i, j = self.get_contactIndex()
         tmp = []
-        for i in xrange(len(self.nativeContacts)):
-            try:
-                tmp.append(load_correlOutput('%s/natq%04d.anl' % (self.anlPathname, i)))
-            except IOError:
-                tmp.append(np.zeros(rowLength))
-                print "Can't find correl output for natq number: %04d." % i
-        return np.array(tmp, dtype=np.float64)
+        for block in self.iter_correlBlocks(atoms=atoms, size=blockSize):
+            tmp.append(pair_distances(block, i, j))
+        if not tmp:
+            return np.zeros((len(i), 0), dtype=np.float64)
+        return np.concatenate(tmp).T.copy()
+
+    def calc_natQofT(self, blockSize=256):
+        """
+        Computes the fraction of native contacts formed in each frame of
+        ``self.dcdFilename`` without CHARMM, and without keeping the contact
+        distance matrix.
+        """
+        atoms, i, j = self.get_contactIndex()
+        tmp = []
+        dist = np.empty((blockSize, len(i)), dtype=np.float64)
+        for block in self.iter_correlBlocks(atoms=atoms, size=blockSize):
+            d = pair_distances(block, i, j, out=dist[:len(block)])
+            tmp.append((d <= self.nativeRad).mean(axis=1))
+        if not tmp:
+            return np.zeros(0, dtype=np.float64)
+        return np.concatenate(tmp)
 
     def get_natQofT(self):
         """
@@ -108,6 +166,17 @@ class NatQ(BaseAnalysis):
         tmp[data > self.nativeRad] = 0
         return tmp.mean(axis=0)
 
+# Native processing
+    def do_native(self, **kwargs):
+        """
+        Computes the native contact distance matrix without CHARMM, through
+        the result cache.
+        """
+        kwargs = lowerKeys(kwargs)
+        blockSize = kwargs.get('blocksize', 256)
+        name, build, params, files = self._nativeSource()
+        self.data = self.get_cached(name, lambda: build(blockSize), params, files)
+
 # Charmm input creation
     def do_correl(self, **kwargs):
         self.write_correlInput(**kwargs)
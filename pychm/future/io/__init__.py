@@ -1,5 +1,11 @@
 
 
+from pychm.future.io.charmm import open_crd
 from pychm.future.io.charmm import open_dcd
+from pychm.future.io.charmm import open_dcd_series
 from pychm.future.io.charmm import open_prm
+from pychm.future.io.charmm import open_psf
 from pychm.future.io.charmm import open_rtf
+from pychm.future.io.archive import open_archive
+from pychm.future.io.archive import dcd_to_archive
+from pychm.future.io.archive import archive_to_dcd
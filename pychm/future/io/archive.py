@@ -0,0 +1,535 @@
+"""This module contains a compact, compressed trajectory container, intended
+for long term storage of CHARMM trajectories.
+
+Coordinates are quantized to a user chosen fixed precision, for example
+0.001 Angstrom, and stored in blocks of :attr:`ArchiveFile.block_size`
+frames. Within a block, the first frame is delta coded along the atom index
+and every later frame is delta coded against the previous frame. The deltas
+are zigzag coded into the narrowest unsigned integer type that can hold
+them, byte shuffled, and entropy coded with DEFLATE (:mod:`zlib`). Unit cell
+data, if present, is stored losslessly.
+
+Blocks are independent, and an index of block offsets is stored at the end
+of the file, so any frame can be read by decoding a single block. Files
+which were not closed properly, and so have no index, are indexed by walking
+the block records.
+
+>>> dcd_to_archive('prod.dcd', 'prod.pca', precision=0.001)
+>>> arc = open_archive('prod.pca')
+>>> for block in arc.iter_block(atoms=ca_index, size=256):
+...     rg.extend(radius_of_gyration(block))
+>>> archive_to_dcd('prod.pca', 'prod_lossy.dcd')
+"""
+
+from __future__ import division
+
+__all__ = ["open_archive", "dcd_to_archive", "archive_to_dcd"]
+
+import os
+import struct
+import warnings
+import zlib
+
+import numpy as np
+
+from pychm.future.io.base import FortFile
+from pychm.future.io.charmm.dcd import open_dcd
+
+
+MAGIC = 'PYCA'
+VERSION = 1
+
+
+def open_archive(fname, mode='r', buffering=None, precision=0.001,
+                block_size=100):
+    """The public function responsible for mediating access to compressed
+    trajectory archives. Opens a file and returns a stream. If the file
+    cannot be opened, an :exec:`IOError` is raised. If the file is opened for
+    reading, its header and block index are read immediately.
+
+    Parameters
+    ----------
+    fname: a string representing the path to a trajectory archive
+    mode: an optional string that specifies the mode in which the file is
+    opened. It defaults to 'r' which means open for reading. Other values
+    are shown in the table below:
+    ========= =================================================================
+    Character Meaning
+    --------- -----------------------------------------------------------------
+    'r'       open for reading (default)
+    'w'       open for writing, truncating the file first
+    'x'       open for writing, noclobber, raises a value error if file exists
+    ========= =================================================================
+    buffering: an optional integer used to set the buffering policy. Passing 0
+    switches buffering off. Passing negative values, or 1 sets buffer to
+    default size. Passing any other positive integer sets the buffer size in
+    bytes.
+    precision: when writing, the quantization step in Angstroms, the largest
+    error of a stored coordinate is half of this value.
+    block_size: when writing, the number of frames per compressed block.
+    Larger blocks compress slightly better, smaller blocks make random
+    access cheaper.
+    """
+    if not isinstance(fname, basestring):
+        raise TypeError("Invalid fname: %r" % fname)
+    if not isinstance(mode, basestring):
+        raise TypeError("Invalid mode: %r" % mode)
+    if buffering is not None and not isinstance(buffering, int):
+        raise TypeError("Invalid buffering: %r" % buffering)
+    # parse modes
+    modes = set(mode)
+    if modes - set("rwxb") or len(mode) > len(modes):
+        raise ValueError("invalid mode: %r" % mode)
+    reading = "r" in modes
+    writing = "w" in modes or "x" in modes
+    if reading + writing != 1:
+        raise ValueError("must have exactly one read/write mode")
+    if "x" in modes and os.path.isfile(fname):
+        raise ValueError("you may not set `mode=x` for existing files")
+    if precision <= 0:
+        raise ValueError("invalid value for precision: %r" % precision)
+    if block_size < 1:
+        raise ValueError("invalid value for block_size: %r" % block_size)
+    # instantiate!
+    tmp = ArchiveFile(fname, mode=(reading and "rb" or "wb"),
+                    buffering=buffering)
+    if reading:
+        tmp.read_header()
+        tmp.read_index()
+    else:
+        tmp.precision = float(precision)
+        tmp.block_size = int(block_size)
+    return tmp
+
+
+def dcd_to_archive(dcd_fname, fname, precision=0.001, block_size=100):
+    """Compresses a DCD file into a trajectory archive, one block at a time,
+    so memory use does not depend on the length of the trajectory. The DCD
+    header is kept in the archive metadata.
+    """
+    with open_dcd(dcd_fname, mode='r') as dcd:
+        view = dcd.memmap()
+        xtl = view.xtl
+        with open_archive(fname, mode='w', precision=precision,
+                        block_size=block_size) as arc:
+            for key in ArchiveFile.dcd_fields:
+                arc.metadata[key] = getattr(dcd, key)
+            arc.metadata['title'] = list(dcd.title)
+            for first in xrange(0, len(view), block_size):
+                last = first + block_size
+                arc.write_frames(view[first:last],
+                                xtl=None if xtl is None else xtl[first:last])
+
+
+def archive_to_dcd(fname, dcd_fname):
+    """Expands a trajectory archive into a DCD file, one block at a time, so
+    memory use does not depend on the length of the trajectory. Fixed atoms
+    are not restored, every frame of the DCD file holds every atom.
+    """
+    with open_archive(fname, mode='r') as arc:
+        with open_dcd(dcd_fname, mode='w') as dcd:
+            dcd.dcdtype = 'cord'
+            dcd.npriv = 0
+            dcd.nsavc = 1
+            dcd.nsavv = 0
+            dcd.ndegfree = 0
+            dcd.del_t = 0
+            dcd.charmm_ver = 0
+            for key in ArchiveFile.dcd_fields:
+                if key in arc.metadata:
+                    setattr(dcd, key, arc.metadata[key])
+            dcd.title = arc.metadata.get('title', ['* archive: %s' % fname])
+            dcd.title_lines = len(dcd.title)
+            dcd.nframes = 0
+            dcd.nsteps = 0
+            dcd.nfix = 0
+            dcd.inconsistent = False
+            dcd.validated = False
+            dcd.natoms = arc.natoms
+            if arc.has_xtl:
+                dcd.XTL_PREC = 'd'
+            dcd.write_header()
+            for i in xrange(arc.nblocks):
+                xyz, xtl = arc.read_block(i)
+                dcd.write_frames(xyz, xtl=xtl)
+
+
+class ArchiveFile(FortFile):
+    """This class has no public constructor, please use :func:`open_archive`
+    instead.
+
+    The file is a sequence of little-endian Fortran records, with 8 byte
+    record markers: a header record, a metadata record holding the DCD header
+    as text, one record per block, then the block index and a fixed size
+    trailer pointing at the index. Each block record starts with the number
+    of frames in the block and the width of its integer deltas.
+
+    To write, call :meth:`write_frames` with blocks of any size, frames are
+    buffered and compressed one :attr:`block_size` block at a time. The
+    trailing partial block and the index are written by :meth:`close`.
+    """
+    dcd_fields = ('dcdtype', 'npriv', 'nsavc', 'nsavv', 'ndegfree', 'del_t',
+                'charmm_ver')
+
+    compresslevel = 6
+
+    _head_fmt = '<4sIqdIB'
+    _block_fmt = '<IB'
+
+    def __init__(self, fname, mode='rb', buffering=None):
+        super(ArchiveFile, self).__init__(fname=fname, mode=mode,
+            buffering=buffering, endian='<', rec_head_prec='q')
+        self.natoms = None
+        self.precision = None
+        self.block_size = None
+        self.has_xtl = None
+        self.metadata = {}
+        self.offsets = []
+        self.counts = []
+        self._xyz = None
+        self._xtl = None
+        self._nbuffered = 0
+        self._header_written = False
+        self._cache = (None, None, None)
+
+    # Header and index ########################################################
+    def read_header(self):
+        self.seek(0, 0)
+        rec0 = self.read_record()
+        try:
+            magic, version, natoms, precision, block_size, has_xtl = \
+                struct.unpack(self._head_fmt, rec0)
+        except struct.error:
+            raise IOError("Error when parsing archive header of: %s" %
+                        self.name)
+        if magic != MAGIC:
+            raise IOError("Not a trajectory archive: %s" % self.name)
+        if version > VERSION:
+            raise IOError("Unsupported archive version %d: %s" % (version,
+                        self.name))
+        self.natoms = natoms
+        self.precision = precision
+        self.block_size = block_size
+        self.has_xtl = bool(has_xtl)
+        self.metadata = {}
+        title = []
+        for line in self.read_record().splitlines():
+            key, value = (line.split(' ', 1) + [''])[:2]
+            if key == 'title':
+                title.append(value)
+            else:
+                self.metadata[key] = _parse_value(value)
+        if title:
+            self.metadata['title'] = title
+        self._data_begin = self.tell()
+
+    def read_index(self):
+        """Reads the block index from the end of the file. If it is missing,
+        the file was not closed properly, and the index is rebuilt by walking
+        the block records, a warning is issued.
+        """
+        size = os.path.getsize(self.name)
+        trailer = 2 * self.REC_HEAD_BLEN + 8
+        index = None
+        # unclosed or truncated files end anywhere, so every length and
+        # offset is checked against the file size before it is followed
+        if size >= self._data_begin + trailer:
+            tmp = self._read_bounded(size - trailer, size)
+            if tmp is not None and len(tmp) == 8:
+                offset = struct.unpack('<q', tmp)[0]
+                if self._data_begin <= offset < size - trailer:
+                    index = self._read_bounded(offset, size - trailer)
+        if index is not None and len(index) >= 8:
+            nblocks = struct.unpack('<q', index[:8])[0]
+            if nblocks < 0 or len(index) != 8 + 12 * nblocks:
+                index = None
+        else:
+            index = None
+        if index is None:
+            warnings.warn("No valid block index found, rebuilding the index "
+                        "of: %s" % self.name)
+            self._rebuild_index(size)
+        else:
+            self.offsets = np.frombuffer(index[8:8+8*nblocks], dtype='<i8')
+            self.counts = np.frombuffer(index[8+8*nblocks:], dtype='<i4')
+        self.offsets = np.asarray(self.offsets, dtype=np.int64)
+        self.counts = np.asarray(self.counts, dtype=np.int64)
+
+    def _read_bounded(self, offset, end):
+        """Returns the record at `offset`, or `None` unless it is complete,
+        with matching markers, and ends no later than `end`.
+        """
+        blen = self.REC_HEAD_BLEN
+        if offset < 0 or offset + 2 * blen > end:
+            return None
+        try:
+            self.seek(offset, 0)
+            l = self._read_chk()
+            if l < 0 or offset + 2 * blen + l > end:
+                return None
+            data = self._read_exactly(l)
+            if self._read_chk() != l:
+                return None
+        except (IOError, struct.error):
+            return None
+        return data
+
+    def _rebuild_index(self, size):
+        offsets = []
+        counts = []
+        offset = self._data_begin
+        blen = self.REC_HEAD_BLEN
+        head = struct.calcsize(self._block_fmt)
+        while offset + 2 * blen + head <= size:
+            self.seek(offset, 0)
+            l = self._read_chk()
+            if l < head or offset + 2 * blen + l > size:
+                break
+            k, width = struct.unpack(self._block_fmt, self.read(head))
+            if width not in (1, 2, 4, 8):
+                break
+            self.seek(offset + blen + l, 0)
+            if self._read_chk() != l:
+                break
+            offsets.append(offset)
+            counts.append(k)
+            offset += 2 * blen + l
+        self.offsets = offsets
+        self.counts = counts
+
+    def _write_header(self):
+        rec0 = struct.pack(self._head_fmt, MAGIC, VERSION, self.natoms,
+                        self.precision, self.block_size, int(self.has_xtl))
+        tmp = []
+        for key, value in sorted(self.metadata.iteritems()):
+            if key == 'title':
+                tmp.extend( 'title %s' % line for line in value )
+            else:
+                tmp.append('%s %s' % (key, value))
+        self._write_raw_record(rec0)
+        self._write_raw_record('\n'.join(tmp))
+        self._header_written = True
+
+    def _write_index(self):
+        offset = self.tell()
+        self._write_raw_record(struct.pack('<q', len(self.offsets)) +
+                            np.asarray(self.offsets, dtype='<i8').tostring() +
+                            np.asarray(self.counts, dtype='<i4').tostring())
+        self._write_raw_record(struct.pack('<q', offset))
+
+    def _write_raw_record(self, s):
+        # unlike write_record, this does not sync the file after every record
+        self._write_chk(len(s))
+        self.write(s)
+        self._write_chk(len(s))
+
+    # Reading #################################################################
+    @property
+    def nblocks(self):
+        return len(self.offsets)
+
+    @property
+    def nframes(self):
+        return int(np.sum(self.counts))
+
+    def count_frames(self):
+        """Returns the number of frames stored in the archive."""
+        return self.nframes
+
+    def __len__(self):
+        return self.nframes
+
+    @property
+    def shape(self):
+        return (self.nframes, self.natoms, 3)
+
+    def read_block(self, i):
+        """Decodes block `i`, and returns a (k, natoms, 3) float32
+        :class:`numpy.ndarray` of coordinates and a (k, 6) array of unit cell
+        data, or `None`. The most recently decoded block is cached.
+        """
+        if self._cache[0] == i:
+            return self._cache[1], self._cache[2]
+        self.seek(self.offsets[i], 0)
+        rec = self.read_record()
+        head = struct.calcsize(self._block_fmt)
+        k, width = struct.unpack(self._block_fmt, rec[:head])
+        data = zlib.decompress(rec[head:])
+        if self.has_xtl:
+            xtl = np.frombuffer(data[:48*k], dtype='<f8').reshape(k, 6)
+            data = data[48*k:]
+        else:
+            xtl = None
+        xyz = _decode(data, k, self.natoms, width, self.precision)
+        self._cache = (i, xyz, xtl)
+        return xyz, xtl
+
+    def _gather(self, frames, atoms, out):
+        """Copies the coordinates of `atoms` in the sorted `frames` into
+        `out`, decoding each block once.
+        """
+        first = np.concatenate(([0], np.cumsum(self.counts)))
+        owner = np.searchsorted(first, frames, side='right') - 1
+        for i in np.unique(owner):
+            mask = owner == i
+            xyz = self.read_block(i)[0]
+            out[mask] = xyz[frames[mask] - first[i]][:, atoms]
+        return out
+
+    def iter_block(self, atoms=None, size=64, begin=0, end=None, stride=None,
+                dtype=np.float32):
+        """Creates a generator over blocks of `size` frames, with the same
+        arguments and conventions as :meth:`DCDFile.iter_block` (`end` is
+        inclusive). The returned array is a view of a buffer which is reused
+        for every block.
+        """
+        if stride is not None and stride < 1:
+            raise ValueError("invalid value for stride: %r" % stride)
+        if size < 1:
+            raise ValueError("invalid value for size: %r" % size)
+        stride = stride or 1
+        if end is None or end >= self.nframes:
+            end = self.nframes - 1
+        if begin > end:
+            warnings.warn("begin > end, this will be an empty iterator")
+            return
+        if atoms is None:
+            atoms = slice(None)
+            nsel = self.natoms
+        else:
+            atoms = np.asarray(atoms, dtype=np.intp).ravel()
+            nsel = len(atoms)
+        out = np.empty((size, nsel, 3), dtype=dtype)
+        frames = np.arange(begin, end + 1, stride)
+        for j in xrange(0, len(frames), size):
+            chunk = frames[j:j+size]
+            yield self._gather(chunk, atoms, out[:len(chunk)])
+
+    def __getitem__(self, key):
+        """Random access by frame, `key` is a frame index, a slice or a
+        sequence of frame indices, optionally followed by atom indices.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError("too many indices")
+        frames = np.arange(self.nframes)[key[0]]
+        if len(key) > 1:
+            atoms = np.atleast_1d(np.arange(self.natoms)[key[1]])
+        else:
+            atoms = slice(None)
+        scalar = np.ndim(frames) == 0
+        frames = np.atleast_1d(frames)
+        order = np.argsort(frames, kind='mergesort')
+        nsel = len(np.arange(self.natoms)[atoms])
+        tmp = np.empty((len(frames), nsel, 3), dtype=np.float32)
+        tmp[order] = self._gather(frames[order], atoms,
+                                np.empty_like(tmp))
+        if scalar:
+            return tmp[0]
+        return tmp
+
+    # Writing #################################################################
+    def write_frames(self, xyz, xtl=None):
+        """Appends a block of k frames, `xyz` is a (k, natoms, 3) array-like
+        (a single (natoms, 3) frame is also accepted), `xtl` is an optional
+        (k, 6) array of unit cell data. The number of atoms and the presence
+        of unit cell data are fixed by the first call.
+        """
+        xyz = np.asarray(xyz)
+        if xyz.ndim == 2:
+            xyz = xyz[np.newaxis]
+        if self.natoms is None:
+            self.natoms = xyz.shape[1]
+            self.has_xtl = xtl is not None
+        if xyz.ndim != 3 or xyz.shape[1:] != (self.natoms, 3):
+            raise ValueError("invalid xyz shape: %r, expected (k, %d, 3)" %
+                            (xyz.shape, self.natoms))
+        if self.has_xtl != (xtl is not None):
+            raise ValueError("xtl must be given for every block, or never")
+        if self.has_xtl:
+            xtl = np.asarray(xtl, dtype=np.float64).reshape(len(xyz), 6)
+        if not self._header_written:
+            self._write_header()
+            self._xyz = np.empty((self.block_size, self.natoms, 3),
+                                dtype=np.float64)
+            self._xtl = np.empty((self.block_size, 6), dtype=np.float64)
+        n = 0
+        while n < len(xyz):
+            k = min(len(xyz) - n, self.block_size - self._nbuffered)
+            self._xyz[self._nbuffered:self._nbuffered+k] = xyz[n:n+k]
+            if self.has_xtl:
+                self._xtl[self._nbuffered:self._nbuffered+k] = xtl[n:n+k]
+            self._nbuffered += k
+            n += k
+            if self._nbuffered == self.block_size:
+                self._write_block()
+
+    def _write_block(self):
+        k = self._nbuffered
+        if not k:
+            return
+        data, width = _encode(self._xyz[:k], self.precision)
+        if self.has_xtl:
+            data = self._xtl[:k].astype('<f8').tostring() + data
+        self.offsets.append(self.tell())
+        self.counts.append(k)
+        self._write_raw_record(struct.pack(self._block_fmt, k, width) +
+                            zlib.compress(data, self.compresslevel))
+        self._nbuffered = 0
+
+    def close(self):
+        if 'w' in self.mode and not self.closed:
+            if not self._header_written:
+                self.natoms = self.natoms or 0
+                self.has_xtl = bool(self.has_xtl)
+                self._write_header()
+            self._write_block()
+            self._write_index()
+        super(ArchiveFile, self).close()
+
+
+def _encode(xyz, precision):
+    """Quantizes a (k, natoms, 3) block of coordinates and returns the byte
+    shuffled, zigzag coded deltas, along with their width in bytes.
+    """
+    q = np.rint(np.asarray(xyz, dtype=np.float64) / precision)
+    q = q.astype(np.int64).transpose(2, 0, 1)
+    d = q.copy()
+    d[:, 1:] -= q[:, :-1]
+    d[:, 0, 1:] -= q[:, 0, :-1]
+    z = ((d << 1) ^ (d >> 63)).view(np.uint64)
+    top = int(z.max()) if z.size else 0
+    for width in (1, 2, 4, 8):
+        if top < 256 ** width:
+            break
+    z = z.astype('<u%d' % width)
+    return z.view(np.uint8).reshape(-1, width).T.tostring(), width
+
+
+def _decode(data, k, natoms, width, precision):
+    """The inverse of :func:`_encode`, returns a (k, natoms, 3) float32
+    :class:`numpy.ndarray`.
+    """
+    z = np.frombuffer(data, dtype=np.uint8).reshape(width, -1).T
+    z = np.ascontiguousarray(z).view('<u%d' % width).ravel()
+    z = z.astype(np.uint64)
+    d = (z >> np.uint64(1)).astype(np.int64) ^ -(z & np.uint64(1)).astype(
+        np.int64)
+    d = d.reshape(3, k, natoms)
+    np.cumsum(d[:, 0], axis=1, out=d[:, 0])
+    np.cumsum(d, axis=1, out=d)
+    tmp = np.empty((k, natoms, 3), dtype=np.float32)
+    tmp[:] = d.transpose(1, 2, 0) * precision
+    return tmp
+
+
+def _parse_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    if value in ('True', 'False'):
+        return value == 'True'
+    return value
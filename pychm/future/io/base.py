@@ -3,7 +3,7 @@
 
 from __future__ import division
 __author__ = ("Frank C. Pickard <frank.pickard@nih.gov>")
-__all__ = ["open_fort"]
+__all__ = ["open_fort", "probe_fort"]
 
 from io import DEFAULT_BUFFER_SIZE
 import os
@@ -30,7 +30,40 @@ def get_buffer_size(arg=None):
         return arg
 
 
-def open_fort(fname, mode='r', buffering=None):
+def probe_fort(fname):
+    """Inspects the first record of an existing fortran binary file, and
+    returns an (endian, rec_head_prec) tuple describing its byte order and
+    record marker width, for example ('>', 'i') for a file written on a big-
+    endian machine with 4 byte record markers. A record is accepted when its
+    leading and trailing markers agree and it fits within the file. An
+    :exec:`IOError` is raised if no combination matches.
+
+    The native byte order is tried first, and 4 byte markers before 8 byte
+    markers.
+    """
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as fp:
+        head = fp.read(8)
+        native = struct.pack('=i', 1) == struct.pack('<i', 1) and '<' or '>'
+        for endian in (native, native == '<' and '>' or '<'):
+            for prec in ('i', 'q'):
+                blen = struct.calcsize('<' + prec)
+                if len(head) < blen:
+                    continue
+                l = struct.unpack(endian + prec, head[:blen])[0]
+                if l < 0 or 2 * blen + l > size:
+                    continue
+                fp.seek(blen + l, 0)
+                tail = fp.read(blen)
+                if len(tail) == blen and \
+                        struct.unpack(endian + prec, tail)[0] == l:
+                    return endian, prec
+    raise IOError("Unable to determine the byte order and record marker "
+                "width of: %s" % fname)
+
+
+def open_fort(fname, mode='r', buffering=None, endian=None,
+            rec_head_prec=None):
     """The public function responsible for mediating access to the Fort file-
     like objects. Opens a file and returns a stream. If the file cannot be
     opened, an IOError is raised.
@@ -56,6 +89,12 @@ def open_fort(fname, mode='r', buffering=None):
         switches buffering off. Passing negative values, or 1 sets buffer
         to default size. Passing any other positive integer sets the buffer
         size in bytes.
+    endian: an optional byte order specifier, '<', '>' or '@'.
+    rec_head_prec: an optional record marker precision, 'i' or 'q'.
+
+    When a non-empty existing file is opened, the byte order and record
+    marker width that are not specified are detected with :func:`probe_fort`,
+    new files default to the native byte order and 4 byte record markers.
     """
     if not isinstance(fname, basestring):
         raise TypeError("Invalid fname: %r" % fname)
@@ -77,13 +116,32 @@ def open_fort(fname, mode='r', buffering=None):
         raise ValueError("must have exactly one read/write/append mode")
     if "x" in modes and os.path.isfile(fname):
         raise ValueError("you may not set `mode=x` for existing files")
+    endian, rec_head_prec = _fort_format(fname, writing, endian,
+                                        rec_head_prec)
     # instantiate!
     return FortFile(fname=fname, mode=
                     (reading and "r" or "") +
                     (writing and "w" or "") +
                     (appending and "a" or "") +
                     (updating and "+" or ""),
-                    buffering=buffering)
+                    buffering=buffering, endian=endian,
+                    rec_head_prec=rec_head_prec)
+
+
+def _fort_format(fname, writing, endian, rec_head_prec):
+    """Fills in the byte order and record marker width of a file that is
+    about to be opened, probing existing files when they are not specified.
+    """
+    if None in (endian, rec_head_prec):
+        if not writing and os.path.isfile(fname) and os.path.getsize(fname):
+            probed = probe_fort(fname)
+        else:
+            probed = ('@', 'i')
+        if endian is None:
+            endian = probed[0]
+        if rec_head_prec is None:
+            rec_head_prec = probed[1]
+    return endian, rec_head_prec
 
 
 class File(object):
@@ -334,9 +392,7 @@ class FortFile(BinFile):
         if prec not in 'fdhilq':
             raise ValueError("Invalid precision specified: %r" % prec)
         data = self.read_record()
-        num = len(data) / self._byte_dict[prec]
-        return np.array(struct.unpack("%s%d%s" % (self.ENDIAN, num, prec), data),
-                        dtype=np.dtype(prec))
+        return np.frombuffer(data, dtype=self.ENDIAN + prec).astype(prec)
 
     def read_reals(self, prec='f'):
         """Read a fortran record, decoded as an array of floats with single
@@ -368,10 +424,10 @@ class FortFile(BinFile):
         """
         if prec not in 'fdhilq':
             raise ValueError("Invalid precision specified: %r" % prec)
-        l = len(arraylike) * self._byte_dict[prec]
-        self._write_chk(l)
-        self.write(struct.pack("%s%d%s" % (self.ENDIAN, l, prec), *arraylike))
-        self._write_chk(l)
+        data = np.asarray(arraylike, dtype=self.ENDIAN + prec).tostring()
+        self._write_chk(len(data))
+        self.write(data)
+        self._write_chk(len(data))
 
     def write_reals(self, arraylike, prec='f'):
         """Write a fortran record, encoded as an array of floats with single
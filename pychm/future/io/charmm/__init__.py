@@ -4,11 +4,15 @@ COMMENT_CHAR = '!'
 CONTINUE_CHAR = '-'
 
 import pychm.future.io.charmm.base
+import pychm.future.io.charmm.crd
 import pychm.future.io.charmm.dcd
 import pychm.future.io.charmm.prm
+import pychm.future.io.charmm.psf
 import pychm.future.io.charmm.rtf
 import pychm.future.io.charmm.readwrite
 
+from pychm.future.io.charmm.crd import *
 from pychm.future.io.charmm.dcd import *
 from pychm.future.io.charmm.prm import *
+from pychm.future.io.charmm.psf import *
 from pychm.future.io.charmm.rtf import *
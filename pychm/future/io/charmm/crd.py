@@ -0,0 +1,279 @@
+"""This module contains the CHARMM coordinate file (CRD) reader and writer.
+
+Both the standard `shortcard` layout and the EXTended `longcard` layout are
+supported. The extended layout is required for systems of more than 99,999
+atoms, or for atom, residue or segment names longer than four characters, and
+is selected automatically when writing.
+
+Files are streamed in blocks of :attr:`CRDFile.chunk_size` records, each block
+is decoded as a fixed-width character array, so coordinates are read straight
+into a (natoms, 3) :class:`numpy.ndarray` without building per atom objects.
+When only the coordinates are needed, for example when swapping a series of
+structures into a topology that is already loaded, the metadata columns can
+be skipped entirely.
+
+>>> crd = open_crd('system.crd')
+>>> crd.xyz.shape
+(1000000, 3)
+>>> xyz = open_crd('frame_0042.crd', xyz_only=True, natoms=psf.natoms).xyz
+"""
+
+from __future__ import division
+
+__all__ = ["open_crd"]
+
+import os
+
+import numpy as np
+
+from pychm.future.io.charmm.base import CharmmCard
+
+
+def open_crd(fname, mode='r', buffering=None, xyz_only=False, natoms=None):
+    """The public function responsible for mediating access to CRD file-
+    like objects. Opens a file and returns a stream. If the file cannot be
+    opened, an :exec:`IOError` is raised. If the file is opened for reading,
+    it is parsed immediately.
+
+    Parameters
+    ----------
+    fname: a string representing the path to a CHARMM CRD file
+    mode: an optional string that specifies the mode in which the file is
+    opened. It defaults to 'r' which means open for reading. Other values
+    are shown in the table below:
+    ========= =================================================================
+    Character Meaning
+    --------- -----------------------------------------------------------------
+    'r'       open for reading (default)
+    'w'       open for writing, truncating the file first
+    'x'       open for writing, noclobber, raises a value error if file exists
+    ========= =================================================================
+    buffering: an optional integer used to set the buffering policy. Passing 0
+    switches buffering off. Passing negative values, or 1 sets buffer to
+    default size. Passing any other positive integer sets the buffer size in
+    bytes.
+    xyz_only: when reading, only decode the coordinate columns.
+    natoms: when reading, raise an :exec:`IOError` unless the file contains
+    exactly this many atoms.
+    """
+    if not isinstance(fname, basestring):
+        raise TypeError("Invalid fname: %r" % fname)
+    if not isinstance(mode, basestring):
+        raise TypeError("Invalid mode: %r" % mode)
+    if buffering is not None and not isinstance(buffering, int):
+        raise TypeError("Invalid buffering: %r" % buffering)
+    # parse modes
+    modes = set(mode)
+    if modes - set("rwx") or len(mode) > len(modes):
+        raise ValueError("invalid mode: %r" % mode)
+    reading = "r" in modes
+    writing = "w" in modes or "x" in modes
+    if reading + writing != 1:
+        raise ValueError("must have exactly one read/write mode")
+    if "x" in modes and os.path.isfile(fname):
+        raise ValueError("you may not set `mode=x` for existing files")
+    # instantiate!
+    tmp = CRDFile(fname, mode=(reading and "r" or "w"), buffering=buffering)
+    if reading:
+        if xyz_only:
+            tmp.parse_xyz()
+        else:
+            tmp.parse()
+        if natoms is not None and tmp.natoms != natoms:
+            raise IOError("Expected %d atoms, but %s contains %d" %
+                        (natoms, fname, tmp.natoms))
+    return tmp
+
+
+class CRDFile(CharmmCard):
+    """This class has no public constructor, please use :func:`open_crd`
+    instead.
+
+    After parsing, the per atom metadata is stored in the structured array
+    :attr:`atom` (see :attr:`atom_dt`) and the coordinates are stored in the
+    (natoms, 3) array :attr:`xyz`. To write a file, set :attr:`xyz` and
+    optionally :attr:`atom` and :attr:`title`, then call :meth:`write_all`.
+    """
+    atom_dt = np.dtype([
+        ('atomNum', np.int64),
+        ('resIndex', np.int64),
+        ('resName', 'S8'),
+        ('atomType', 'S8'),
+        ('segid', 'S8'),
+        ('resid', 'S8'),
+        ('weight', np.float64)
+        ])
+
+    # field name: (shortcard columns, longcard columns)
+    _columns = {
+        'atomNum': ((0, 5), (0, 10)),
+        'resIndex': ((5, 10), (10, 20)),
+        'resName': ((11, 15), (22, 30)),
+        'atomType': ((16, 20), (32, 40)),
+        'x': ((20, 30), (40, 60)),
+        'y': ((30, 40), (60, 80)),
+        'z': ((40, 50), (80, 100)),
+        'segid': ((51, 55), (102, 110)),
+        'resid': ((56, 60), (112, 120)),
+        'weight': ((60, 70), (120, 140))
+        }
+
+    _formats = (
+        '%5d%5d %-4s %-4s%10.5f%10.5f%10.5f %-4s %-4s%10.5f',
+        '%10d%10d  %-8s  %-8s%20.10f%20.10f%20.10f  %-8s  %-8s%20.10f'
+        )
+
+    chunk_size = 65536
+
+    def __init__(self, fname, mode='r', buffering=None):
+        super(CRDFile, self).__init__(fname=fname, mode=mode,
+                                    buffering=buffering)
+        self.ext = None
+        self.natoms = None
+        self.atom = None
+        self.xyz = None
+
+    # Parsing #################################################################
+    def parse(self):
+        """Streams the entire file, decoding both the atom metadata and the
+        coordinates.
+        """
+        self._parse(xyz_only=False)
+
+    def parse_xyz(self):
+        """Streams the entire file, decoding only the coordinates. This is the
+        fast path for loading structures into an existing topology.
+        """
+        self._parse(xyz_only=True)
+
+    def _parse(self, xyz_only):
+        self.seek(0, 0)
+        self._parse_header()
+        layout = int(self.ext)
+        width = self._columns['weight'][layout][1]
+        self.xyz = np.empty((self.natoms, 3), dtype=np.float64)
+        if xyz_only:
+            self.atom = None
+        else:
+            self.atom = np.zeros(self.natoms, dtype=self.atom_dt)
+        n = 0
+        while n < self.natoms:
+            size = min(self.chunk_size, self.natoms - n)
+            chunk = []
+            for i in xrange(size):
+                line = self.fp.readline()
+                if not line:
+                    raise IOError("Expected %d atoms, but %s ended after %d" %
+                                (self.natoms, self.name, n + i))
+                chunk.append(line)
+            chars = self._chunk_to_chars(chunk, width)
+            for i, key in enumerate('xyz'):
+                self.xyz[n:n+size, i] = self._numeric(chars, key, layout,
+                                                    np.float64)
+            if not xyz_only:
+                atom = self.atom[n:n+size]
+                for key in ('atomNum', 'resIndex'):
+                    atom[key] = self._numeric(chars, key, layout, np.int64)
+                for key in ('resName', 'atomType', 'segid', 'resid'):
+                    atom[key] = self._string(chars, key, layout)
+                atom['weight'] = self._numeric(chars, 'weight', layout,
+                                            np.float64)
+            n += size
+
+    def _parse_header(self):
+        self.title = []
+        while 1:
+            line = self.fp.readline()
+            if not line:
+                raise IOError("Error when parsing crd header, no atom count "
+                            "found in: %s" % self.name)
+            line = line.strip()
+            if line.startswith('*'):
+                self.title.append(line[1:].strip().lower())
+            elif line:
+                break
+        self.title = [ tl for tl in self.title if tl ]
+        tmp = line.lower().split()
+        try:
+            self.natoms = int(tmp[0])
+        except ValueError:
+            raise IOError("Error when parsing crd atom count: %r" % line)
+        self.ext = 'ext' in tmp[1:]
+
+    @staticmethod
+    def _chunk_to_chars(chunk, width):
+        """Returns a block of records as a (n, width) character array. Records
+        which are not exactly `width` characters long are padded or clipped.
+        """
+        tmp = ''.join(chunk)
+        if len(tmp) == len(chunk) * (width + 1):
+            chars = np.frombuffer(tmp, dtype='S1').reshape(len(chunk), width + 1)
+            if (chars[:, -1] == '\n').all():
+                return chars[:, :-1]
+        tmp = ''.join( line.rstrip('\r\n').ljust(width)[:width] for line in chunk )
+        return np.frombuffer(tmp, dtype='S1').reshape(len(chunk), width)
+
+    def _numeric(self, chars, key, layout, dtype):
+        begin, end = self._columns[key][layout]
+        field = np.empty((len(chars), end - begin + 1), dtype='S1')
+        field[:, :-1] = chars[:, begin:end]
+        field[:, -1] = ' '
+        tmp = np.fromstring(field.tostring(), dtype=dtype, sep=' ')
+        if len(tmp) != len(chars):
+            raise IOError("Error when parsing crd, missing or malformed %s "
+                        "field in: %s" % (key, self.name))
+        return tmp
+
+    def _string(self, chars, key, layout):
+        begin, end = self._columns[key][layout]
+        field = np.ascontiguousarray(chars[:, begin:end])
+        field = field.view('S%d' % (end - begin)).ravel()
+        return np.char.lower(np.char.strip(field))
+
+    # Writing #################################################################
+    def write_all(self):
+        """Streams :attr:`xyz` and :attr:`atom` to disk, in blocks of
+        :attr:`chunk_size` records. If no atom metadata is present, generic
+        values are written in its place.
+        """
+        if self.xyz is None:
+            raise ValueError("No coordinate data to write")
+        xyz = np.asarray(self.xyz, dtype=np.float64).reshape(-1, 3)
+        self.natoms = len(xyz)
+        atom = self.atom
+        if atom is None:
+            atom = np.zeros(self.natoms, dtype=self.atom_dt)
+            atom['atomNum'] = np.arange(1, self.natoms + 1)
+            atom['resIndex'] = atom['atomNum']
+            atom['resName'] = 'unk'
+            atom['atomType'] = 'x'
+            atom['segid'] = 'a'
+            atom['resid'] = atom['atomNum'].astype('S8')
+        elif len(atom) != self.natoms:
+            raise ValueError("atom and xyz have different lengths: %d, %d" %
+                            (len(atom), self.natoms))
+        if self.ext is None or not self.ext:
+            self.ext = self.natoms > 99999 or self._long_names(atom)
+        fmt = self._formats[int(self.ext)]
+        self.write(self.pack_title())
+        self.write('\n')
+        if self.ext:
+            self.write('%10d  EXT\n' % self.natoms)
+        else:
+            self.write('%5d\n' % self.natoms)
+        for n in xrange(0, self.natoms, self.chunk_size):
+            a = atom[n:n+self.chunk_size]
+            x = xyz[n:n+self.chunk_size]
+            columns = (a['atomNum'], a['resIndex'], np.char.upper(a['resName']),
+                    np.char.upper(a['atomType']), x[:, 0], x[:, 1], x[:, 2],
+                    np.char.upper(a['segid']), np.char.upper(a['resid']),
+                    a['weight'])
+            columns = [ c.tolist() for c in columns ]
+            self.write(''.join( fmt % row + '\n' for row in zip(*columns) ))
+
+    @staticmethod
+    def _long_names(atom):
+        for key in ('resName', 'atomType', 'segid', 'resid'):
+            if len(atom) and np.char.str_len(atom[key]).max() > 4:
+                return True
+        return False
@@ -4,29 +4,32 @@ Documentation mostly done!
 
 :TODO:
     :meth:`DCDFile.info` -- new method to pretty print header information
-    :meth:`write_nparray` -- test, add error checking, right now it blindly
-    writes
 """
 
 from __future__ import division
 
 __author__ = ("Frank C. Pickard <frank.pickard@nih.gov>")
-__all__ = ["open_dcd"]
+__all__ = ["open_dcd", "open_dcd_series"]
 
 from array import array
 from collections import deque
 import os
+import Queue
 import struct
+import sys
+import threading
+import time
 import warnings
 
 import numpy as np
 
-from pychm.future.io.base import FortFile
+from pychm.future.io.base import FortFile, _fort_format
 from pychm.future.io.charmm.base import CharmmBin
 from pychm.future.tools import rwprop
 
 
-def open_dcd(fname, mode='r', buffering=None):
+def open_dcd(fname, mode='r', buffering=None, endian=None,
+            rec_head_prec=None, validate=False):
     """The public function responsible for mediating access to DCD file- like
     objects. Opens a file and returns a stream. If the file cannot be opened,
     an :exec:`IOError` is raised.
@@ -52,6 +55,15 @@ def open_dcd(fname, mode='r', buffering=None):
     switches buffering off. Passing negative values, or 1 sets buffer to
     default size. Passing any other positive integer sets the buffer size in
     bytes.
+    endian: an optional byte order specifier, '<', '>' or '@'.
+    rec_head_prec: an optional record marker precision, 'i' or 'q'.
+    validate: when reading, check the file for a truncated or corrupt tail
+    with :meth:`DCDFile.scan` and warn if one is found.
+
+    The byte order and record marker width of existing files are detected
+    from the first record, unless they are specified. Frames are decoded
+    with the detected byte order, one vectorized conversion per block, so
+    big-endian trajectories read as fast as native ones.
     """
     if not isinstance(fname, basestring):
         raise TypeError("Invalid fname: %r" % fname)
@@ -73,22 +85,51 @@ def open_dcd(fname, mode='r', buffering=None):
         raise ValueError("must have exactly one read/write/append mode")
     if "x" in modes and os.path.isfile(fname):
         raise ValueError("you may not set `mode=x` for existing files")
+    endian, rec_head_prec = _fort_format(fname, writing, endian,
+                                        rec_head_prec)
     # instantiate!
     tmp = DCDFile(fname, mode=
                 (reading and "r" or "") +
                 (writing and "w" or "") +
                 (appending and "a" or "") +
                 (updating and "+" or ""),
-                buffering=buffering)
+                buffering=buffering, endian=endian,
+                rec_head_prec=rec_head_prec)
     if reading or appending:
         tmp.read_header()
         tmp.seek_frame(0, whence=0)
+        if validate:
+            scan = tmp.scan()
+            if not scan.ok:
+                warnings.warn("%r" % scan)
     return tmp
 
 
+def open_dcd_series(fnames, max_open=32):
+    """Opens an ordered sequence of DCD files, such as the segments of a
+    restarted production run or the per replica output of a REX run, as a
+    single read-only :class:`DCDSeries`. Only the headers are read, so
+    opening hundreds of segments is nearly instantaneous. A :exec:`ValueError`
+    is raised if the headers are not compatible.
+
+    Parameters
+    ----------
+    fnames: a sequence of strings representing paths to CHARMM DCD files
+    max_open: the maximum number of files kept memory mapped at once
+    """
+    if isinstance(fnames, basestring):
+        fnames = [fnames]
+    fnames = list(fnames)
+    if not fnames:
+        raise ValueError("must specify input dcd files")
+    return DCDSeries(fnames, max_open=max_open)
+
+
 class DCDFile(CharmmBin):
     """This class has no public constructor, please use :func:`open_dcd`
     instead."""
+    INDEX_EXT = '.idx'
+
     def __init__(self, fname, mode='rb', buffering=None, endian='@',
                 rec_head_prec='i', c_array_prec='i', xyz_prec='f',
                 xtl_prec=None, d4_prec=None, q_prec=None):
@@ -118,12 +159,19 @@ class DCDFile(CharmmBin):
         self.title_lines = None
         self.title = None
         self.natoms = None
+        self.free_atoms = None
         self.header_size = None
         # build frame data structure
         self._frame_dt = None
         self._frame_size = None
+        self._frame0_dt = None
+        self._frame0_size = None
+        self._fixed_xyz = None
+        self._free_index = None
         # etc
         self._leftovers = []
+        self._coalesce_bytes = 4 * 1024 * 1024
+        self._dirty = False
 
     # Header reading, writing , importing, exporting ##########################
     def read_header(self):
@@ -132,9 +180,13 @@ class DCDFile(CharmmBin):
             rec0 = fp.read_record()
             rec1 = fp.read_record()
             rec2 = fp.read_record()
+            c_array = self._c_array(rec0[4:])
+            if c_array[8] > 0:
+                rec3 = fp.read_record()
+            else:
+                rec3 = None
         # read rec0
         self.dcdtype = ''.join(struct.unpack('cccc', rec0[:4])).lower()
-        c_array = array(self.C_ARRAY_PREC, rec0[4:])
         self.nframes = c_array[0]
         self.npriv = c_array[1]
         self.nsavc = c_array[2]
@@ -142,7 +194,7 @@ class DCDFile(CharmmBin):
         self.nsavv = c_array[4]
         self.ndegfree = c_array[7]
         self.nfix = c_array[8]
-        self.del_t = c_array[9]
+        self.del_t = self._c_float(c_array[9])
         if c_array[10] == 1:
             self._xtl_prec = 'd'
         if c_array[11] == 1:
@@ -153,7 +205,7 @@ class DCDFile(CharmmBin):
         self.validated = c_array[18] == 1
         self.charmm_ver = c_array[19]
         # read rec1
-        self.title_lines = struct.unpack('i', rec1[:4])[0]
+        self.title_lines = struct.unpack(self.ENDIAN + 'i', rec1[:4])[0]
         self.title = []
         title_deque = deque(array('c', rec1[4:]))
         for n_line in range(self.title_lines):
@@ -166,29 +218,63 @@ class DCDFile(CharmmBin):
             self.title.append(''.join(tmp))
         # read rec2
         if len(rec2) == self.C_ARRAY_BLEN:
-            self.natoms = struct.unpack(self.C_ARRAY_PREC, rec2)[0]
+            self.natoms = struct.unpack(self.ENDIAN + self.C_ARRAY_PREC,
+                                        rec2)[0]
         else:
             raise IOError("Error when parsing natoms record of dcd header")
+        # read rec3, the free atom indices when there are fixed atoms
+        if rec3 is None:
+            self.free_atoms = None
+        else:
+            self.free_atoms = np.frombuffer(rec3, dtype='%s%s' % (self.ENDIAN,
+                                            self.C_ARRAY_PREC)) - 1
+            if len(self.free_atoms) != self.natoms - self.nfix:
+                raise IOError("Error when parsing free atom record of dcd "
+                            "header, expected %d atoms, found %d" %
+                            (self.natoms - self.nfix, len(self.free_atoms)))
+            self.free_atoms = self.free_atoms.astype(np.intp)
         # check first four chars in rec0 for gibberish
         if self.dcdtype not in ['cord', 'veld']:
             warnings.warn("unexpected dcdtype: %s" %self.dcdtype)
         # calc header_size
-        self.header_size = len(rec0) + len(rec1) + len(rec2) + 24
-        # compile frame info
-        self._frame_dt = self.compile_npdt()
+        self.header_size = len(rec0) + len(rec1) + len(rec2) + \
+                        6 * self.REC_HEAD_BLEN
+        if rec3 is not None:
+            self.header_size += len(rec3) + 2 * self.REC_HEAD_BLEN
+        # compile frame info, with fixed atoms only the first frame is full
+        self._frame0_dt = self.compile_npdt()
+        self._frame0_size = self._frame0_dt.itemsize
+        if self.nfix > 0:
+            self._frame_dt = self.compile_npdt(self.natoms - self.nfix)
+        else:
+            self._frame_dt = self._frame0_dt
         self._frame_size = self._frame_dt.itemsize
+        self._fixed_xyz = None
+        self._free_index = None
 
     def write_header(self):
         """The class' current values for attributes defined by a CHARMM DCD
         header are read from the class, mapped to a binary format, and written
         to disk.
         """
-        # length of header less the title
-        hlen_minus_title = 6 * self.REC_HEAD_BLEN + 4 + 21 * self.C_ARRAY_BLEN
-        if '+' in self.mode:
-            # TODO if len(self.title) is too long, truncate it
-            # TODO if len(self.title) is too short, pad with whitespace
-            return
+        # length of header less the title: dcdtype, title count, control
+        # array and natoms
+        hlen_minus_title = 6 * self.REC_HEAD_BLEN + 8 + 21 * self.C_ARRAY_BLEN
+        if self.nfix > 0:
+            if self.free_atoms is None or \
+                    len(self.free_atoms) != self.natoms - self.nfix:
+                raise ValueError("free_atoms must list the natoms - nfix "
+                                "free atom indices")
+            hlen_minus_title += 2 * self.REC_HEAD_BLEN + \
+                                len(self.free_atoms) * self.C_ARRAY_BLEN
+        if self.header_size is not None and \
+                os.fstat(self.fileno()).st_size > self.header_size:
+            # frames follow the header, so its size must not change
+            hlen = hlen_minus_title + 80 * self.title_lines
+            if hlen != self.header_size:
+                raise IOError("Can not resize the header of a dcd file which "
+                            "contains frames, title must have %d lines" %
+                            ((self.header_size - hlen_minus_title) // 80))
         # build rec0
         rec0 = list(self.dcdtype[:4].upper())
         rec0.append(int(self.nframes))      # c_array 1
@@ -200,7 +286,7 @@ class DCDFile(CharmmBin):
         rec0.append(0)
         rec0.append(int(self.ndegfree))
         rec0.append(int(self.nfix))
-        rec0.append(int(self.del_t))        # c_array 10
+        rec0.append(self._c_bits(self.del_t))   # c_array 10
         rec0.append(int(self.has_xtl))
         rec0.append(int(self.has_d4))
         rec0.append(int(self.has_q))
@@ -211,11 +297,11 @@ class DCDFile(CharmmBin):
         rec0.append(0)
         rec0.append(int(self.validated))
         rec0.append(int(self.charmm_ver))   # c_array 20
-        rec0_formatting = '4c 20%s' % self.C_ARRAY_PREC
+        rec0_formatting = '%s4c 20%s' % (self.ENDIAN, self.C_ARRAY_PREC)
         rec0 = struct.pack(rec0_formatting, *rec0)
         # build rec1
         rec1 = []
-        rec1.append(struct.pack('i', self.title_lines))
+        rec1.append(struct.pack(self.ENDIAN + 'i', self.title_lines))
         for n_line in range(self.title_lines):
             rec1.append("%-80s" % self.title[n_line][:80])
         rec1 = ''.join(rec1)
@@ -223,16 +309,39 @@ class DCDFile(CharmmBin):
         rec1 = struct.pack(rec1_formatting, *rec1)
         # build rec2
         rec2 = int(self.natoms)
-        rec2_formatting = self.C_ARRAY_PREC
+        rec2_formatting = self.ENDIAN + self.C_ARRAY_PREC
         rec2 = struct.pack(rec2_formatting, rec2)
+        # build rec3
+        if self.nfix > 0:
+            rec3 = (np.asarray(self.free_atoms) + 1).astype('%s%s' %
+                    (self.ENDIAN, self.C_ARRAY_PREC)).tostring()
         # write
         self.fp.seek(0, 0)
         self.write_record(rec0)
         self.write_record(rec1)
         self.write_record(rec2)
+        if self.nfix > 0:
+            self.write_record(rec3)
         # verify and set frame vars
         self.read_header()
 
+    def _c_array(self, data):
+        """Decodes the integer control array of the first header record."""
+        return np.frombuffer(data, dtype='%s%s' % (self.ENDIAN,
+                            self.C_ARRAY_PREC)).tolist()
+
+    def _c_float(self, value):
+        """Reinterprets an integer control array entry as the real value
+        CHARMM stores in that slot, such as the timestep in AKMA units.
+        """
+        fmt = self.C_ARRAY_BLEN == 8 and 'd' or 'f'
+        return float(np.array(value, dtype=self.C_ARRAY_PREC).view(fmt))
+
+    def _c_bits(self, value):
+        """The inverse of :meth:`_c_float`."""
+        fmt = self.C_ARRAY_BLEN == 8 and 'd' or 'f'
+        return int(np.array(value, dtype=fmt).view(self.C_ARRAY_PREC))
+
     def import_header(self, arg):
         tmp = self.export_header()
         try:
@@ -265,6 +374,7 @@ class DCDFile(CharmmBin):
             'title_lines': self.title_lines,
             'title': self.title,
             'natoms': self.natoms,
+            'free_atoms': self.free_atoms,
             'header_size': self.header_size
             }
         return tmp
@@ -315,7 +425,8 @@ class DCDFile(CharmmBin):
         """Creates a generator over the frames of the DCDFile. Uses the
         (hopefully) familiar start:stop:stride syntax of :class:`slice`s.  This
         generator returns a :class:`numpy.ndarray` object representing one MD
-        frame.
+        frame. With fixed atoms, only the first frame holds every atom, see
+        :meth:`read_nparray`.
         """
         if end is not None and not isinstance(end, int):
             raise TypeError("invalid type for end: %r" % end)
@@ -329,13 +440,13 @@ class DCDFile(CharmmBin):
             if stride is None:
                 try:
                     while 1:
-                        yield np.fromfile(self.fp, dtype=self.frame_dt, count=1)
+                        yield self._next_nparray()
                 except MemoryError:
                     raise StopIteration
             else:
                 try:
                     while 1:
-                        yield np.fromfile(self.fp, dtype=self.frame_dt, count=1)
+                        yield self._next_nparray()
                         self.seek_frame(stride-1, whence=1)
                 except MemoryError:
                     raise StopIteration
@@ -347,7 +458,7 @@ class DCDFile(CharmmBin):
                     while 1:
                         if begin > end:
                             raise StopIteration
-                        yield np.fromfile(self.fp, dtype=self.frame_dt, count=1)
+                        yield self._next_nparray()
                         begin += 1
                 except MemoryError:
                     raise StopIteration
@@ -356,12 +467,147 @@ class DCDFile(CharmmBin):
                     while 1:
                         if begin > end:
                             raise StopIteration
-                        yield np.fromfile(self.fp, dtype=self.frame_dt, count=1)
+                        yield self._next_nparray()
                         self.seek_frame(stride-1, whence=1)
                         begin += stride
                 except MemoryError:
                     raise StopIteration
 
+    def iter_block(self, atoms=None, size=64, begin=0, end=None, stride=None,
+                dtype=np.float32):
+        """Creates a generator over blocks of `size` frames, using the same
+        begin/end/stride conventions as :meth:`iter_nparray` (`end` is
+        inclusive). Each block is returned as a C-contiguous (k, nsel, 3)
+        :class:`numpy.ndarray` of `dtype`, where `nsel` is the number of atom
+        indices in `atoms` (default, all atoms) and k <= `size` frames.
+
+        The frames of a block are read from disk with a single read, when the
+        stride between them is small enough to make this worthwhile, and the
+        returned array is a view of a buffer which is reused for every block.
+        Copy the block if you need to keep it past the next iteration.
+
+        >>> for block in dcd.iter_block(atoms=ca_index, size=256):
+        ...     rg.extend(radius_of_gyration(block))
+        """
+        return self._iter_block(atoms, size, begin, end, stride, dtype)
+
+    def _iter_block(self, atoms, size, begin, end, stride, dtype,
+                    buffers=None):
+        """The body of :meth:`iter_block`, if an iterator of (size, nsel, 3)
+        `buffers` is given, each block is read into the next buffer instead of
+        a single reused one.
+        """
+        if end is not None and not isinstance(end, (int, long)):
+            raise TypeError("invalid type for end: %r" % end)
+        if stride is not None and not isinstance(stride, (int, long)):
+            raise TypeError("invalid type for stride: %r" % stride)
+        if stride is not None and stride < 1:
+            raise ValueError("invalid value for stride: %r" % stride)
+        if size < 1:
+            raise ValueError("invalid value for size: %r" % size)
+        stride = stride or 1
+        nframes = self.count_frames()
+        if end is None or end >= nframes:
+            end = nframes - 1
+        if begin > end:
+            warnings.warn("begin > end, this will be an empty iterator")
+            return
+        if atoms is None and not self.nfix:
+            atoms = slice(None)
+            nsel = self.natoms
+        else:
+            if atoms is None:
+                atoms = np.arange(self.natoms)
+            atoms = np.asarray(atoms, dtype=np.intp).ravel()
+            nsel = len(atoms)
+        if buffers is None:
+            out = np.empty((size, nsel, 3), dtype=dtype)
+        # coalesce the reads of strided frames, with each read spanning at
+        # most _coalesce_bytes, so large gaps fall back to one frame per read
+        per = (self._coalesce_bytes // self.frame_size - 1) // stride + 1
+        per = min(max(per, 1), size)
+        raw = np.empty((per - 1) * stride + 1, dtype=self.frame_dt)
+        for first in xrange(begin, end + 1, size * stride):
+            n = min(size, (end - first) // stride + 1)
+            if buffers is not None:
+                out = next(buffers)
+            j0 = 0
+            if first == 0 and self.nfix:
+                # the full first frame has a different layout, it is cached
+                out[0] = self.fixed_xyz[atoms]
+                j0 = 1
+            for j in xrange(j0, n, per):
+                m = min(per, n - j)
+                span = (m - 1) * stride + 1
+                self.seek_frame(first + j * stride, whence=0)
+                self._readinto_exactly(raw[:span])
+                self._unpack_xyz(raw[:span:stride], atoms, out[j:j+m])
+            yield out[:n]
+
+    def _unpack_xyz(self, block, atoms, out):
+        """Copies the coordinates of `atoms` from a block of :attr:`frame_dt`
+        records into `out`. With fixed atoms, the records only hold the free
+        atoms and the fixed atoms are taken from the first frame.
+        """
+        if not self.nfix:
+            for d, key in enumerate('xyz'):
+                out[:, :, d] = block[key][:, atoms]
+            return
+        pos = self.free_index[atoms]
+        free = pos >= 0
+        out[:, ~free] = self.fixed_xyz[atoms[~free]]
+        if free.any():
+            pos = pos[free]
+            for d, key in enumerate('xyz'):
+                out[:, free, d] = block[key][:, pos]
+
+    @property
+    def fixed_xyz(self):
+        """The (natoms, 3) coordinates of the first frame, which supplies the
+        positions of the fixed atoms for every later frame.
+        """
+        if self._fixed_xyz is None:
+            pos = self.fp.tell()
+            self.seek_frame(0, whence=0)
+            tmp = np.fromfile(self.fp, dtype=self._frame0_dt, count=1)
+            self.fp.seek(pos, 0)
+            if len(tmp) != 1:
+                raise IOError("Did not read enough data, the first frame of "
+                            "%s is incomplete" % self.name)
+            self._fixed_xyz = np.column_stack((tmp['x'][0], tmp['y'][0],
+                                            tmp['z'][0]))
+        return self._fixed_xyz
+
+    @property
+    def free_index(self):
+        """A natoms long array mapping each atom to its position in the free
+        atom records, fixed atoms are mapped to -1.
+        """
+        if self._free_index is None:
+            if self.free_atoms is None:
+                self._free_index = np.arange(self.natoms)
+            else:
+                self._free_index = np.empty(self.natoms, dtype=np.intp)
+                self._free_index.fill(-1)
+                self._free_index[self.free_atoms] = \
+                    np.arange(len(self.free_atoms))
+        return self._free_index
+
+    def count_frames(self):
+        """Returns the number of complete frames stored on disk, which may
+        differ from the :attr:`nframes` value reported by the header.
+        """
+        nbytes = os.fstat(self.fileno()).st_size - self.header_size
+        if self.nfix and nbytes >= self._frame0_size:
+            return (nbytes - self._frame0_size) // self.frame_size + 1
+        return max(nbytes // self.frame_size, 0)
+
+    def _readinto_exactly(self, buf):
+        nbytes = self.fp.readinto(buf)
+        if nbytes != buf.nbytes:
+            raise IOError("Did not read enough data, wanted %r bytes, "
+                        "received %r bytes." % (buf.nbytes, nbytes))
+
     def get_massive_dump(self):
         """Returns a large 3-D :class:`numpy.ndarray` containing all of the
         frame data for the entire trajectory.
@@ -371,6 +617,159 @@ class DCDFile(CharmmBin):
         self.readline()
         return tmp
 
+    def scan(self, chunk_size=4096, use_index=True):
+        """Checks the record markers of every frame, and returns a
+        :class:`DCDScan` describing the intact part of the file. The markers
+        are compared in vectorized chunks of `chunk_size` frames through a
+        memory map, so only the pages holding markers are read from disk.
+
+        The result is saved in a small sidecar index file, named by appending
+        :attr:`INDEX_EXT` to the file name, which is reused by later scans as
+        long as the size and modification time of the file are unchanged.
+        Pass `use_index=False` to force a full scan.
+        """
+        if use_index:
+            tmp = self._read_index()
+            if tmp is not None:
+                return tmp
+        size = os.path.getsize(self.name)
+        nbytes = size - self.header_size
+        if self.nfix and nbytes >= self._frame0_size:
+            nmapped = (nbytes - self._frame0_size) // self.frame_size
+        elif self.nfix:
+            nmapped = 0
+        else:
+            nmapped = nbytes // self.frame_size
+        nframes = 0
+        bad_frame = None
+        # the full first frame of a trajectory with fixed atoms
+        if self.nfix and nbytes >= self._frame0_size:
+            frame0 = np.memmap(self.name, dtype=self._frame0_dt, mode='r',
+                            offset=self.header_size, shape=(1,))
+            if self._markers_ok(frame0)[0]:
+                nframes = 1
+            else:
+                bad_frame = 0
+                nmapped = 0
+        skip = int(bool(self.nfix))
+        if nmapped:
+            frames = np.memmap(self.name, dtype=self.frame_dt, mode='r',
+                            offset=self.frame_offset(skip), shape=(nmapped,))
+            for first in xrange(0, nmapped, chunk_size):
+                ok = self._markers_ok(frames[first:first+chunk_size])
+                if not ok.all():
+                    nframes += first + int(np.argmin(ok))
+                    bad_frame = nframes
+                    break
+            else:
+                nframes += nmapped
+            del frames
+        if nframes:
+            end = self.frame_offset(nframes)
+        else:
+            end = self.header_size
+        tmp = DCDScan(self.name, nframes, self.nframes, bad_frame, size - end,
+                    from_index=False)
+        self._write_index(tmp)
+        return tmp
+
+    def repair(self):
+        """Scans the file and, if it is damaged, truncates it in place after
+        the last good frame and updates the frame count of the header. The
+        file may be open in any mode. Returns the :class:`DCDScan` of the
+        damaged file.
+        """
+        tmp = self.scan(use_index=False)
+        if not tmp.ok:
+            if tmp.trailing_bytes:
+                self.fp.flush()
+                with open(self.name, 'r+b') as fp:
+                    fp.truncate(self.frame_offset(tmp.nframes))
+            self.update_header()
+            self.scan(use_index=False)
+        return tmp
+
+    @staticmethod
+    def _markers_ok(frames):
+        """Returns a boolean array flagging the frames whose leading and
+        trailing record markers match the lengths of their records.
+        """
+        ok = np.ones(len(frames), dtype=np.bool_)
+        names = [ name for name in frames.dtype.names
+                if not name.startswith('pad') ]
+        for i, name in enumerate(names):
+            nbytes = frames.dtype.fields[name][0].itemsize
+            ok &= frames['pad%d' % (i*2)][:, 0] == nbytes
+            ok &= frames['pad%d' % (i*2+1)][:, 0] == nbytes
+        return ok
+
+    def _index_key(self):
+        stat = os.stat(self.name)
+        return [stat.st_size, int(stat.st_mtime * 1e6), self.header_size,
+                self._frame0_size, self.frame_size]
+
+    def _read_index(self):
+        try:
+            with open(self.name + self.INDEX_EXT, 'r') as fp:
+                tmp = fp.read().split()
+        except IOError:
+            return None
+        try:
+            if tmp[0] != 'dcdindex' or \
+                    map(int, tmp[1:6]) != self._index_key():
+                return None
+            nframes, bad_frame, trailing_bytes = map(int, tmp[6:9])
+        except (IndexError, ValueError):
+            return None
+        if bad_frame < 0:
+            bad_frame = None
+        return DCDScan(self.name, nframes, self.nframes, bad_frame,
+                    trailing_bytes, from_index=True)
+
+    def _write_index(self, scan):
+        tmp = ['dcdindex'] + self._index_key() + [scan.nframes,
+                scan.bad_frame is None and -1 or scan.bad_frame,
+                scan.trailing_bytes]
+        try:
+            with open(self.name + self.INDEX_EXT, 'w') as fp:
+                fp.write(' '.join(map(str, tmp)) + '\n')
+        except IOError:
+            warnings.warn("Unable to write dcd index: %s%s" % (self.name,
+                        self.INDEX_EXT))
+
+    def memmap(self, dtype=np.float32):
+        """Returns a :class:`DCDView`, a read-only memory mapped view of the
+        trajectory that can be sliced and fancy indexed like a (nframes,
+        natoms, 3) :class:`numpy.ndarray` of `dtype`. Only the pages holding
+        the requested frames and atoms are ever read from disk.
+        """
+        return DCDView(self, dtype=dtype)
+
+    def iter_prefetch(self, atoms=None, size=64, begin=0, end=None,
+                    stride=None, dtype=np.float32, depth=2):
+        """Returns a :class:`DCDPrefetch` iterator over the same blocks as
+        :meth:`iter_block`, which are read ahead on a background thread, up to
+        `depth` blocks ahead of the consumer, into a ring of `depth` + 1
+        preallocated buffers. Disk reads and decoding overlap with whatever
+        computation is done on the current block. The block returned by each
+        iteration is only valid until the next one is requested.
+
+        >>> blocks = dcd.iter_prefetch(atoms=ca_index, size=256, depth=3)
+        >>> for block in blocks:
+        ...     rg.extend(radius_of_gyration(block))
+        >>> blocks.stall_time
+        0.82
+        """
+        args = (self.name, self.ENDIAN, self.REC_HEAD_PREC)
+        def source(buffers):
+            with open_dcd(args[0], mode='r', endian=args[1],
+                        rec_head_prec=args[2]) as fp:
+                for block in fp._iter_block(atoms, size, begin, end, stride,
+                                            dtype, buffers):
+                    yield block
+        nsel = self.natoms if atoms is None else len(np.ravel(atoms))
+        return DCDPrefetch(source, (size, nsel, 3), dtype, depth)
+
     def read_frame(self):
         """Reads and returns a full frame in binary format, an empty binary
         string (if there are no more frames to be read) or reads a partial
@@ -380,57 +779,167 @@ class DCDFile(CharmmBin):
 
     def read_nparray(self):
         """Reads and returns a full frame formatted as a
-        :class:`numpy.ndarray`.
+        :class:`numpy.ndarray`. With fixed atoms, the first frame is returned
+        with the :attr:`frame0_dt` layout, and the later frames, holding only
+        the free atoms, with the :attr:`frame_dt` layout.
         """
+        if self.nfix and self.fp.tell() == self.header_size:
+            return np.fromfile(self.fp, dtype=self._frame0_dt, count=1)
         return np.fromfile(self.fp, dtype=self.frame_dt, count=1)
 
-    def write_nparray(self, nparray, order='C'):
-        """Takes an appropriately structed :class:`numpy.ndarray`, converts it
-        to binary format and writes it to disk.
-
-        *Untested*
+    def _next_nparray(self):
+        tmp = self.read_nparray()
+        if not len(tmp):
+            raise StopIteration
+        return tmp
 
-        :TODO: Error checking, right now it blindly writes
+    def write_nparray(self, nparray):
+        """Takes a :class:`numpy.ndarray` of :attr:`frame_dt` records, such as
+        those returned by :meth:`read_nparray`, and writes them to disk with a
+        single write. The frame count in the header is updated when the file
+        is flushed or closed.
         """
         if not isinstance(nparray, np.ndarray):
             raise TypeError("invalid nparray")
-        self.fp.write(nparray.tostring(order))
+        if nparray.dtype not in (self.frame_dt, self.frame0_dt):
+            raise TypeError("invalid nparray dtype: %r, expected %r" %
+                            (nparray.dtype, self.frame_dt))
+        self._check_writable()
+        np.ascontiguousarray(nparray).tofile(self.fp)
+        self._dirty = True
+
+    def write_frames(self, xyz, xtl=None, d4=None, q=None):
+        """Writes a block of k frames, `xyz` is a (k, natoms, 3) array-like
+        (a single (natoms, 3) frame is also accepted). If the header declares
+        unit cell, fourth dimension or charge data, then `xtl` (k, 6), `d4`
+        (k, natoms) and `q` (k, natoms) must also be specified. The block is
+        packed, record markers included, into one buffer which is written
+        with a single call. The frame count in the header is updated when
+        the file is flushed or closed.
+
+        >>> with open_dcd('new.dcd', mode='w') as fp:
+        ...     fp.import_header(template.export_header())
+        ...     fp.write_header()
+        ...     for block in template.iter_block(size=1024):
+        ...         fp.write_frames(block)
+        """
+        self._check_writable()
+        xyz = np.asarray(xyz)
+        if xyz.ndim == 2:
+            xyz = xyz[np.newaxis]
+        if xyz.ndim != 3 or xyz.shape[1:] != (self.natoms, 3):
+            raise ValueError("invalid xyz shape: %r, expected (k, %d, 3)" %
+                            (xyz.shape, self.natoms))
+        extra = {'xtl': xtl, 'd4': d4, 'q': q}
+        for name in self._record_names():
+            if name not in 'xyz' and extra[name] is None:
+                raise ValueError("the dcd header requires %s data" % name)
+            elif name not in 'xyz':
+                extra[name] = np.asarray(extra[name]).reshape(len(xyz), -1)
+        k = 0
+        if self.nfix:
+            self.fp.flush()
+        if self.nfix and self.count_frames() == 0:
+            # the first frame holds every atom, the rest only the free atoms
+            self._pack_frames(self._frame0_dt, xyz, extra, slice(0, 1),
+                            None).tofile(self.fp)
+            k = 1
+        if k < len(xyz):
+            self._pack_frames(self.frame_dt, xyz, extra, slice(k, None),
+                            self.free_atoms).tofile(self.fp)
+        self._dirty = True
+
+    def _pack_frames(self, frame_dt, xyz, extra, frames, atoms):
+        """Packs the `frames` slice of a block into `frame_dt` records, with
+        only the `atoms` subset of the per atom data, if specified.
+        """
+        buf = np.empty(len(xyz[frames]), dtype=frame_dt)
+        for i, name in enumerate(self._record_names()):
+            if name in 'xyz':
+                tmp = xyz[frames, :, 'xyz'.index(name)]
+            else:
+                tmp = extra[name][frames]
+            if atoms is not None and name != 'xtl':
+                tmp = tmp[:, atoms]
+            buf[name] = tmp
+            nbytes = frame_dt.fields[name][0].itemsize
+            buf['pad%d' % (i*2)] = nbytes
+            buf['pad%d' % (i*2+1)] = nbytes
+        return buf
+
+    def update_header(self):
+        """Patches the frame count and step count stored in the header on
+        disk, in place, to match the number of complete frames in the file.
+        The step count is advanced by `nsavc` for every frame added since the
+        header was last written.
+        """
+        self.fp.flush()
+        nframes = self.count_frames()
+        if self.nframes is not None and self.nsteps is not None:
+            self.nsteps += (nframes - self.nframes) * self.nsavc
+        else:
+            self.nsteps = nframes * self.nsavc
+        self.nframes = nframes
+        fmt = self.ENDIAN + self.C_ARRAY_PREC
+        offset = self.REC_HEAD_BLEN + 4
+        # a separate handle is used, because appending handles ignore seeks
+        with open(self.name, 'r+b') as fp:
+            fp.seek(offset, 0)
+            fp.write(struct.pack(fmt, self.nframes))
+            fp.seek(offset + 3 * self.C_ARRAY_BLEN, 0)
+            fp.write(struct.pack(fmt, self.nsteps))
+        self._dirty = False
+
+    def flush(self):
+        super(DCDFile, self).flush()
+        if self._dirty:
+            self.update_header()
+
+    def _check_writable(self):
+        if 'r' in self.mode and '+' not in self.mode:
+            raise IOError("File not open for writing")
+        if self.frame_dt is None:
+            raise IOError("The dcd header must be written before any frames")
+
+    def _record_names(self):
+        """Returns the names of the data records of a frame, in order."""
+        return [ name for name in self.frame_dt.names
+                if not name.startswith('pad') ]
 
     @property
     def leftovers(self):
         return self._leftovers
 
     # Frame (meta)data ########################################################
-    def compile_npdt(self):
+    def compile_npdt(self, natoms=None):
         """Uses the availible precision specifications to build a
         :class:`numpy.dtype` object. This is then used in turn to convert
         between :class:`numpy.ndarray` objects and binary formatting for
-        writing to disk.
+        writing to disk. By default the records hold every atom, `natoms`
+        overrides the count, as for the free atom frames of a trajectory with
+        fixed atoms.
         """
+        if natoms is None:
+            natoms = self.natoms
         tmp = []
         if self.has_xtl:
-            tmp.append(('xtl', '%s%s%d' % (self.ENDIAN, self.XTL_PREC, self.XTL_BLEN), 6))
-        tmp.append(('x', '%s%s%d' % (self.ENDIAN, self.XYZ_PREC, self.XYZ_BLEN),
-                    self.natoms))
-        tmp.append(('y', '%s%s%d' % (self.ENDIAN, self.XYZ_PREC, self.XYZ_BLEN),
-                    self.natoms))
-        tmp.append(('z', '%s%s%d' % (self.ENDIAN, self.XYZ_PREC, self.XYZ_BLEN),
-                    self.natoms))
+            tmp.append(('xtl', '%s%s' % (self.ENDIAN, self.XTL_PREC), 6))
+        tmp.append(('x', '%s%s' % (self.ENDIAN, self.XYZ_PREC), natoms))
+        tmp.append(('y', '%s%s' % (self.ENDIAN, self.XYZ_PREC), natoms))
+        tmp.append(('z', '%s%s' % (self.ENDIAN, self.XYZ_PREC), natoms))
         if self.has_d4:
-            tmp.append(('d4', '%s%s%d' % (self.ENDIAN, self.D4_PREC, self.D4_BLEN),
-                        self.natoms))
+            tmp.append(('d4', '%s%s' % (self.ENDIAN, self.D4_PREC), natoms))
         if self.has_q:
-            tmp.append(('q', '%s%s%d' % (self.ENDIAN, self.Q_PREC, self.Q_BLEN),
-                        self.natoms))
+            tmp.append(('q', '%s%s' % (self.ENDIAN, self.Q_PREC), natoms))
         # add record markers
         tmp2 = []
         if True:
             for i, t in enumerate(tmp):
-                tmp2.append(('pad%d' % (i*2), '%s%s%d' % (self.ENDIAN,
-                            self.REC_HEAD_PREC, self.REC_HEAD_BLEN), (1,)))
+                tmp2.append(('pad%d' % (i*2), '%s%s' % (self.ENDIAN,
+                            self.REC_HEAD_PREC), (1,)))
                 tmp2.append(t)
-                tmp2.append(('pad%d' % (i*2+1), '%s%s%d' % (self.ENDIAN,
-                            self.REC_HEAD_PREC, self.REC_HEAD_BLEN), (1,)))
+                tmp2.append(('pad%d' % (i*2+1), '%s%s' % (self.ENDIAN,
+                            self.REC_HEAD_PREC), (1,)))
             return np.dtype(tmp2)
         return np.dtype(tmp)
 
@@ -442,19 +951,39 @@ class DCDFile(CharmmBin):
     def frame_size(self):
         return self._frame_size
 
+    @property
+    def frame0_dt(self):
+        return self._frame0_dt
+
+    @property
+    def frame0_size(self):
+        return self._frame0_size
+
+    def frame_offset(self, frame):
+        """Returns the byte offset of `frame`, with fixed atoms the first frame
+        is larger than the rest.
+        """
+        tmp = frame * self.frame_size + self.header_size
+        if frame > 0:
+            tmp += self._frame0_size - self._frame_size
+        return tmp
+
     # Wrapper to python file API ##############################################
     def readline(self):
         """Reads and returns a full frame in binary format, an empty binary
         string (if there are no more frames to be read) or reads a partial
         frame into the :attr:`leftovers` attribute.
         """
-        tmp = self.fp.read(self.frame_size)
-        if len(tmp) == self.frame_size:
+        size = self.frame_size
+        if self.nfix and self.fp.tell() == self.header_size:
+            size = self._frame0_size
+        tmp = self.fp.read(size)
+        if len(tmp) == size:
             return tmp
         elif len(tmp) == 0:
             return b''
         else:
-            warnings.warn("Did not read enough data, wanted %r bytes, received %r bytes." % (self.frame_size, len(tmp)))
+            warnings.warn("Did not read enough data, wanted %r bytes, received %r bytes." % (size, len(tmp)))
             warnings.warn("Dumping fractional frame to leftovers.")
             self._leftovers.append(tmp)
             return b''
@@ -485,7 +1014,9 @@ class DCDFile(CharmmBin):
         if whence == -1:
             self.fp.seek(0, 0)
         elif whence == 0:
-            self.fp.seek(offset * self.frame_size + self.header_size, whence)
+            self.fp.seek(self.frame_offset(offset), 0)
+        elif whence == 1 and self.nfix and self.fp.tell() <= self.header_size:
+            self.fp.seek(self.frame_offset(offset), 0)
         else:
             self.fp.seek(offset * self.frame_size, whence)
 
@@ -494,7 +1025,13 @@ class DCDFile(CharmmBin):
         of the frame. If an integer is returned the filepointer is between
         frames, if a float is returned the filepointer is in a frame.
         """
-        tmp = (self.fp.tell() - self.header_size) / self.frame_size
+        tmp = self.fp.tell() - self.header_size
+        if self.nfix and tmp >= self._frame0_size:
+            tmp = (tmp - self._frame0_size) / self.frame_size + 1
+        elif self.nfix:
+            tmp = tmp / self._frame0_size
+        else:
+            tmp = tmp / self.frame_size
         if tmp == int(tmp):
             return int(tmp)
         else:
@@ -506,7 +1043,7 @@ class DCDFile(CharmmBin):
         used.  Offset must be an integer.
         """
         if offset == int(offset):
-            self.fp.truncate(offset * self.frame_size + self.header_size)
+            self.fp.truncate(self.frame_offset(offset))
         else:
             raise ValueError("offset must be an integer")
 
@@ -606,3 +1143,453 @@ class DCDFile(CharmmBin):
     @property
     def has_q(self):
         return not self._q_prec is None
+
+
+class DCDScan(object):
+    """The result of :meth:`DCDFile.scan`, describing the intact part of a DCD
+    file. This class has no public constructor.
+
+    :attr:`nframes` is the number of frames whose record markers are intact,
+    :attr:`bad_frame` is the index of the first frame with corrupt markers,
+    or `None`, and :attr:`trailing_bytes` counts the bytes after the last
+    good frame, such as a partial frame left by a killed job.
+    """
+    def __init__(self, name, nframes, header_nframes, bad_frame,
+                trailing_bytes, from_index=False):
+        super(DCDScan, self).__init__()
+        self.name = name
+        self.nframes = nframes
+        self.header_nframes = header_nframes
+        self.bad_frame = bad_frame
+        self.trailing_bytes = trailing_bytes
+        self.from_index = from_index
+
+    @property
+    def last_good_frame(self):
+        """The index of the last intact frame, or `None`."""
+        if self.nframes:
+            return self.nframes - 1
+        return None
+
+    @property
+    def ok(self):
+        return self.bad_frame is None and not self.trailing_bytes and \
+            self.header_nframes in (0, self.nframes)
+
+    def __repr__(self):
+        tmp = ["%d good frames" % self.nframes]
+        if self.bad_frame is not None:
+            tmp.append("corrupt record markers at frame %d" % self.bad_frame)
+        if self.trailing_bytes:
+            tmp.append("%d trailing bytes" % self.trailing_bytes)
+        if self.header_nframes not in (0, self.nframes):
+            tmp.append("header reports %d frames" % self.header_nframes)
+        return "%s(%r, %s)" % (self.__class__.__name__, self.name,
+                            ', '.join(tmp))
+
+
+class DCDView(object):
+    """A read-only, memory mapped view of the coordinates stored in a DCD
+    file, that behaves like a (nframes, natoms, 3) :class:`numpy.ndarray`.
+    This class has no public constructor, please use :meth:`DCDFile.memmap`
+    instead.
+
+    The file is mapped with the :attr:`DCDFile.frame_dt` structured dtype,
+    so indexing never copies more than the requested frames and atoms, and
+    the operating system pages data in lazily. Indexing returns native
+    :class:`numpy.ndarray` objects of :attr:`dtype`.
+
+    >>> view = open_dcd('huge.dcd').memmap()
+    >>> view.shape
+    (250000, 1000000, 3)
+    >>> ca = view[::100, ca_index]
+    >>> last = view[-1]
+
+    With fixed atoms, only the free atom frames are mapped, and the fixed
+    atoms are filled in from the first frame, which is kept in memory.
+    """
+    def __init__(self, dcd, dtype=np.float32):
+        super(DCDView, self).__init__()
+        self.name = dcd.name
+        self.natoms = dcd.natoms
+        self.nfix = dcd.nfix
+        self.dtype = np.dtype(dtype)
+        self.nframes = dcd.count_frames()
+        nbytes = os.path.getsize(dcd.name) - dcd.header_size
+        if self.nframes:
+            nbytes -= dcd.frame_offset(self.nframes) - dcd.header_size
+        if nbytes > 0:
+            warnings.warn("Ignoring %d trailing bytes of a partial frame in "
+                        "%s" % (nbytes, dcd.name))
+        if dcd.nframes and dcd.nframes != self.nframes:
+            warnings.warn("DCD header reports %d frames, but %s contains %d" %
+                        (dcd.nframes, dcd.name, self.nframes))
+        # with fixed atoms the first frame is not mapped, see _getitem_nfix
+        skip = int(bool(self.nfix))
+        if self.nframes > skip:
+            self._map = np.memmap(dcd.name, dtype=dcd.frame_dt, mode='r',
+                                offset=dcd.frame_offset(skip),
+                                shape=(self.nframes - skip,))
+        else:
+            self._map = np.zeros(0, dtype=dcd.frame_dt)
+        self._fields = (self._map['x'], self._map['y'], self._map['z'])
+        if self.nfix and self.nframes:
+            self._fixed_xyz = dcd.fixed_xyz
+            self._free_index = dcd.free_index
+            if dcd.has_xtl:
+                dcd.seek_frame(0, whence=0)
+                self._xtl0 = dcd.read_nparray()['xtl']
+
+    @property
+    def shape(self):
+        return (self.nframes, self.natoms, 3)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def xtl(self):
+        """A (nframes, 6) view of the unit cell data, or `None`."""
+        if 'xtl' not in self._map.dtype.names:
+            return None
+        if self.nfix and self.nframes:
+            return np.concatenate((self._xtl0, self._map['xtl']))
+        return self._map['xtl']
+
+    def __len__(self):
+        return self.nframes
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError("too many indices")
+        key = key + (slice(None),) * (3 - len(key))
+        frames, atoms, dims = key
+        if isinstance(dims, (int, long, np.integer)):
+            dims = [dims]
+            squeeze = True
+        else:
+            squeeze = False
+        dims = np.arange(3)[dims]
+        if self.nfix:
+            tmp = self._getitem_nfix(frames, atoms, dims)
+            if squeeze:
+                tmp = tmp[..., 0]
+            return tmp
+        # both frames and atoms as arrays would be zipped, use an open mesh
+        if not isinstance(frames, (slice, int, long, np.integer)) and \
+                not isinstance(atoms, (slice, int, long, np.integer)):
+            frames, atoms = np.ix_(np.asarray(frames).ravel(),
+                                np.asarray(atoms).ravel())
+        tmp = [ np.asarray(self._fields[d][frames, atoms], dtype=self.dtype)
+                for d in dims ]
+        tmp = np.concatenate([ t[..., np.newaxis] for t in tmp ], axis=-1)
+        if squeeze:
+            tmp = tmp[..., 0]
+        return tmp
+
+    def _getitem_nfix(self, frames, atoms, dims):
+        """Gathers the requested coordinates of a trajectory with fixed atoms,
+        starting from the fixed coordinates of the first frame and scattering
+        the free atom coordinates of the later frames on top.
+        """
+        frames = np.arange(self.nframes)[frames]
+        atoms = np.arange(self.natoms)[atoms]
+        f = np.atleast_1d(frames)
+        a = np.atleast_1d(atoms)
+        tmp = np.empty((len(f), len(a), len(dims)), dtype=self.dtype)
+        tmp[:] = self._fixed_xyz[a][:, dims]
+        pos = self._free_index[a]
+        free = pos >= 0
+        later = f > 0
+        if free.any() and later.any():
+            rows = np.ix_(f[later] - 1, pos[free])
+            block = tmp[later]
+            for j, d in enumerate(dims):
+                block[:, free, j] = self._fields[d][rows]
+            tmp[later] = block
+        if np.ndim(atoms) == 0:
+            tmp = tmp[:, 0]
+        if np.ndim(frames) == 0:
+            tmp = tmp[0]
+        return tmp
+
+    def __iter__(self):
+        for i in xrange(self.nframes):
+            yield self[i]
+
+    def __array__(self, dtype=None):
+        tmp = self[:]
+        if dtype is not None:
+            tmp = tmp.astype(dtype)
+        return tmp
+
+    def __repr__(self):
+        return "%s(%r, shape=%r)" % (self.__class__.__name__, self.name,
+                                    self.shape)
+
+
+def _prefetch_buffers(ring, free, stop, stats):
+    while 1:
+        i = None
+        while i is None:
+            if stop.is_set():
+                return
+            try:
+                i = free.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        stats['last'] = i
+        yield ring[i]
+
+
+def _prefetch_run(source, ring, free, ready, stop, stats):
+    """The reader thread of a :class:`DCDPrefetch`. Stopping makes the
+    buffer generator return, which ends `source` and closes its file.
+    """
+    try:
+        start = time.time()
+        for block in source(_prefetch_buffers(ring, free, stop, stats)):
+            stats['read_time'] += time.time() - start
+            ready.put((stats['last'], len(block)))
+            start = time.time()
+    except Exception:
+        ready.put(sys.exc_info())
+    else:
+        ready.put(None)
+
+
+class DCDPrefetch(object):
+    """An iterator over blocks of frames which are read ahead on a background
+    thread. This class has no public constructor, please use
+    :meth:`DCDFile.iter_prefetch` or :meth:`DCDSeries.iter_prefetch` instead.
+
+    The reader thread fills a ring of `depth` + 1 preallocated buffers, and
+    blocks when all of them are waiting to be consumed. Each block handed to
+    the consumer is recycled when the next block is requested. After (or
+    during) iteration, :attr:`stall_time` is the total time in seconds that
+    the consumer spent waiting on the reader, and :attr:`read_time` is the
+    time the reader spent reading and decoding. A stall time near zero means
+    the analysis, not the disk, is the bottleneck.
+    """
+    def __init__(self, source, shape, dtype, depth=2):
+        super(DCDPrefetch, self).__init__()
+        if depth < 1:
+            raise ValueError("invalid value for depth: %r" % depth)
+        self.depth = depth
+        self.nblocks = 0
+        self.stall_time = 0.
+        self._ring = [ np.empty(shape, dtype=dtype) for i in xrange(depth + 1) ]
+        self._free = Queue.Queue()
+        for i in xrange(depth + 1):
+            self._free.put(i)
+        self._ready = Queue.Queue()
+        self._current = None
+        self._done = False
+        self._stop = threading.Event()
+        self._stats = {'read_time': 0.}
+        # the thread must not reference self, so that an abandoned iterator
+        # is collected, and its __del__ stops the thread and closes the file
+        self._thread = threading.Thread(target=_prefetch_run,
+                            args=(source, self._ring, self._free, self._ready,
+                                self._stop, self._stats))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def read_time(self):
+        return self._stats['read_time']
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+        if self._done:
+            raise StopIteration
+        start = time.time()
+        item = self._ready.get()
+        self.stall_time += time.time() - start
+        if item is None:
+            self._done = True
+            raise StopIteration
+        if len(item) == 3:
+            self._done = True
+            raise item[0], item[1], item[2]
+        self._current, n = item
+        self.nblocks += 1
+        return self._ring[self._current][:n]
+
+    def close(self):
+        """Stops the reader thread, abandoning any blocks read ahead."""
+        self._done = True
+        self._stop.set()
+        self._thread.join()
+
+    def __del__(self):
+        # no join, the thread notices within its polling interval
+        stop = getattr(self, '_stop', None)
+        if stop is not None:
+            stop.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return "%s(depth=%d, blocks=%d, stall_time=%.3f, read_time=%.3f)" % (
+                self.__class__.__name__, self.depth, self.nblocks,
+                self.stall_time, self.read_time)
+
+
+class DCDSeries(object):
+    """A read-only virtual concatenation of several DCD files, indexed by a
+    single global frame number. This class has no public constructor, please
+    use :func:`open_dcd_series` instead.
+
+    The number of frames in each file is computed from its size, and kept in
+    the :attr:`offsets` table, so random access costs one binary search plus
+    a memory mapped read. Indexing follows the same rules as :class:`DCDView`
+    and :meth:`iter_block` has the same signature as
+    :meth:`DCDFile.iter_block`.
+
+    >>> traj = open_dcd_series(['prod_%03d.dcd' % i for i in range(500)])
+    >>> traj.shape
+    (500000, 3341, 3)
+    >>> ca = traj[::10, ca_index]
+    """
+    _compatible = ('natoms', 'nsavc', 'nfix', 'XYZ_PREC', 'has_xtl', 'has_d4',
+                'has_q')
+
+    def __init__(self, fnames, max_open=32):
+        super(DCDSeries, self).__init__()
+        self.fnames = fnames
+        self.max_open = max_open
+        self.headers = []
+        nframes = []
+        for fname in fnames:
+            with open_dcd(fname, mode='r') as fp:
+                header = dict( (key, getattr(fp, key)) for key in
+                                self._compatible )
+                header['frame_size'] = fp.frame_size
+                nframes.append(fp.count_frames())
+            self.headers.append(header)
+        first = self.headers[0]
+        for fname, header in zip(fnames, self.headers):
+            for key in self._compatible:
+                if header[key] != first[key]:
+                    raise ValueError('incompatible dcd headers, "%s" has %s = '
+                                    '%r but "%s" has %s = %r' % (fnames[0],
+                                    key, first[key], fname, key, header[key]))
+        self.natoms = first['natoms']
+        self.nsavc = first['nsavc']
+        self.has_xtl = first['has_xtl']
+        self.nframes_per_file = np.array(nframes, dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.nframes_per_file)))
+        self.nframes = int(self.offsets[-1])
+        self._views = {}
+        self._lru = deque()
+
+    @property
+    def shape(self):
+        return (self.nframes, self.natoms, 3)
+
+    def __len__(self):
+        return self.nframes
+
+    def locate(self, frame):
+        """Returns a (file index, local frame index) tuple for a global
+        frame index."""
+        if frame < 0:
+            frame += self.nframes
+        if not 0 <= frame < self.nframes:
+            raise IndexError("frame index out of range: %r" % frame)
+        i = int(np.searchsorted(self.offsets, frame, side='right')) - 1
+        return i, frame - int(self.offsets[i])
+
+    def _view(self, i):
+        try:
+            view = self._views[i]
+            self._lru.remove(i)
+        except KeyError:
+            with open_dcd(self.fnames[i], mode='r') as fp:
+                view = fp.memmap()
+            self._views[i] = view
+            while len(self._views) > self.max_open:
+                del self._views[self._lru.popleft()]
+        self._lru.append(i)
+        return view
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        frames, rest = key[0], key[1:]
+        if isinstance(frames, slice):
+            index = np.arange(*frames.indices(self.nframes))
+        else:
+            index = np.arange(self.nframes)[frames]
+        scalar = np.ndim(index) == 0
+        index = np.atleast_1d(index)
+        owner = np.searchsorted(self.offsets, index, side='right') - 1
+        tmp = None
+        for i in np.unique(owner):
+            mask = owner == i
+            part = self._view(i)[(index[mask] - self.offsets[i],) + rest]
+            if tmp is None:
+                tmp = np.empty((len(index),) + part.shape[1:], dtype=part.dtype)
+            tmp[mask] = part
+        if tmp is None:
+            tmp = self._view(0)[(index,) + rest]
+        if scalar:
+            return tmp[0]
+        return tmp
+
+    def iter_block(self, atoms=None, size=64, begin=0, end=None, stride=None,
+                dtype=np.float32):
+        """Creates a generator over blocks of frames, spanning every file in
+        the series, see :meth:`DCDFile.iter_block`. Blocks do not straddle
+        file boundaries, so a block may hold fewer than `size` frames.
+        """
+        return self._iter_block(atoms, size, begin, end, stride, dtype)
+
+    def iter_prefetch(self, atoms=None, size=64, begin=0, end=None,
+                    stride=None, dtype=np.float32, depth=2):
+        """Returns a :class:`DCDPrefetch` iterator over the same blocks as
+        :meth:`iter_block`, read ahead on a background thread, see
+        :meth:`DCDFile.iter_prefetch`.
+        """
+        def source(buffers):
+            return self._iter_block(atoms, size, begin, end, stride, dtype,
+                                    buffers)
+        nsel = self.natoms if atoms is None else len(np.ravel(atoms))
+        return DCDPrefetch(source, (size, nsel, 3), dtype, depth)
+
+    def _iter_block(self, atoms, size, begin, end, stride, dtype,
+                    buffers=None):
+        stride = stride or 1
+        if end is None or end >= self.nframes:
+            end = self.nframes - 1
+        for i, fname in enumerate(self.fnames):
+            first, last = self.offsets[i], self.offsets[i+1] - 1
+            if last < begin or first > end:
+                continue
+            local_begin = max(begin + -(-(first - begin) // stride) * stride,
+                            begin) - first
+            local_end = min(end, last) - first
+            if local_begin > local_end:
+                continue
+            with open_dcd(fname, mode='r') as fp:
+                for block in fp._iter_block(atoms, size, int(local_begin),
+                                            int(local_end), stride, dtype,
+                                            buffers):
+                    yield block
+
+    def __repr__(self):
+        return "%s(%d files, shape=%r)" % (self.__class__.__name__,
+                                        len(self.fnames), self.shape)
@@ -0,0 +1,474 @@
+"""This module contains the CHARMM protein structure file (PSF) reader and
+writer.
+
+Rather than building one python object per atom, the topology is held in a
+handful of :class:`numpy.ndarray` objects. Each section of the file is parsed
+in bulk, which keeps the load time of million atom membrane systems down to a
+few seconds, and the atom records line up index for index with the coordinate
+arrays produced by :class:`pychm.future.io.charmm.dcd.DCDFile`.
+
+Standard, EXTended, XPLOR and CMAP flavored files are supported. All of the
+connectivity arrays use 0-based atom indices, the 1-based indices used on
+disk are restored when the file is written.
+
+>>> psf = open_psf('system.psf')
+>>> dcd = open_dcd('system.dcd')
+>>> psf.natoms == dcd.natoms
+True
+>>> heavy = psf.select(mask=psf.atom['mass'] > 1.5)
+"""
+
+from __future__ import division
+
+__all__ = ["open_psf"]
+
+import os
+import warnings
+
+import numpy as np
+
+from pychm.future.io.charmm.base import CharmmCard
+
+
+def open_psf(fname, mode='r', buffering=None):
+    """The public function responsible for mediating access to PSF file-
+    like objects. Opens a file and returns a stream. If the file cannot be
+    opened, an :exec:`IOError` is raised. If the file is opened for reading,
+    it is parsed immediately.
+
+    Parameters
+    ----------
+    fname: a string representing the path to a CHARMM PSF file
+    mode: an optional string that specifies the mode in which the file is
+    opened. It defaults to 'r' which means open for reading. Other values
+    are shown in the table below:
+    ========= =================================================================
+    Character Meaning
+    --------- -----------------------------------------------------------------
+    'r'       open for reading (default)
+    'w'       open for writing, truncating the file first
+    'x'       open for writing, noclobber, raises a value error if file exists
+    ========= =================================================================
+    buffering: an optional integer used to set the buffering policy. Passing 0
+    switches buffering off. Passing negative values, or 1 sets buffer to
+    default size. Passing any other positive integer sets the buffer size in
+    bytes.
+    """
+    if not isinstance(fname, basestring):
+        raise TypeError("Invalid fname: %r" % fname)
+    if not isinstance(mode, basestring):
+        raise TypeError("Invalid mode: %r" % mode)
+    if buffering is not None and not isinstance(buffering, int):
+        raise TypeError("Invalid buffering: %r" % buffering)
+    # parse modes
+    modes = set(mode)
+    if modes - set("rwx") or len(mode) > len(modes):
+        raise ValueError("invalid mode: %r" % mode)
+    reading = "r" in modes
+    writing = "w" in modes or "x" in modes
+    if reading + writing != 1:
+        raise ValueError("must have exactly one read/write mode")
+    if "x" in modes and os.path.isfile(fname):
+        raise ValueError("you may not set `mode=x` for existing files")
+    # instantiate!
+    tmp = PSFFile(fname, mode=(reading and "r" or "w"), buffering=buffering)
+    if reading:
+        tmp.parse()
+    return tmp
+
+
+def _lower(column):
+    return np.char.lower(np.char.strip(column))
+
+
+class PSFFile(CharmmCard):
+    """This class has no public constructor, please use :func:`open_psf`
+    instead.
+
+    The parsed topology is exposed through the following attributes, each is
+    `None` if the corresponding section is absent:
+    ============ ==============================================================
+    Attribute    Contents
+    ------------ --------------------------------------------------------------
+    atom         structured array, one record per atom, see :attr:`atom_dt`
+    bond         (nbond, 2) integer array
+    angle        (ntheta, 3) integer array
+    dihedral     (nphi, 4) integer array
+    improper     (nimphi, 4) integer array
+    donor        (ndon, 2) integer array
+    acceptor     (nacc, 2) integer array
+    nonbond      (nnb,) integer array of explicit exclusions
+    iblo         (natom,) integer array, exclusion pointers for `nonbond`
+    group        (ngrp, 3) integer array: first atom, group type, move flag
+    molnt        (natom,) integer array of molecule numbers
+    cross_term   (ncrterm, 8) integer array
+    ============ ==============================================================
+    """
+    atom_dt = np.dtype([
+        ('atomNum', np.int64),
+        ('segid', 'S8'),
+        ('resid', 'S8'),
+        ('resName', 'S8'),
+        ('atomType', 'S8'),
+        ('chemType', 'S8'),
+        ('charge', np.float64),
+        ('mass', np.float64),
+        ('imove', np.int32)
+        ])
+
+    # (header keyword, attribute name, integers per record, records per line)
+    _sections = (
+        ('nbond', 'bond', 2, 4),
+        ('ntheta', 'angle', 3, 3),
+        ('nphi', 'dihedral', 4, 2),
+        ('nimphi', 'improper', 4, 2),
+        ('ndon', 'donor', 2, 4),
+        ('nacc', 'acceptor', 2, 4),
+        ('nnb', 'nonbond', 1, 8),
+        ('ngrp', 'group', 3, 3),
+        ('molnt', 'molnt', 1, 8),
+        ('ncrterm', 'cross_term', 8, 1)
+        )
+
+    _section_labels = {
+        'nbond': '!NBOND: bonds',
+        'ntheta': '!NTHETA: angles',
+        'nphi': '!NPHI: dihedrals',
+        'nimphi': '!NIMPHI: impropers',
+        'ndon': '!NDON: donors',
+        'nacc': '!NACC: acceptors',
+        'nnb': '!NNB',
+        'ngrp': '!NGRP NST2',
+        'molnt': '!MOLNT',
+        'ncrterm': '!NCRTERM: cross-terms'
+        }
+
+    def __init__(self, fname, mode='r', buffering=None):
+        super(PSFFile, self).__init__(fname=fname, mode=mode,
+                                    buffering=buffering)
+        self.flags = set()
+        self.atom = None
+        self.bond = None
+        self.angle = None
+        self.dihedral = None
+        self.improper = None
+        self.donor = None
+        self.acceptor = None
+        self.nonbond = None
+        self.iblo = None
+        self.group = None
+        self.nst2 = 0
+        self.molnt = None
+        self.lone_pair = None
+        self.cross_term = None
+
+    # Parsing #################################################################
+    def parse(self):
+        """Reads the entire file into memory, and decodes each section with
+        a single bulk conversion to a :class:`numpy.ndarray`.
+        """
+        self.seek(0, 0)
+        lines = self.read().split('\n')
+        self.deque = None
+        self.version = None
+        # the first non-blank line holds the format flags
+        i = 0
+        while not lines[i].strip():
+            i += 1
+        flags = lines[i].lower().split()
+        if not flags or flags[0] != 'psf':
+            raise IOError("Error when parsing psf header, expected 'PSF' "
+                        "but found: %r" % lines[i])
+        self.flags = set(flags[1:])
+        i += 1
+        n_lines = len(lines)
+        while i < n_lines:
+            line = lines[i]
+            if '!' not in line:
+                i += 1
+                continue
+            counts, keyword = line.split('!', 1)
+            keyword = keyword.split(':')[0].split()[0].lower()
+            try:
+                counts = map(int, counts.split())
+            except ValueError:
+                raise IOError("Error when parsing psf section header: %r" %
+                            line)
+            i += 1
+            if keyword == 'ntitle':
+                self.title = [ line.strip()[1:].strip().lower() for line in
+                                lines[i:i+counts[0]] ]
+                i += counts[0]
+            elif keyword == 'natom':
+                self.atom = self._parse_atoms(lines[i:i+counts[0]])
+                i += counts[0]
+            elif keyword == 'nnb':
+                i = self._parse_nnb(lines, i, counts[0])
+            elif keyword == 'numlp':
+                i = self._parse_lone_pairs(lines, i, *counts[:2])
+            else:
+                i = self._parse_section(lines, i, keyword, counts)
+        if self.atom is None:
+            raise IOError("No atom section found in psf: %s" % self.name)
+        if self.cross_term is None and 'cmap' in self.flags:
+            warnings.warn("psf is flagged 'CMAP', but has no cross-terms.")
+
+    def _parse_atoms(self, lines):
+        natom = len(lines)
+        tmp = np.zeros(natom, dtype=self.atom_dt)
+        if not natom:
+            return tmp
+        columns = self._split_fixed(lines)
+        if columns is None:
+            columns = self._split_free(lines)
+        tmp['atomNum'] = self._to_numeric(columns[0], np.int64)
+        tmp['segid'] = _lower(columns[1])
+        tmp['resid'] = _lower(columns[2])
+        tmp['resName'] = _lower(columns[3])
+        tmp['atomType'] = _lower(columns[4])
+        tmp['chemType'] = _lower(columns[5])
+        tmp['charge'] = self._to_numeric(columns[6], np.float64)
+        tmp['mass'] = self._to_numeric(columns[7], np.float64)
+        tmp['imove'] = self._to_numeric(columns[8], np.int32)
+        return tmp
+
+    @staticmethod
+    def _split_fixed(lines):
+        """Fast path for files whose atom records all have the same length,
+        the records are viewed as a 2D character array, and the fields are
+        located by the columns which are blank in every record. Returns `None`
+        if the fields can not be unambiguously located.
+        """
+        width = len(lines[0])
+        if not width or any( len(line) != width for line in lines ):
+            return None
+        chars = np.frombuffer(''.join(lines), dtype=np.uint8)
+        chars = chars.reshape(len(lines), width)
+        used = np.concatenate(([0], chars.max(axis=0) > 32, [0]))
+        edges = np.flatnonzero(np.diff(used.astype(np.int8)))
+        if len(edges) < 18:
+            return None
+        tmp = []
+        for begin, end in zip(edges[0:18:2], edges[1:18:2]):
+            field = np.ascontiguousarray(chars[:, begin:end])
+            tmp.append(field.view('S%d' % (end - begin)).ravel())
+        return tmp
+
+    @staticmethod
+    def _split_free(lines):
+        """Slow path, for whitespace delimited atom records."""
+        natom = len(lines)
+        ncol = len(lines[0].split())
+        if ncol < 9:
+            raise IOError("Error when parsing atom section of psf, expected "
+                        "at least 9 columns, found %d" % ncol)
+        tokens = '\n'.join(lines).split()
+        if len(tokens) != natom * ncol:
+            raise IOError("Error when parsing atom section of psf, lines "
+                        "have an inconsistent number of columns")
+        return [ np.array(tokens[i::ncol]) for i in range(9) ]
+
+    @staticmethod
+    def _to_numeric(column, dtype):
+        tmp = np.fromstring(' '.join(column.tolist()), dtype=dtype, sep=' ')
+        if len(tmp) != len(column):
+            raise IOError("Error when parsing atom section of psf, found "
+                        "non-numeric data in a numeric field")
+        return tmp
+
+    def _parse_section(self, lines, i, keyword, counts):
+        """Decodes an integer section, and returns the index of the first line
+        following it.
+        """
+        for key, attr, width, per_line in self._sections:
+            if key == keyword:
+                break
+        else:
+            warnings.warn("Skipping unknown psf section: %r" % keyword)
+            return i
+        n = counts[0]
+        if keyword == 'molnt':
+            n = self.natoms
+        if keyword == 'ngrp' and len(counts) > 1:
+            self.nst2 = counts[1]
+        n_lines = -(-n // per_line)
+        data = self._read_ints(lines[i:i+n_lines], n * width, keyword)
+        if width > 1:
+            data = data.reshape(n, width)
+        if keyword != 'ngrp':
+            # group pointers are already 0-based on disk
+            data -= 1
+        setattr(self, attr, data)
+        return i + n_lines
+
+    def _parse_nnb(self, lines, i, nnb):
+        """Decodes the explicit nonbond exclusion list and its per atom
+        pointers. When the exclusion list is empty, CHARMM writes a blank
+        record in its place.
+        """
+        n_lines = -(-nnb // 8)
+        if not nnb and not lines[i].strip():
+            n_lines = 1
+        self.nonbond = self._read_ints(lines[i:i+n_lines], nnb, 'nnb') - 1
+        i += n_lines
+        n_lines = -(-self.natoms // 8)
+        self.iblo = self._read_ints(lines[i:i+n_lines], self.natoms, 'iblo')
+        return i + n_lines
+
+    def _parse_lone_pairs(self, lines, i, numlp, numlph):
+        """Lone pair information is retained as raw text, so that it can be
+        written back out unmodified.
+        """
+        n_lines = numlp + -(-numlph // 8)
+        self.lone_pair = (numlp, numlph, lines[i:i+n_lines])
+        return i + n_lines
+
+    @staticmethod
+    def _read_ints(lines, n, keyword):
+        tmp = np.fromstring(' '.join(lines), dtype=np.int64, sep=' ')
+        if len(tmp) != n:
+            raise IOError("Error when parsing %s section of psf, expected %d "
+                        "values, found %d" % (keyword, n, len(tmp)))
+        return tmp
+
+    # Public API ##############################################################
+    @property
+    def natoms(self):
+        try:
+            return len(self.atom)
+        except TypeError:
+            return 0
+
+    @property
+    def ext(self):
+        return 'ext' in self.flags
+
+    @property
+    def xplor(self):
+        return 'xplor' in self.flags
+
+    def select(self, mask=None, **kwargs):
+        """Returns a sorted array of 0-based atom indices, suitable for
+        indexing coordinate arrays. Atoms are selected by matching any number
+        of :attr:`atom_dt` fields, each keyword value may be a single value
+        or a sequence of acceptable values. An additional boolean `mask` may
+        also be specified.
+
+        >>> psf.select(segid='a', atomType=('n', 'ca', 'c', 'o'))
+        """
+        if mask is None:
+            mask = np.ones(self.natoms, dtype=np.bool)
+        else:
+            mask = np.array(mask, dtype=np.bool)
+        for key, value in kwargs.iteritems():
+            if key not in self.atom_dt.names:
+                raise KeyError("Invalid atom field: %r" % key)
+            if isinstance(value, basestring) or not hasattr(value, '__iter__'):
+                value = [value]
+            mask &= np.in1d(self.atom[key], np.array(value,
+                                                dtype=self.atom[key].dtype))
+        return np.flatnonzero(mask)
+
+    def is_compatible(self, dcd):
+        """Checks that a :class:`DCDFile` (or any object with a `natoms`
+        attribute) describes the same number of atoms as this topology.
+        """
+        return dcd.natoms == self.natoms
+
+    # Writing #################################################################
+    def pack(self):
+        if self.atom is None:
+            raise ValueError("No atom data to write")
+        if self.natoms > 99999 or self._long_names():
+            self.flags.add('ext')
+        if self.cross_term is not None and len(self.cross_term):
+            self.flags.add('cmap')
+        if not np.char.isdigit(self.atom['chemType']).all():
+            self.flags.add('xplor')
+        ifmt = self.ext and '%10d' or '%8d'
+        tmp = []
+        tmp.append(' '.join(['PSF'] + sorted(f.upper() for f in self.flags)))
+        tmp.append('')
+        title = self.title or ['A blank title.']
+        tmp.append('%s !NTITLE' % (ifmt % len(title)))
+        tmp.extend('* %s' % line for line in title)
+        tmp.append('')
+        tmp.append('%s !NATOM' % (ifmt % self.natoms))
+        tmp.append(self._pack_atoms())
+        tmp.append('')
+        for key, attr, width, per_line in self._sections:
+            data = getattr(self, attr)
+            if key == 'ncrterm':
+                tmp.extend(self._pack_lone_pairs())
+            if data is None and key in ('molnt', 'ncrterm'):
+                continue
+            if data is None:
+                data = np.zeros((0, width), dtype=np.int64)
+            data = np.array(data, dtype=np.int64).reshape(-1, width)
+            if key == 'ngrp':
+                label = '%s%s !NGRP NST2' % (ifmt % len(data),
+                                            ifmt % self.nst2)
+            elif key == 'molnt':
+                data = data + 1
+                label = '%s !MOLNT' % (ifmt % data.max())
+            else:
+                data = data + 1
+                label = '%s %s' % (ifmt % len(data), self._section_labels[key])
+            tmp.append(label)
+            tmp.append(self._pack_ints(data, per_line * width))
+            if key == 'nnb':
+                iblo = self.iblo
+                if iblo is None:
+                    iblo = np.zeros(self.natoms, dtype=np.int64)
+                tmp.append(self._pack_ints(iblo, 8))
+            tmp.append('')
+        tmp.append('')
+        return '\n'.join(tmp)
+
+    def write_all(self):
+        self.write(self.pack())
+
+    def _long_names(self):
+        if not len(self.atom):
+            return False
+        for key in ('segid', 'resid', 'resName', 'atomType', 'chemType'):
+            if np.char.str_len(self.atom[key]).max() > 4:
+                return True
+        return False
+
+    def _pack_lone_pairs(self):
+        if self.lone_pair is None:
+            return []
+        numlp, numlph, lines = self.lone_pair
+        ifmt = self.ext and '%10d' or '%8d'
+        tmp = ['%s%s !NUMLP NUMLPH' % (ifmt % numlp, ifmt % numlph)]
+        tmp.extend(line.upper() for line in lines)
+        tmp.append('')
+        return tmp
+
+    def _pack_atoms(self):
+        if self.ext:
+            fmt = '%10d %-8s %-8s %-8s %-8s %-6s %14.6f%14.4f%8d'
+        elif self.xplor:
+            fmt = '%8d %-4s %-4s %-4s %-4s %-4s %14.6f%14.4f%8d'
+        else:
+            fmt = '%8d %-4s %-4s %-4s %-4s %4s %14.6f%14.4f%8d'
+        atom = self.atom
+        columns = (atom['atomNum'], np.char.upper(atom['segid']),
+                np.char.upper(atom['resid']), np.char.upper(atom['resName']),
+                np.char.upper(atom['atomType']), np.char.upper(atom['chemType']),
+                atom['charge'], atom['mass'], atom['imove'])
+        return '\n'.join( fmt % row for row in zip(*[ c.tolist() for c in columns ]) )
+
+    def _pack_ints(self, data, per_line):
+        """Formats a flat integer array into lines of `per_line` values, the
+        full lines are formatted with a single string interpolation.
+        """
+        ifmt = self.ext and '%10d' or '%8d'
+        data = np.asarray(data).ravel().tolist()
+        n_full = len(data) // per_line
+        tmp = ((ifmt * per_line + '\n') * n_full) % tuple(data[:n_full*per_line])
+        rest = data[n_full*per_line:]
+        if rest:
+            tmp += (ifmt * len(rest)) % tuple(rest)
+        return tmp.rstrip('\n')
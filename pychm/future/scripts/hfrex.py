@@ -1,10 +1,13 @@
 
 
+import os
 import os.path
-from collections import deque
 from contextlib import closing
+import warnings
 
-from pychm.future.tools import paragraphs, _myexpandpath, _myopenzip
+import numpy as np
+
+from pychm.future.tools import _myexpandpath, _myopenzip
 from pychm.future.io import open_dcd
 
 import pdb, sys
@@ -35,85 +38,231 @@ class LogEntry(object):
         return "%s(%r, %r, %r)" % (self.__class__.__name__, self.exchange, self.step, self.repeat)
 
     def __len__(self):
-        return len(self.body)
+        return len(self.index_array)
+
+
+def _iter_line_blocks(fp, size):
+    """Reads a file-like object `size` bytes at a time, and yields lists of
+    complete lines, without line endings."""
+    tail = ''
+    while 1:
+        data = fp.read(size)
+        if not data:
+            break
+        lines = (tail + data).split('\n')
+        tail = lines.pop()
+        yield lines
+    if tail:
+        yield [tail]
 
 
 class ExchangeLog(object):
+    """A replica exchange log, parsed into arrays. The log is streamed once,
+    without holding its text in memory, and the result is stored in:
+
+    ============ ===============================================================
+    attribute    contents
+    ------------ ---------------------------------------------------------------
+    exchange     (nexchanges,) exchange numbers
+    step         (nexchanges,) step of each exchange
+    repeat       (nexchanges,) repeat count of each exchange
+    index        (nexchanges, nreplicas) 1-based replica index at each
+                 temperature, one row per exchange
+    data         (nexchanges, nreplicas, ncolumns) every column of the log
+                 body as floats, acceptance flags such as T/F are mapped to 1/0
+    energy       (nexchanges, nreplicas) third column of the body, or `None`
+    accepted     (nexchanges, nreplicas) fourth column of the body as booleans,
+                 or `None`
+    ============ ===============================================================
+
+    Unless `cache=False`, the arrays are saved to a sidecar file, named by
+    appending '.npz' to the log file name, which is loaded instead of the log
+    as long as the size and modification time of the log are unchanged.
+    Compressed logs are opened with :func:`_myopenzip`, see `ftype`.
     """
-    """
-    def __init__(self, fname, validate=True, ftype=None):
-        self.text = self._init_text(fname, ftype)
-        self._validate_text()
-        self.header = self.text.popleft()
-        self.log = self.parse_log()
+    block_size = 1 << 22
+
+    _flags = {'t': '1', 'true': '1', 'yes': '1', 'y': '1',
+            'f': '0', 'false': '0', 'no': '0', 'n': '0'}
+    _flag_map = dict( (case(key), value) for key, value in _flags.iteritems()
+                    for case in (str.lower, str.upper, str.capitalize) )
+
+    def __init__(self, fname, validate=True, ftype=None, cache=True):
+        self.fname = fname
+        self.header = None
+        if not (cache and self._load_cache()):
+            self._parse(fname, ftype)
+            if cache:
+                self._save_cache()
         if validate:
             self._validate_log()
 
     @property
     def temp_array(self):
         try:
-            return self.log[0].temp_array
+            return tuple(self.data[0, :, 1].tolist())
         except IndexError:
             return None
 
-    def _init_text(self, fname, ftype):
-        """open input file, normalize the text, dump it to a deque"""
+    @property
+    def nreplicas(self):
+        return self.data.shape[1]
+
+    @property
+    def energy(self):
+        if self.data.shape[2] > 2:
+            return self.data[:, :, 2]
+        return None
+
+    @property
+    def accepted(self):
+        if self.data.shape[2] > 3:
+            return self.data[:, :, 3] != 0
+        return None
+
+    def _parse(self, fname, ftype):
+        """Streams the log in large blocks of lines. The exchange headers of a
+        block are parsed individually, and all of its body lines are converted
+        to floats at once.
+        """
+        heads = []
+        chunks = []
+        carry = []
         with closing(_myopenzip(fname, ftype=ftype)) as inp_fp:
-            iterator = ( line.lower() for line in inp_fp )
-            iterator = ( line.strip() for line in iterator )
-            iterator = ( line for line in iterator if line )
-            return deque(iterator)
-
-    def _validate_text(self):
-        """check if the header exists, and check if exchange delimeters exist"""
-        if not self.text[0].startswith('#'):
+            for lines in _iter_line_blocks(inp_fp, self.block_size):
+                lines = carry + lines
+                hpos = [ i for i, line in enumerate(lines) if '#' in line ]
+                if self.header is None:
+                    if not hpos or lines[hpos[0]].strip()[:1] != '#' or \
+                            lines[:hpos[0]] != [''] * hpos[0]:
+                        raise LogError('Bad formatting, missing log file header, should be one line and start with "#".')
+                    self.header = lines[hpos[0]].strip().lower()
+                    lines = lines[hpos[0]+1:]
+                    hpos = [ i - hpos[0] - 1 for i in hpos[1:] ]
+                # the last exchange may continue in the next block
+                if hpos:
+                    carry = lines[hpos[-1]:]
+                    lines = lines[:hpos[-1]]
+                    hpos = hpos[:-1]
+                else:
+                    carry = lines
+                    continue
+                chunks.append(self._convert(lines, hpos, heads))
+        if carry:
+            hpos = [ i for i, line in enumerate(carry) if '#' in line ]
+            chunks.append(self._convert(carry, hpos, heads))
+        if self.header is None:
             raise LogError('Bad formatting, missing log file header, should be one line and start with "#".')
-        if not self.text[1].startswith('# exchange'):
+        chunks = [ chunk for chunk in chunks if chunk.size ]
+        if not chunks:
+            raise LogError("Can't determine length of first log element.")
+        shapes = set( chunk.shape[1:] for chunk in chunks )
+        if len(shapes) != 1:
+            raise LogError("Log elements do not all have the same shape: %r" % sorted(shapes))
+        self.data = np.concatenate(chunks)
+        heads = np.array(heads, dtype=np.int64).reshape(-1, 3)
+        self.exchange, self.step, self.repeat = heads.T.copy()
+        self.index = self.data[:, :, 0].astype(np.int64)
+
+    def _convert(self, lines, hpos, heads):
+        """Parses the exchange headers at positions `hpos` of `lines` into
+        `heads`, and returns the body lines as a (nexchanges, nreplicas,
+        ncolumns) float array.
+        """
+        if not hpos:
+            if ''.join(lines).strip():
+                raise LogError('Bad formatting, missing exchange delimeter, should be one line and start with "# Exchange".')
+            return np.zeros((0, 0, 0))
+        if ''.join(lines[:hpos[0]]).strip():
             raise LogError('Bad formatting, missing exchange delimeter, should be one line and start with "# Exchange".')
+        for i in hpos:
+            tmp = lines[i].lower().split()
+            if tmp[:2] != ['#', 'exchange']:
+                raise LogError('Bad formatting, missing exchange delimeter, should be one line and start with "# Exchange".')
+            try:
+                heads.append((int(tmp[2][:-1]), int(tmp[4][:-1]), int(tmp[6])))
+            except (IndexError, ValueError):
+                raise LogError("Bad formatting, can't parse exchange delimeter: %r" % lines[i])
+            lines[i] = ''
+        lines = lines[hpos[0]:]
+        hpos = [ i - hpos[0] for i in hpos ]
+        # blank lines, and the blanked headers, are not body lines
+        blank = np.array([ not line.strip() for line in lines ])
+        nlines = np.diff(hpos + [len(lines)]) - np.add.reduceat(blank, hpos)
+        bad = np.flatnonzero(nlines != nlines[0])
+        if len(bad):
+            raise LogError("Element %d in log does not have the correct length of %d" % (len(heads) - len(hpos) + bad[0], nlines[0]))
+        nrep = int(nlines[0])
+        text = ' '.join(lines)
+        first = lines[np.argmin(blank)].split() if nrep else []
+        ncol = len(first)
+        # flags, such as T/F, are mapped to 1/0
+        if [ token for token in first if token in self._flag_map ]:
+            text = ' %s ' % text
+            for token, value in self._flag_map.iteritems():
+                token = ' %s ' % token
+                # repeat, as adjacent flags share a space
+                while token in text:
+                    text = text.replace(token, ' %s ' % value)
+        tmp = np.fromstring(text, dtype=np.float64, sep=' ')
+        if len(tmp) != len(hpos) * nrep * ncol:
+            raise LogError("Bad formatting, log body lines must all have %d numeric columns" % ncol)
+        return tmp.reshape(len(hpos), nrep, ncol)
 
     def _validate_log(self):
-        """checks if all log entries are the same length, and have the same
-        temp_array the way the temp_array is checked is pretty lazy. this might
-        have to change to account for floating point rounding. running this
-        method in the constructor is the default, but can be shut off by
+        """checks that all log entries have the same temperature array. running
+        this method in the constructor is the default, but can be shut off by
         setting the keyword `validate=False`"""
+        temps = self.data[:, :, 1]
+        bad = np.flatnonzero((temps != temps[0]).any(axis=1))
+        if len(bad):
+            raise LogError("Element %d in log does not have the correct temperature array of %r" % (bad[0], self.temp_array))
+
+    # sidecar cache ###########################################################
+    def _cache_key(self):
+        stat = os.stat(self.fname)
+        return np.array([stat.st_size, int(stat.st_mtime * 1e6)], dtype=np.int64)
+
+    def _load_cache(self):
         try:
-            length = len(self.log[0])
-        except IndexError:
-            raise LogError("Can't determine length of first log element.")
+            with closing(np.load(self.fname + '.npz')) as tmp:
+                if not (tmp['key'] == self._cache_key()).all():
+                    return False
+                self.header = str(tmp['header'])
+                self.exchange = tmp['exchange']
+                self.step = tmp['step']
+                self.repeat = tmp['repeat']
+                self.data = tmp['data']
+        except (IOError, OSError, KeyError, ValueError):
+            return False
+        self.index = self.data[:, :, 0].astype(np.int64)
+        return True
+
+    def _save_cache(self):
         try:
-            temp = self.log[0].temp_array
-        except AttributeError:
-            raise LogError("First log element has no temp_array attribute")
-        for i, entry in enumerate(self.log):
-            if length != len(entry):
-                raise LogError("Element %d in log does not have the correct length of %d" % (i, length))
-            if temp != entry.temp_array:
-                raise LogError("Element %d in log does not have the correct temperature array of %r" % (i, temp))
-
-    def parse_log(self):
-        """read through self.text, instantiate LogEntry objects and return a
-        list of them"""
-        def _parse_entry(iterable):
-            tmp = LogEntry()
-            # parse values from exchange header
-            header = iterable[0].split()
-            tmp.exchange = int(header[2][:-1])
-            tmp.step = int(header[4][:-1])
-            tmp.repeat = int(header[6])
-            tmp.body = iterable[1:]
-            tmp._parse_body()
-            return tmp
-        tmp = []
-        for entry in paragraphs(self.text, "# exchange"):
-            tmp.append(_parse_entry(entry))
+            with open(self.fname + '.npz', 'wb') as fp:
+                np.savez(fp, key=self._cache_key(), header=np.array(self.header),
+                        exchange=self.exchange, step=self.step,
+                        repeat=self.repeat, data=self.data)
+        except (IOError, OSError):
+            warnings.warn("Unable to write exchange log cache: %s.npz" % self.fname)
+
+    # compatibility with the LogEntry interface ###############################
+    def __getitem__(self, i):
+        tmp = LogEntry()
+        tmp.exchange = int(self.exchange[i])
+        tmp.step = int(self.step[i])
+        tmp.repeat = int(self.repeat[i])
+        tmp.index_array = tuple(self.index[i].tolist())
+        tmp.temp_array = tuple(self.data[i, :, 1].tolist())
         return tmp
 
     def __iter__(self):
-        return iter(self.log)
+        for i in xrange(len(self)):
+            yield self[i]
 
     def __len__(self):
-        return len(self.log)
+        return len(self.step)
 
 def get_nsavc(*fnames):
     if not fnames:
@@ -123,15 +272,66 @@ def get_nsavc(*fnames):
         with open_dcd(fname, mode='r') as fp:
             nsavc_array.append(fp.nsavc)
     nsavc0 = nsavc_array[0]
-    for nsavc in nsavc_array:
+    for fname, nsavc in zip(fnames, nsavc_array):
         if nsavc != nsavc0:
-            raise ValueError('bad value for nsavc, first dcd has nsavc = %d but dcd file "%s" has value of %d' % (nsavc, dcd_fnames[i], nsav))
+            raise ValueError('bad value for nsavc, first dcd has nsavc = %d but dcd file "%s" has value of %d' % (nsavc0, fname, nsavc))
     return nsavc0
 
+def rex_table(rexlog, nsavc, nframes):
+    """Returns a (nframes, nreplicas) array, whose row k holds the 0-based
+    replica index at each temperature, for the k-th frame saved by every
+    replica. Frame k is saved at step (k + 1) * nsavc, and belongs to the first
+    exchange logged at or after that step. Each exchange entry lists the
+    replica order in effect before the attempt, so when an exchange is repeated
+    at a step, the first entry describes the frames written since the previous
+    exchange, and the repeats are reflected in the next step's first entry.
+    Frames saved after the last exchange are not covered by the log and are
+    not included, so the table may hold fewer than `nframes` rows.
+    """
+    bad = np.flatnonzero(rexlog.step % nsavc)
+    if len(bad):
+        raise ValueError("bad value for nsavc, is not multiple of step %d in exchangelog entry %d" % (rexlog.step[bad[0]], rexlog.exchange[bad[0]]))
+    if (np.diff(rexlog.step) < 0).any():
+        i = np.flatnonzero(np.diff(rexlog.step) < 0)[0] + 1
+        raise LogError("exchangelog entry %d goes back in time to step %d" % (rexlog.exchange[i], rexlog.step[i]))
+    # the first entry logged at each step
+    first = np.concatenate(([True], np.diff(rexlog.step) != 0))
+    steps = rexlog.step[first]
+    index = rexlog.index[first] - 1
+    frame_steps = (np.arange(nframes, dtype=np.int64) + 1) * nsavc
+    owner = np.searchsorted(steps, frame_steps, side='left')
+    return index[owner[owner < len(steps)]]
+
+def _iter_runs(column):
+    """Yields (begin, end, value) for each run of equal values in `column`."""
+    if not len(column):
+        return
+    edges = np.flatnonzero(np.diff(column)) + 1
+    begins = np.concatenate(([0], edges))
+    ends = np.concatenate((edges, [len(column)]))
+    for begin, end in zip(begins, ends):
+        yield begin, end, column[begin]
+
 ###############################################################################
 # work time ###################################################################
 ###############################################################################
-def rex_map(log_fname, out_dir, dcd_fnames, log_ftype='auto'):
+def rex_map(log_fname, out_dir, dcd_fnames, log_ftype='auto', by='temperature',
+            block_size=1 << 22):
+    """Demultiplexes the trajectories of a replica exchange run. The input dcd
+    files are the continuous trajectories of each replica, in replica order.
+    With `by='temperature'` (default) one output trajectory is written per
+    temperature, named rex_map_<index>_<temperature>.dcd. With
+    `by='replica'` the inputs are instead taken to be per temperature
+    trajectories, such as the output of a previous run, and one continuous
+    trajectory is written per replica, named rex_map_replica_<index>.dcd.
+
+    The full frame permutation table is computed up front from the exchange
+    log (see :func:`rex_table`), then each output is assembled from runs of
+    consecutive frames taken from the same input, copied from memory mapped
+    inputs with one write per run, in pieces of at most `block_size` bytes
+    (or one frame, if larger).
+    Returns the list of output file names.
+    """
     # validate inputs
     if not isinstance(log_fname, basestring):
         raise TypeError("invalid log_fname")
@@ -139,53 +339,72 @@ def rex_map(log_fname, out_dir, dcd_fnames, log_ftype='auto'):
         raise TypeError("invalid out_dir")
     if not dcd_fnames:
         raise ValueError("must specify input dcd files")
+    if by not in ('temperature', 'replica'):
+        raise ValueError("invalid value for by: %r" % by)
     # parse rexlog
     rexlog = ExchangeLog(fname=log_fname, validate=True, ftype=log_ftype)
+    if len(rexlog.temp_array) != len(dcd_fnames):
+        raise ValueError("exchangelog has %d replicas, but %d dcd files were specified" % (len(rexlog.temp_array), len(dcd_fnames)))
     # parse nsavc value
     nsavc = get_nsavc(*dcd_fnames)
-    # make nsavc is compatible with step values from log
-    for entry in rexlog:
-        if entry.step % nsavc != 0:
-            raise ValueError("bad value for nsavc, is not multiple of step %d in exchangelog entry %d" % (entry.step, entry.exchange))
-    # create output fnames
-    out_dcd_fnames = []
-    for i, temp in enumerate(rexlog.temp_array):
-        fname = _myexpandpath(out_dir) + os.path.sep + 'rex_map_%02d_%6.2f.dcd' % (i, temp)
-        out_dcd_fnames.append(fname)
-    # write headers
-    with open_dcd(dcd_fnames[0], mode='r') as fp:
-        base_header = fp.export_header()
-    for fname in out_dcd_fnames:
-        with open_dcd(fname, mode='wb') as fp:
-            tmp_header = {}
-            tmp_header.update(base_header)
-            tmp = ["\x02\x00\x00\x00"]
-            tmp.append("%-80s" % "* This DCD was generated by rex_map")
-            tmp.append("%-80s" % "* This DCD index is %d, and temp is %d" % (i,rexlog.temp_array[i]))
-            tmp_header['title'] = ''.join(tmp)
-            fp.import_header(tmp_header)
-            fp.write_header()
-    # write frames
-    inp_dcd = [ open_dcd(fname, mode='rb') for fname in dcd_fnames ]
-    out_dcd = [ open_dcd(fname, mode='ab') for fname in out_dcd_fnames ]
-    ## ignore entries where repeat != 1
-    iterator = ( entry for entry in rexlog if entry.repeat == 1 )
-    current_step = 0 # how many steps have we written?
-    for entry in iterator:
-#        print "exchange number: %d" % entry.exchange
-        while current_step < entry.step:
-#            print "  step number: %d" % (current_step + nsavc)
-            ###################
-            # do work #########
-            ###################
-            for i, out in enumerate(out_dcd):
-#                print "    reading from: %s" % dcd_fnames[entry.index_array[i]-1]
-#                print "    writing to: %s" % out.name
-                out.write(inp_dcd[entry.index_array[i]-1].read_frame())
-            ##################
-            # done with work #
-            ##################
-            current_step += nsavc
+    # open inputs, and build the permutation table
+    inp_dcd = [ open_dcd(fname, mode='r') for fname in dcd_fnames ]
+    try:
+        nframes = min( fp.count_frames() for fp in inp_dcd )
+        table = rex_table(rexlog, nsavc, nframes)
+        if by == 'replica':
+            table = np.argsort(table, axis=1)
+        if len(table) < nframes:
+            warnings.warn("%d frames saved after the last exchange were skipped" % (nframes - len(table)))
+        # create output fnames
+        out_dcd_fnames = []
+        for i, temp in enumerate(rexlog.temp_array):
+            if by == 'temperature':
+                fname = 'rex_map_%02d_%6.2f.dcd' % (i, temp)
+            else:
+                fname = 'rex_map_replica_%02d.dcd' % i
+            out_dcd_fnames.append(_myexpandpath(out_dir) + os.path.sep + fname)
+        # raw frames can be copied when every input has the same layout
+        frame_dt = inp_dcd[0].frame_dt
+        raw = all( fp.frame_dt == frame_dt and not fp.nfix for fp in inp_dcd )
+        if not len(table):
+            src = []
+        elif raw:
+            src = [ np.memmap(fp.name, dtype=fp.frame_dt, mode='r', offset=fp.header_size, shape=(len(table),)) for fp in inp_dcd ]
+        else:
+            src = [ fp.memmap() for fp in inp_dcd ]
+            xtl = [ view.xtl for view in src ]
+        # frames per piece, from the bytes each frame takes in memory
+        if raw:
+            nbytes = [ fp.frame_size for fp in inp_dcd ]
+        else:
+            nbytes = [ 3 * fp.natoms * view.dtype.itemsize for fp, view in zip(inp_dcd, src) ]
+        piece = [ max(1, block_size // n) for n in nbytes ]
+        for i, fname in enumerate(out_dcd_fnames):
+            # raw frames keep the byte order and record markers of the inputs
+            with open_dcd(fname, mode='w', endian=inp_dcd[0].ENDIAN,
+                        rec_head_prec=inp_dcd[0].REC_HEAD_PREC) as out:
+                out.import_header(inp_dcd[0].export_header())
+                out.nframes = 0
+                out.nsteps = 0
+                # replicas may differ in their fixed atoms, so write them all
+                out.nfix = 0
+                out.free_atoms = None
+                out.title = ["* This DCD was generated by rex_map",
+                            "* This DCD %s index is %d, and temp is %.2f" % (by, i, rexlog.temp_array[i])]
+                out.title_lines = len(out.title)
+                out.write_header()
+                for begin, end, j in _iter_runs(table[:, i]):
+                    for first in xrange(begin, end, piece[j]):
+                        last = min(first + piece[j], end)
+                        if raw:
+                            out.write_nparray(src[j][first:last])
+                        else:
+                            out.write_frames(src[j][first:last], xtl=None if xtl[j] is None else xtl[j][first:last])
+    finally:
+        for fp in inp_dcd:
+            fp.close()
+    return out_dcd_fnames
 
 ###############################################################################
 # inputs ######################################################################
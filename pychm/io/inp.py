@@ -4,12 +4,19 @@
 """
 
 
-from commands import getstatusoutput
+from os import stat
 from os.path import abspath, dirname, expanduser, exists
-from tempfile import NamedTemporaryFile
+from pychm.const.units import FEMTOSECOND
+from pychm.future.io.charmm.dcd import open_dcd
 from pychm.tools import Property, expandPath, lowerKeys, mkdir
 
 
+_dcdQueryCache = {}
+"""
+Maps .dcd file names to the (size, mtime, result) of their last query.
+"""
+
+
 class INPFile(object):
     """
     A base class for writing CHARMM .inp text files within pychmlib.
@@ -17,7 +24,8 @@ class INPFile(object):
 
     This class provides functionality and book keeping for data common
     to nearly all CHARMM jobs, such as tracking .rtf, .prm, .psf and
-    .crd file locations, writing .inp file headers and querying .dcd files.
+    .crd file locations, writing .inp file headers and querying .dcd file
+    headers.
 
     **Class Attributes:**
         | ``defaultBin``
@@ -207,9 +215,8 @@ class INPFile(object):
     def maxatom():
         doc =\
         """
-        If a valid .dcd file and valid charmmBin are specified, this
-        ``property`` will return the number of atoms present in the
-        trajectory.
+        If a valid .dcd file is specified, this ``property`` will return
+        the number of atoms present in the trajectory.
         """
         def fget(self):
             return self._maxatom
@@ -219,9 +226,8 @@ class INPFile(object):
     def nstep():
         doc =\
         """
-        If a valid .dcd file and valid charmmBin are specified, this
-        ``property`` will return the number of frames present in the
-        trajectory.
+        If a valid .dcd file is specified, this ``property`` will return
+        the number of steps present in the trajectory.
         """
         def fget(self):
             return self._nstep
@@ -231,8 +237,8 @@ class INPFile(object):
     def timestep():
         doc =\
         """
-        If a valid .dcd file and valid charmmBin are specified, this
-        ``property`` will return the timestep used in the trajectory.
+        If a valid .dcd file is specified, this ``property`` will return
+        the timestep in fs used in the trajectory.
         """
         def fget(self):
             return self._timestep
@@ -303,47 +309,32 @@ class INPFile(object):
 
     def query_dcd(self, dcdFilename=None):
         """
-        Queries a .dcd file using the specified ``charmmBin`` and
-        returns a 3-tuple of integers corresponding to the number of
-        atoms, the number of steps, and the timestep in fs of the
-        specified .dcd file.  Defaults to ``self.dcdFilename``.
+        Queries the header of a .dcd file and returns a 3-tuple of
+        integers corresponding to the number of atoms, the number of
+        steps, and the timestep in fs of the specified .dcd file.
+        Defaults to ``self.dcdFilename``.
+
+        Results are cached for the life of the process, and are reread
+        when the size or modification time of the file changes.
         """
         if dcdFilename is None:
             dcdFilename = self.dcdFilename
         else:
             dcdFilename = self.expandPath(dcdFilename)
-        # tmp file
-        tmp = NamedTemporaryFile()
-        tmpOut = []
-        tmpOut.append('* trj query')
-        tmpOut.append('*')
-        tmpOut.append('open unit 10 read unform name %s' % dcdFilename)
-        tmpOut.append('traj query unit 10')
-        tmpOut.append('stop')
-        tmpOut = '\n'.join(tmpOut)
-        tmp.file.write(tmpOut)
-        tmp.file.flush()
-        # execute charmm
-        charmmOut = getstatusoutput('%s < %s' % (self.charmmBin, tmp.name))[1].split('\n')
-        # parse output
-        nCrd = None
-        freq = None
-        nDeg = None
-        nFix = None
-        ts = None
-        iterator = ( line.strip().lower() for line in charmmOut )
-        for line in iterator:
-            if line.startswith('number of coordinate'):
-                nCrd = int(line.split()[-1])
-            elif line.startswith('frequency'):
-                freq = int(line.split()[-1])
-            elif line.startswith('number of degrees of freedom'):
-                nDeg = int(line.split()[-1])
-            elif line.startswith('number of fixed atoms'):
-                nFix = int(line.split()[-1])
-            elif line.startswith('the integration time'):
-                ts = float(line.split()[-1])
-        maxatom = int(nDeg / 3 + nFix) + 1
-        nstep = int(nCrd * freq)
-        timestep = int(ts * 1000)
+        st = stat(dcdFilename)
+        key = (st.st_size, st.st_mtime)
+        try:
+            cached = _dcdQueryCache[dcdFilename]
+            if cached[:2] == key:
+                return cached[2]
+        except KeyError:
+            pass
+        dcd = open_dcd(dcdFilename, mode='r')
+        try:
+            maxatom = int(dcd.natoms)
+            nstep = int(dcd.count_frames() * dcd.nsavc)
+            timestep = int(round(dcd.del_t / FEMTOSECOND))
+        finally:
+            dcd.close()
+        _dcdQueryCache[dcdFilename] = key + ((maxatom, nstep, timestep),)
         return (maxatom, nstep, timestep)
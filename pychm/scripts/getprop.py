@@ -11,8 +11,11 @@ A command line CHARMM output file parser.
 """
 
 
+import multiprocessing
 import sys
-from pychm.tools import paragraphs
+import zlib
+from array import array
+import numpy as np
 
 
 propPrefixes = ['dyna','aver','fluc','lave','lflc']
@@ -56,16 +59,64 @@ def parse_prop(prop):
             raise TypeError('parse_prop: invalid suffix %s' % prop[4:])
 
 
+def openOutput(fileName, chunkSize=2**20):
+    """
+    Returns an iterator over the lines of the CHARMM output file
+    `fileName`. Gzipped files, recognised by their magic number, are
+    inflated with :mod:`zlib` in chunks of `chunkSize` bytes, which is much
+    faster than :func:`gzip.open`.
+    """
+    filePointer = open(fileName, 'rb')
+    if filePointer.read(2) != '\x1f\x8b':
+        filePointer.seek(0)
+        return filePointer
+    filePointer.seek(0)
+    return _gzipLines(filePointer, chunkSize)
+
+
+def _gzipLines(filePointer, chunkSize):
+    try:
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        tail = ''
+        while 1:
+            raw = filePointer.read(chunkSize)
+            if not raw:
+                break
+            data = inflater.decompress(raw)
+            # concatenated gzip members
+            while inflater.unused_data:
+                raw = inflater.unused_data
+                inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += inflater.decompress(raw)
+            lines = (tail + data).splitlines(True)
+            if lines and not lines[-1].endswith('\n'):
+                tail = lines.pop()
+            else:
+                tail = ''
+            for line in lines:
+                yield line
+        if tail:
+            yield tail
+    finally:
+        filePointer.close()
+
+
 def getProp(iterable,*props,**kwargs):
     """
     Returns a dictionary whose keys are the requested properties, and
-    whose values are list(prop(t)).  Two key/value pairs are created
-    per property: propX and propX_time.
+    whose values are :class:`numpy.ndarray` prop(t).  Two key/value pairs
+    are created per property: propX and propX_time.
+
+    The output is read in a single pass, and DYNA/AVER/FLUC/LAVE/LFLC blocks
+    are recognised by their line prefix, so any number of properties cost
+    about the same as one.  The header, and the block of step 0, are
+    skipped.
 
     Usage: getProp(iterable,props*)
     Example:
     >>> getProp(open('charmm.out'),'averener','dynavdw')
-    
+    >>> getProp(openOutput('charmm.out.gz'),'averener','dynavdw')
+
     Each prop is of the form prefixsuffix, for example 'avertote'
 
     Valid prefixes are:
@@ -91,41 +142,108 @@ def getProp(iterable,*props,**kwargs):
         stopIter = int(kwargs['stopIter'])
     else:
         stopIter = None
-    # Initialize Lists
+    # Growable typed buffers, viewed as arrays at the end
+    values = {}
+    times = {}
+    wanted = {}
+    for prop, prefix, suffix in propList:
+        values[prop] = array('d')
+        times[prop] = array('l')
+        lineNum, start, stop = propSuffixes[suffix]
+        tmp = wanted.setdefault(prefix, [ [] for i in xrange(5) ])
+        tmp[lineNum].append((values[prop].append, times[prop].append, start, stop))
+    # State machine, one pass over the lines.  `paragraph` counts the
+    # DYNA> steps, data is kept from paragraph 2 on (0 is the header, 1 is
+    # step 0).  A block starts at a DYNA> line or after a ' ----------'
+    # line, and its lines not starting with a space are numbered from 0.
+    # `targets` holds the wanted properties of each line of the block.
+    paragraph = None
+    targets = None
+    lineNum = 0
+    for line in iterable:
+        if line[:1] == ' ':
+            if line[:11] == ' ----------':
+                targets = ()
+            elif line[:6] == ' DYNA>':
+                if paragraph is None:
+                    paragraph = -1
+                paragraph += 1
+                if stopIter and paragraph - 2 >= stopIter:
+                    break
+                targets = ()
+            continue
+        if line[:5] == 'DYNA>':
+            if paragraph is None:
+                # no header, the first step is discarded in its place
+                paragraph = -1
+            paragraph += 1
+            if stopIter and paragraph - 2 >= stopIter:
+                break
+            targets = ()
+        elif paragraph is None:
+            paragraph = 0
+            continue
+        if targets is None:
+            continue
+        if targets == ():
+            if paragraph < 2 or line.startswith('AVER DYN'):
+                # step 0, or label block
+                targets = None
+                continue
+            targets = wanted.get(line[0:4].lower())
+            if targets is None:
+                continue
+            lineNum = 0
+        else:
+            lineNum += 1
+        if lineNum < 5:
+            for appendValue, appendTime, start, stop in targets[lineNum]:
+                appendTime(paragraph - 1)
+                appendValue(float(line[start:stop]))
     outDict = {}
-    for prop in propList:
-        outDict['%s_time' % prop[0]] = []
-        outDict[prop[0]] = []
-    stepIterator = paragraphs(iterable, ['DYNA>', ' DYNA>'])
-    stepIterator.next() # Discard Header
-    stepIterator.next() # Discard Step 0
-    # Do Work
-    for i,step in enumerate(stepIterator):
-        if stopIter:
-            if i >= stopIter:
-                return outDict
-        subSteps = paragraphs(step,[' ----------'])
-        for subStep in subSteps:
-            # Strip extraneous lines
-            tmp = [ line for line in subStep if not line.startswith(' ') ]
-            # Ignore empty blocks
-            if tmp:
-                # Ignore label block
-                if tmp[0].startswith('AVER DYN'):
-                    continue
-                tmpSuffix = tmp[0][0:4].lower()
-                for prop in propList:
-                    if prop[1] == tmpSuffix:
-                        lineNum,start,stop = propSuffixes[prop[2]]
-                        outDict['%s_time' % prop[0]].append(i + 1)
-                        outDict[prop[0]].append(float(tmp[lineNum][start:stop]))
+    for prop in props:
+        outDict['%s_time' % prop] = np.frombuffer(times[prop], dtype=np.int_)
+        outDict[prop] = np.frombuffer(values[prop], dtype=np.float64)
     return outDict
 
 
+def _getPropFile(args):
+    fileName, props, kwargs = args
+    return getProp(openOutput(fileName), *props, **kwargs)
+
+
+def getPropFiles(fileNames, *props, **kwargs):
+    """
+    Returns a list of the :func:`getProp` dictionaries of each file in
+    `fileNames`, read in a pool of `nproc` processes (default, one per
+    CPU), for example the .out files of every replica of a REX run.
+
+    Valid kwargs:
+        `stopIter` = int
+        `nproc` = int
+    """
+    kwargs = dict(kwargs)
+    nproc = kwargs.pop('nproc', None)
+    tasks = [ (fileName, props, kwargs) for fileName in fileNames ]
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    nproc = max(min(nproc, len(tasks)), 1)
+    if nproc == 1:
+        return map(_getPropFile, tasks)
+    pool = multiprocessing.Pool(nproc)
+    try:
+        return pool.map(_getPropFile, tasks)
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+
 if __name__ == '__main__':
 
 
-    import gzip
     import os
     from itertools import izip
 
@@ -146,15 +264,8 @@ if __name__ == '__main__':
         print helpString
         sys.exit(0)
 
-    # Create filepointer
-    if fileName.endswith('gz'):
-        print '\n\nWARNING - Operating on .gz files can be excruciatingly slow.\n\n'
-        filePointer = gzip.open(fileName)
-    else:
-        filePointer = open(fileName)
-
     # Main
-    outDict = getProp(filePointer, *props)
+    outDict = getProp(openOutput(fileName), *props)
     for prop in props:
         outFileName = '%s_%s.dat' % (os.path.basename(fileName), prop)
         print 'Writing data to %s' % outFileName
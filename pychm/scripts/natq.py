@@ -78,10 +78,11 @@ if 0:
 if 1:
 
 
-    from pychm.analysis.delg import DelG
+    from pychm.analysis.delg import DelG, DelGError
 
 
     delGList = []
+    delGErrList = []
     counts = []
     for i in xrange(len(dcdFileList)):
         taco.anlPathname = anlPath % (nscale, i)
@@ -92,10 +93,17 @@ if 1:
         burrito.addState('unfolded', 0, 0.5)
         burrito.count()
         delGList.append(burrito.get_DelG('unfolded', 'folded'))
+        # 95% block bootstrap confidence interval
+        try:
+            delGErrList.append(burrito.get_bootstrapCI('unfolded', 'folded'))
+        except DelGError:
+            delGErrList.append((np.nan, np.nan))
     # Filter out infinite energies (for plotting and regression)
     plotTemp = [ temp for i,temp in enumerate(tempList) if delGList[i] != np.inf ]
+    plotDelGErr = [ err for i,err in enumerate(delGErrList) if delGList[i] != np.inf ]
     plotDelG = [ delg for i,delg in enumerate(delGList) if delGList[i] != np.inf ]
     # Keep data where 250K < temp < 400K
+    plotDelGErr = [ err for i,err in enumerate(plotDelGErr) if 250. <= plotTemp[i] <= 400. ]
     plotDelG = [ delg for i,delg in enumerate(plotDelG) if 250. <= plotTemp[i] <= 400. ]
     plotTemp = [ temp for i,temp in enumerate(plotTemp) if 250. <= plotTemp[i] <= 400. ]
 
@@ -129,6 +137,7 @@ if 1:
 
         x = np.array(plotTemp)
         y = np.array(plotDelG)
+        yerr = np.abs(np.array(plotDelGErr).T - y)
 
         ## Initial parameter values
         paramArray_0 = np.array([16.8,300,0.28])
@@ -149,7 +158,8 @@ if 1:
         writeTo.close()
 
         X = linspace(x.min(),x.max(),len(x)*5)
-        pyplot.plot(x,y,'g^', X, residuals(paramArray,X),'k-')
+        pyplot.errorbar(x,y,yerr=yerr,fmt='g^')
+        pyplot.plot(X, residuals(paramArray,X),'k-')
         pyplot.xlabel(r'$Temperature\ (K)$')
         #pyplot.ylabel(r'$Radius\ of\ Gyration\ (\AA)$')
         pyplot.ylabel(r'$Gibbs\ Free\ Energy\ (kCal\ mol^-1)$')
@@ -16,28 +16,30 @@ Example Usage;
 import os
 import numpy as np
 import matplotlib.pyplot as pyplot
-from pychm.scripts.getprop import getProp
+from pychm.scripts.getprop import getPropFiles
 from pychm.tools import expandPath
 
 
-def rexHist(iterable, title, write=False, imgFilePath=None):
+def rexHist(iterable, title, write=False, imgFilePath=None, nproc=None):
     """
-    `iterable`  *string         # An iterable of the CHARMM .out files
+    `iterable`  *string         # An iterable of the CHARMM .out files,
+                                # plain or gzipped.
     `title`     string          # The title of the plot.
     `write`     [`False`,`"svg"`,`"png"`]   # The plot's output format,
                                             # False won't write a file.
     `imgFilePath` string        # The plot's file path, defaults
                                 # to `$cwd/default_title`.
+    `nproc`     int             # The number of files read in parallel,
+                                # defaults to one per CPU.
     """
     fileList = list(iterable)
     fileList = map(expandPath, fileList)
+    print 'Processing %d files...' % len(fileList)
+    rawDataList = getPropFiles(fileList, 'averener', 'avertemp', nproc=nproc)
     tempArray = []
-    for fileName in fileList:
-        print 'Processing %s...' % fileName
-        filePointer = open(fileName)
-        rawData = getProp(filePointer, 'averener', 'avertemp')
-        tempArray.append(np.array(rawData['avertemp']).mean()) # Calc Temp
-        histData = np.histogram(rawData['averener'], 20, new=True)
+    for fileName, rawData in zip(fileList, rawDataList):
+        tempArray.append(rawData['avertemp'].mean()) # Calc Temp
+        histData = np.histogram(rawData['averener'], 20)
         pyplot.plot(histData[1][1:],histData[0],label=os.path.basename(fileName))
     pyplot.legend( ['%3dK' % tempArray[i] for i in xrange(len(fileList))]
                 ,loc=0, ncol=2)
@@ -79,6 +81,8 @@ if __name__ == '__main__':
     optparser.add_option('-F', '--format', default=False,
                         choices=[False, 'svg', 'png'],
                         help='Format of output figure, default is not to save.')
+    optparser.add_option('-N', '--nproc', default=None, type='int', metavar='N',
+                        help='Read N .out files in parallel, default one per CPU.')
     # Parse
     (options, args) = optparser.parse_args(sys.argv)
     # Set defaults
@@ -100,4 +104,4 @@ if __name__ == '__main__':
             for i in xrange(len(outList)) ]
     #
     rexHist(outList, options.title, write=options.format,
-            imgFilePath=options.output)
+            imgFilePath=options.output, nproc=options.nproc)
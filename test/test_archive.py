@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Regression checks for :mod:`pychm.future.io.archive`.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+import numpy as np
+from pychm.future.io.archive import open_archive
+
+
+PRECISION = 0.001
+BLOCK_SIZE = 64
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp, 'traj.pca')
+        rng = np.random.RandomState(0)
+        # a random walk, like a trajectory, with some large jumps
+        self.xyz = np.cumsum(rng.randn(250, 50, 3), axis=0) + 20.
+        self.xyz[100] += 500.
+        self.xtl = rng.rand(250, 6) * 60.
+        arc = open_archive(self.fname, 'w', precision=PRECISION,
+                        block_size=BLOCK_SIZE)
+        try:
+            arc.write_frames(self.xyz[:10], xtl=self.xtl[:10])
+            arc.write_frames(self.xyz[10:], xtl=self.xtl[10:])
+        finally:
+            arc.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def open_quiet(self, fname):
+        """Opens `fname`, and returns it with the number of warnings."""
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            arc = open_archive(fname)
+        return arc, len(w)
+
+    def test_roundtrip(self):
+        arc, nwarn = self.open_quiet(self.fname)
+        try:
+            self.assertEqual(nwarn, 0)
+            self.assertEqual(arc.shape, self.xyz.shape)
+            self.assertEqual(arc.nblocks, 4)
+            got = arc[:]
+            err = np.abs(got - self.xyz).max()
+            # float32 output adds its own rounding, far below the precision
+            self.assertTrue(err <= PRECISION / 2 + 1e-4, err)
+            xtl = np.concatenate([ arc.read_block(i)[1] for i in xrange(arc.nblocks) ])
+            self.assertTrue((xtl == self.xtl).all())
+        finally:
+            arc.close()
+
+    def test_random_access(self):
+        arc = open_archive(self.fname)
+        try:
+            full = arc[:]
+            for i in (0, 63, 64, 100, 249, -1):
+                self.assertTrue((arc[i] == full[i]).all())
+            frames = [200, 3, 64, 3, 130]
+            self.assertTrue((arc[frames] == full[frames]).all())
+            self.assertTrue((arc[frames, [7, 2]] == full[frames][:, [7, 2]]).all())
+            self.assertTrue((arc[10:200:7] == full[10:200:7]).all())
+        finally:
+            arc.close()
+
+    def test_iter_block(self):
+        arc = open_archive(self.fname)
+        try:
+            full = arc[:]
+            atoms = [4, 0, 31]
+            for size, begin, end, stride in ((64, 0, None, None), (5, 3, 240, 7),
+                                        (1, 60, 70, 3), (1000, 0, 1000, 63)):
+                got = np.concatenate([ block.copy() for block in
+                        arc.iter_block(atoms, size, begin, end, stride) ])
+                last = end is None and len(full) or end + 1
+                self.assertTrue((got == full[begin:last:stride or 1][:, atoms]).all())
+        finally:
+            arc.close()
+
+    def check_rebuilt(self, data, nframes):
+        fname = os.path.join(self.tmp, 'damaged.pca')
+        open(fname, 'wb').write(data)
+        arc, nwarn = self.open_quiet(fname)
+        try:
+            self.assertEqual(nwarn, 1)
+            self.assertEqual(arc.nframes, nframes)
+            err = np.abs(arc[:] - self.xyz[:nframes]).max()
+            self.assertTrue(err <= PRECISION / 2 + 1e-4, err)
+        finally:
+            arc.close()
+
+    def test_truncated_index(self):
+        data = open(self.fname, 'rb').read()
+        # every block is intact, only the index is lost
+        for cut in (1, 30):
+            self.check_rebuilt(data[:-cut], 250)
+
+    def test_truncated_block(self):
+        arc = open_archive(self.fname)
+        offset = arc.offsets[-1]
+        arc.close()
+        data = open(self.fname, 'rb').read()
+        self.check_rebuilt(data[:offset + 20], 3 * BLOCK_SIZE)
+
+    def test_unclosed(self):
+        fname = os.path.join(self.tmp, 'unclosed.pca')
+        arc = open_archive(fname, 'w', precision=PRECISION, block_size=BLOCK_SIZE)
+        try:
+            arc.write_frames(self.xyz[:200], xtl=self.xtl[:200])
+            arc.flush()
+            # the writer died here, the partial block and index are missing
+            data = open(fname, 'rb').read()
+        finally:
+            arc.close()
+        self.check_rebuilt(data, 3 * BLOCK_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Checks of the :mod:`pychm.analysis.geometry` kernels against per frame,
+brute force references.
+"""
+
+
+import unittest
+import numpy as np
+from pychm.analysis.geometry import (cell_list_pairs, dihedral_angles,
+                                    kabsch_rmsd, pair_distances, pair_id,
+                                    radius_of_gyration)
+
+
+def rotation(rng):
+    """Returns a random proper rotation matrix."""
+    q, r = np.linalg.qr(rng.randn(3, 3))
+    q *= np.sign(np.diag(r))
+    if np.linalg.det(q) < 0:
+        q[:, 0] *= -1
+    return q
+
+
+class PairTest(unittest.TestCase):
+    def test_pair_distances(self):
+        rng = np.random.RandomState(0)
+        xyz = rng.rand(4, 20, 3).astype(np.float32) * 10
+        i, j = np.array([0, 3, 19]), np.array([5, 3, 1])
+        got = pair_distances(xyz, i, j)
+        self.assertEqual(got.shape, (4, 3))
+        for f in xrange(4):
+            for p in xrange(3):
+                expected = np.sqrt(((xyz[f, i[p]].astype(np.float64) - xyz[f, j[p]]) ** 2).sum())
+                self.assertAlmostEqual(got[f, p], expected, places=5)
+        self.assertRaises(ValueError, pair_distances, xyz, i, j[:2])
+
+    def test_cell_list_pairs(self):
+        rng = np.random.RandomState(1)
+        # clustered and spread out atoms, with empty cells in between
+        xyz = np.concatenate((rng.rand(150, 3) * 8, rng.rand(50, 3) * 30 + 10))
+        for cutoff in (0.5, 2.5, 7., 100.):
+            i, j, d = cell_list_pairs(xyz, cutoff)
+            self.assertTrue((i < j).all())
+            diff = xyz[:, np.newaxis] - xyz[np.newaxis]
+            full = np.sqrt((diff ** 2).sum(axis=2))
+            ei, ej = np.nonzero(np.triu(full <= cutoff, 1))
+            self.assertEqual(sorted(zip(i, j)), sorted(zip(ei, ej)))
+            self.assertTrue(np.allclose(d, full[i, j]))
+        self.assertRaises(ValueError, cell_list_pairs, xyz, 0.)
+
+    def test_pair_id(self):
+        n = 7
+        i, j = np.triu_indices(n, 1)
+        self.assertEqual(pair_id(i, j, n).tolist(), range(n * (n - 1) // 2))
+
+
+class ShapeTest(unittest.TestCase):
+    def test_radius_of_gyration(self):
+        rng = np.random.RandomState(2)
+        xyz = rng.randn(3, 30, 3)
+        masses = rng.rand(30) + 1.
+        for m in (None, masses):
+            w = np.ones(30) if m is None else m
+            for f in xrange(3):
+                com = np.dot(w, xyz[f]) / w.sum()
+                expected = np.sqrt(np.dot(w, ((xyz[f] - com) ** 2).sum(axis=1)) / w.sum())
+                self.assertAlmostEqual(radius_of_gyration(xyz, m)[f], expected)
+        self.assertRaises(ValueError, radius_of_gyration, xyz, masses[:5])
+
+    def test_kabsch_rmsd(self):
+        rng = np.random.RandomState(3)
+        ref = rng.randn(25, 3) * 5
+        masses = rng.rand(25) + 1.
+        noise = rng.randn(4, 25, 3) * 0.1
+        # rotated, translated copies of noisy references
+        xyz = np.array([ np.dot(ref + n, rotation(rng).T) + rng.randn(3) * 10
+                        for n in noise ])
+        got = kabsch_rmsd(xyz, ref, masses)
+        # the superposition is optimal, so the noise is an upper bound
+        for f in xrange(4):
+            n = noise[f] - np.dot(masses, noise[f]) / masses.sum()
+            self.assertTrue(got[f] <= np.sqrt(np.dot(masses, (n ** 2).sum(axis=1)) / masses.sum()) + 1e-12)
+        self.assertTrue((got > 0.05).all())
+        # exact copies, including a mirror image, which is not superimposable
+        exact = np.array([ np.dot(ref, rotation(rng).T) + 3. for k in xrange(2) ])
+        self.assertTrue(np.allclose(kabsch_rmsd(exact, ref), 0., atol=1e-6))
+        self.assertTrue(kabsch_rmsd(-ref[np.newaxis], ref)[0] > 1.)
+        self.assertRaises(ValueError, kabsch_rmsd, xyz, ref[:5])
+
+    def test_dihedral_angles(self):
+        # i-j-k-l with j-k along z, l rotated by phi about it from i
+        phi = np.array([0., 60., -60., 120., -179., 180.])
+        rad = np.radians(phi)
+        xyz = np.zeros((len(phi), 4, 3))
+        xyz[:, 0] = [1., 0., 0.]
+        xyz[:, 2] = [0., 0., 1.5]
+        xyz[:, 3, 0] = np.cos(rad)
+        xyz[:, 3, 1] = np.sin(rad)
+        xyz[:, 3, 2] = 1.5
+        got = dihedral_angles(xyz, [0], [1], [2], [3])[:, 0]
+        self.assertTrue(np.allclose(got[:-1], phi[:-1]))
+        self.assertAlmostEqual(abs(got[-1]), 180.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Regression checks for :func:`pychm.future.scripts.hfrex.rex_map` and
+:class:`pychm.future.scripts.hfrex.ExchangeLog`.
+"""
+
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import numpy as np
+from pychm.future.io.charmm.dcd import open_dcd
+from pychm.future.scripts.hfrex import ExchangeLog, rex_map
+
+
+TEMPS = [300., 310., 320., 330.]
+NSAVC = 100
+
+
+def write_dcd(fname, xyz, endian='<', mark='i'):
+    """
+    Writes the (nframes, natoms, 3) `xyz` as a DCD file, with byte order
+    `endian` and `mark` ('i' or 'q') record markers.
+    """
+    nframes, natoms = xyz.shape[:2]
+    def rec(data):
+        tmp = struct.pack(endian + mark, len(data))
+        return tmp + data + tmp
+    icntrl = [nframes, NSAVC, NSAVC, nframes * NSAVC, 0, 0, 0, 3 * natoms, 0]
+    rec0 = 'CORD' + struct.pack(endian + '9i', *icntrl) + \
+            struct.pack(endian + 'f', 0.0204548) + \
+            struct.pack(endian + '10i', *([0] * 9 + [37]))
+    rec1 = struct.pack(endian + 'i', 2) + '%-80s' % '* test' + '%-80s' % '*'
+    out = [rec(rec0), rec(rec1), rec(struct.pack(endian + 'i', natoms))]
+    for frame in xyz:
+        for d in xrange(3):
+            out.append(rec(frame[:, d].astype(endian + 'f4').tostring()))
+    open(fname, 'wb').write(''.join(out))
+
+
+def write_log(fname, nexchanges, exfreq, seed=0, blank=False, trailing=False):
+    """
+    Writes a random exchange log, and returns the (nexchanges, nreplicas)
+    replica at each temperature. With `blank`, every entry is followed by a
+    blank line, and with `trailing`, the file ends with one.
+    """
+    rng = np.random.RandomState(seed)
+    perm = np.arange(len(TEMPS))
+    lines = ['# replica exchange log']
+    perms = []
+    for ex in xrange(nexchanges):
+        lines.append('# Exchange %d: Step %d: Repeat 1' % (ex + 1, (ex + 1) * exfreq))
+        lines.extend( '%d %.2f' % (perm[t] + 1, temp) for t, temp in enumerate(TEMPS) )
+        if blank:
+            lines.append('')
+        perms.append(perm.copy())
+        a = rng.randint(len(TEMPS) - 1)
+        perm[[a, a + 1]] = perm[[a + 1, a]]
+    if trailing:
+        lines.append('')
+    open(fname, 'w').write('\n'.join(lines) + '\n')
+    return np.array(perms)
+
+
+class RexMapTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp, 'rex.exch')
+        self.perms = write_log(self.log, 12, 5 * NSAVC)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _run(self, nframes, endian, mark, **kwargs):
+        rng = np.random.RandomState(1)
+        xyz = rng.rand(len(TEMPS), nframes, 5, 3).astype(np.float32)
+        inputs = []
+        for r in xrange(len(TEMPS)):
+            inputs.append(os.path.join(self.tmp, 'rep.dcd_%d' % r))
+            # a list of byte orders mixes the layouts of the inputs
+            write_dcd(inputs[-1], xyz[r], endian[r % len(endian)], mark)
+        return xyz, rex_map(self.log, self.tmp, inputs, **kwargs)
+
+    def check_format(self, endian, mark, **kwargs):
+        xyz, outs = self._run(60, endian, mark, **kwargs)
+        for t, fname in enumerate(outs):
+            dcd = open_dcd(fname)
+            try:
+                self.assertEqual(dcd.ENDIAN, endian[0])
+                got = dcd.memmap()[:]
+            finally:
+                dcd.close()
+            expected = xyz[self.perms[np.arange(60) // 5, t], np.arange(60)]
+            self.assertTrue(np.allclose(got, expected))
+
+    def test_byteswapped(self):
+        self.check_format('>', 'i')
+
+    def test_long_record_markers(self):
+        self.check_format('<', 'q')
+
+    def test_small_pieces(self):
+        # 3 frames per piece, and one frame when a frame is larger
+        for block_size in (3 * 84, 1):
+            self.check_format('<', 'i', block_size=block_size)
+
+    def test_mixed_layouts(self):
+        for block_size in (1 << 22, 3 * 60, 1):
+            self.check_format(['<', '>'], 'i', block_size=block_size)
+
+    def test_empty_table(self):
+        xyz, outs = self._run(0, '<', 'i')
+        for fname in outs:
+            dcd = open_dcd(fname)
+            try:
+                self.assertEqual(dcd.count_frames(), 0)
+            finally:
+                dcd.close()
+
+
+class ExchangeLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp, 'rex.exch')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def check_log(self, **kwargs):
+        perms = write_log(self.log, 12, 5 * NSAVC, **kwargs)
+        log = ExchangeLog(self.log, cache=False)
+        self.assertEqual(log.data.shape, (12, len(TEMPS), 2))
+        self.assertTrue((log.index == perms + 1).all())
+        self.assertEqual(log.temp_array, tuple(TEMPS))
+        self.assertTrue((log.step == 5 * NSAVC * np.arange(1, 13)).all())
+
+    def test_plain(self):
+        self.check_log()
+
+    def test_trailing_blank_line(self):
+        self.check_log(trailing=True)
+
+    def test_interleaved_blank_lines(self):
+        self.check_log(blank=True)
+
+    def test_interleaved_and_trailing_blank_lines(self):
+        self.check_log(blank=True, trailing=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
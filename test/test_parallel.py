@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Checks of :func:`pychm.analysis.parallel.map_frames`.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from pychm.analysis.parallel import map_frames, split_frames
+from test_hfrex import write_dcd
+
+
+# the workers receive these by pickling, so they are defined at module level
+def com_of_block(xyz):
+    return xyz.mean(axis=1)
+
+
+def sum_of_block(xyz):
+    return xyz.sum(axis=0)
+
+
+def first_frame(a, b):
+    return a
+
+
+class SplitFramesTest(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(split_frames(10, 4), [(0, 4, 1), (4, 8, 1), (8, 10, 1)])
+        self.assertEqual(split_frames(10, 2, begin=1, end=8, stride=3),
+                        [(1, 7, 3), (7, 9, 3)])
+        self.assertEqual(split_frames(10, 4, begin=12), [])
+        self.assertRaises(ValueError, split_frames, 10, 0)
+
+
+class MapFramesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.xyz = []
+        self.fnames = []
+        for k, nframes in enumerate((37, 20)):
+            self.xyz.append((rng.rand(nframes, 12, 3) * 20).astype(np.float32))
+            self.fnames.append(os.path.join(self.tmp, 'rep.dcd_%d' % k))
+            write_dcd(self.fnames[-1], self.xyz[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_gather(self):
+        for nproc in (1, 2):
+            got = map_frames(com_of_block, self.fnames, nproc=nproc, chunkSize=5)
+            self.assertEqual(len(got), 2)
+            for tmp, xyz in zip(got, self.xyz):
+                self.assertTrue(np.allclose(tmp, xyz.mean(axis=1)))
+            got = map_frames(com_of_block, self.fnames[0], atoms=[3, 0, 7],
+                            nproc=nproc, chunkSize=4, begin=2, end=30, stride=3)
+            self.assertTrue(np.allclose(got, self.xyz[0][2:31:3][:, [3, 0, 7]].mean(axis=1)))
+
+    def test_reduce(self):
+        total = sum( xyz.astype(np.float64).sum(axis=0) for xyz in self.xyz )
+        for nproc in (1, 2):
+            got = map_frames(sum_of_block, self.fnames, nproc=nproc,
+                            chunkSize=6, reduce=np.add)
+            self.assertTrue(np.allclose(got, total))
+            got = map_frames(sum_of_block, self.fnames, nproc=nproc,
+                            chunkSize=6, reduce=np.add, initial=np.ones((12, 3)))
+            self.assertTrue(np.allclose(got, total + 1.))
+            # blocks are folded in frame order
+            got = map_frames(sum_of_block, self.fnames, nproc=nproc,
+                            chunkSize=1, reduce=first_frame)
+            self.assertTrue(np.allclose(got, self.xyz[0][0]))
+
+    def test_empty(self):
+        got = map_frames(com_of_block, self.fnames, nproc=1, begin=25)
+        self.assertEqual(got[1].shape, (0,))
+        self.assertTrue(np.allclose(got[0], self.xyz[0][25:].mean(axis=1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
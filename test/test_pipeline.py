@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Checks of :class:`pychm.analysis.pipeline.Pipeline` against the geometry
+kernels called directly.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from pychm.analysis.geometry import (dihedral_angles, kabsch_rmsd,
+                                    pair_distances, radius_of_gyration)
+from pychm.analysis.pipeline import (Custom, Dihedrals, Distances, Gyration,
+                                    NativeQ, Pipeline, PipelineError, RMSD)
+from test_hfrex import write_dcd
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp, 'traj.dcd')
+        rng = np.random.RandomState(0)
+        self.xyz = (rng.rand(50, 30, 3) * 20).astype(np.float32)
+        write_dcd(self.fname, self.xyz)
+        self.masses = rng.rand(30) + 1.
+        self.bb = np.array([3, 1, 4, 15, 9, 26])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def pipeline(self):
+        pipe = Pipeline(self.fname, blockSize=7)
+        bb = self.bb
+        pipe.add(Gyration('rg', masses=self.masses))
+        pipe.add(RMSD('rmsd', bb, self.xyz[0, bb], self.masses[bb]))
+        pipe.add(Distances('dist', [2, 7, 29], [11, 2, 0]))
+        pipe.add(NativeQ('q', [2, 7, 29], [11, 2, 0], 10.))
+        pipe.add(Dihedrals('phi', [[0, 5, 10, 20], [29, 3, 8, 1]]))
+        pipe.add(Custom('zmax', lambda xyz: xyz[..., 2].max(axis=1), atoms=[6, 12]))
+        return pipe
+
+    def check(self, frames, **kwargs):
+        data = self.pipeline().run(**kwargs)
+        xyz = self.xyz[frames].astype(np.float64)
+        bb = self.bb
+        dist = pair_distances(xyz, [2, 7, 29], [11, 2, 0])
+        expected = {
+            'rg': radius_of_gyration(xyz, self.masses),
+            'rmsd': kabsch_rmsd(xyz[:, bb], self.xyz[0, bb], self.masses[bb]),
+            'dist': dist,
+            'q': (dist <= 10.).mean(axis=1),
+            'phi': dihedral_angles(xyz, [0, 29], [5, 3], [10, 8], [20, 1]),
+            'zmax': xyz[:, [6, 12], 2].max(axis=1),
+            }
+        self.assertEqual(sorted(data), sorted(expected))
+        for name, value in expected.iteritems():
+            self.assertEqual(data[name].shape, value.shape, name)
+            self.assertTrue(np.allclose(data[name], value), name)
+
+    def test_all_frames(self):
+        self.check(slice(None))
+
+    def test_window(self):
+        self.check(slice(3, 41, 4), begin=3, end=40, stride=4)
+
+    def test_empty_window(self):
+        data = self.pipeline().run(begin=60)
+        self.assertEqual(data['rg'].shape, (0,))
+        self.assertEqual(data['dist'].shape, (0, 3))
+
+    def test_atom_subset(self):
+        # no observable needs every atom, so only their union is read
+        pipe = Pipeline(self.fname, blockSize=16)
+        pipe.add(Distances('dist', [2, 7], [11, 2]))
+        pipe.add(Gyration('rg', [7, 11, 20]))
+        data = pipe.run()
+        xyz = self.xyz.astype(np.float64)
+        self.assertTrue(np.allclose(data['dist'], pair_distances(xyz, [2, 7], [11, 2])))
+        self.assertTrue(np.allclose(data['rg'], radius_of_gyration(xyz[:, [7, 11, 20]])))
+        self.assertEqual(sorted(pipe.timing), ['dist', 'read', 'rg'])
+
+    def test_errors(self):
+        pipe = Pipeline(self.fname)
+        self.assertRaises(PipelineError, pipe.run)
+        self.assertRaises(PipelineError, pipe.add, 'rg')
+        pipe.add(Gyration('rg'))
+        self.assertRaises(PipelineError, pipe.add, Gyration('rg'))
+        pipe = Pipeline(self.fname)
+        pipe.add(Gyration('rg', [0, 30]))
+        self.assertRaises(PipelineError, pipe.run)
+
+
+if __name__ == '__main__':
+    unittest.main()
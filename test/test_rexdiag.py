@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Regression checks for :class:`pychm.analysis.rexdiag.RexDiag`.
+"""
+
+
+import unittest
+import numpy as np
+from pychm.analysis.rexdiag import RexDiag
+
+
+class FakeLog(object):
+    """
+    Holds the (nexchanges, nreplicas) 1-based replica index at each
+    temperature, built from the temperature index of each replica.
+    """
+    def __init__(self, position, temps):
+        position = np.asarray(position)
+        self.index = np.empty_like(position)
+        rows = np.arange(len(position))[:, np.newaxis]
+        self.index[rows, position] = np.arange(position.shape[1]) + 1
+        self.temp_array = tuple(temps)
+
+
+class RoundTripTest(unittest.TestCase):
+    def diag(self, column):
+        # two replicas, the second one always at the other temperature
+        column = np.asarray(column)
+        return RexDiag(FakeLog(np.column_stack((column, 1 - column)), (300., 350.)))
+
+    def test_start_at_top(self):
+        # top at 0, bottom at 5, top at 10, bottom at 15
+        column = [1] * 5 + [0] * 5 + [1] * 5 + [0] * 5
+        trips = self.diag(column).get_roundTrips()
+        self.assertEqual(trips[0].tolist(), [10])
+        self.assertEqual(trips[1].tolist(), [10])
+
+    def test_start_at_bottom(self):
+        column = [0] * 3 + [1] * 4 + [0] * 6 + [1] * 2 + [0] * 1
+        trips = self.diag(column).get_roundTrips()
+        self.assertEqual(trips[0].tolist(), [7, 8])
+        self.assertEqual(trips[1].tolist(), [10])
+
+    def test_no_trip(self):
+        diag = self.diag([1] * 5 + [0] * 5)
+        self.assertEqual([ len(trip) for trip in diag.get_roundTrips() ], [0, 0])
+        self.assertEqual(diag.get_meanRoundTrip(), np.inf)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Checks of :class:`pychm.analysis.wham.Wham` against analytic models.
+"""
+
+
+import unittest
+import numpy as np
+from pychm.analysis.wham import Wham, WhamError, logsumexp
+from pychm.const.units import BOLTZMANN
+
+
+def gamma_energies(rng, temps, dof, nsamples, offset=0.):
+    """
+    Samples the energies of `dof` harmonic degrees of freedom, a gamma
+    distribution of shape dof/2 and scale kT, at each of `temps`.
+    """
+    return [ offset + rng.gamma(dof / 2., BOLTZMANN * t, nsamples) for t in temps ]
+
+
+class TwoState(object):
+    """
+    Two harmonic states, folded (F) and unfolded (U), of `dofF` and `dofU`
+    degrees of freedom, U lying `gap` kcal/mol above F, with the entropy of
+    U chosen so both are equally populated at `tm`.
+    """
+    def __init__(self, gap=60., dofF=200., dofU=240., tm=340.):
+        self.gap, self.dofF, self.dofU, self.tm = gap, dofF, dofU, tm
+        ktm = BOLTZMANN * tm
+        self.entropy = gap / ktm - (dofU - dofF) / 2. * np.log(ktm)
+
+    def ratio(self, temps):
+        """Returns the population ratio U / F at each of `temps`."""
+        kt = BOLTZMANN * np.asarray(temps, dtype=np.float64)
+        return np.exp(self.entropy - self.gap / kt) * kt ** ((self.dofU - self.dofF) / 2.)
+
+    def sample(self, rng, temps, nsamples):
+        """Returns the energies, and Q (0.8 for F, 0.2 for U), at each of `temps`."""
+        energies, q = [], []
+        for t in temps:
+            r = self.ratio(t)
+            unfolded = rng.rand(nsamples) < r / (1. + r)
+            kt = BOLTZMANN * t
+            energies.append(np.where(unfolded,
+                                    self.gap + rng.gamma(self.dofU / 2., kt, nsamples),
+                                    rng.gamma(self.dofF / 2., kt, nsamples)))
+            q.append(np.where(unfolded, 0.2, 0.8))
+        return energies, q
+
+
+class WhamTest(unittest.TestCase):
+    def test_logsumexp(self):
+        a = np.array([[1000., 1000.], [-np.inf, 0.]])
+        self.assertAlmostEqual(logsumexp(a), 1000. + np.log(2.))
+        self.assertTrue(np.allclose(logsumexp(a, axis=1), [1000. + np.log(2.), 0.]))
+
+    def test_harmonic(self):
+        # <E> = dof/2 kT and Cv = dof/2 k, between and at the simulated temperatures
+        rng = np.random.RandomState(0)
+        dof = 300.
+        temps = np.linspace(300., 400., 8)
+        wham = Wham(gamma_energies(rng, temps, dof, 20000, offset=-500.), temps)
+        f = wham.solve()
+        self.assertEqual(f[0], 0.)
+        grid = np.linspace(305., 395., 19)
+        energy = wham.get_energy(grid)
+        expected = -500. + dof / 2. * BOLTZMANN * grid
+        self.assertTrue(np.abs(energy - expected).max() < 0.5)
+        cv = wham.get_Cv(grid)
+        self.assertTrue(np.abs(cv / (dof / 2. * BOLTZMANN) - 1.).max() < 0.05)
+
+    def test_two_state(self):
+        rng = np.random.RandomState(1)
+        model = TwoState()
+        temps = np.exp(np.linspace(np.log(250.), np.log(450.), 12))
+        energies, q = model.sample(rng, temps, 20000)
+        wham = Wham(energies, temps)
+        # -kT ln(pF / pU), within +-9 kcal/mol, where both states are sampled
+        grid = np.linspace(300., 380., 81)
+        delg = wham.get_DelG(q, (0.5, 1.), (0., 0.5), grid)
+        expected = BOLTZMANN * grid * np.log(model.ratio(grid))
+        self.assertTrue(np.abs(delg - expected).max() < 0.1)
+        grid = np.linspace(260., 440., 181)
+        self.assertTrue(abs(wham.get_Tm(grid, q, (0.5, 1.), (0., 0.5)) - model.tm) < 1.)
+        self.assertTrue(abs(wham.get_Tm(grid) - model.tm) < 1.)
+
+    def test_vanishing_population(self):
+        rng = np.random.RandomState(2)
+        temps = [300., 320.]
+        energies = gamma_energies(rng, temps, 100., 1000)
+        q = [ np.ones(1000) for t in temps ]
+        delg = Wham(energies, temps).get_DelG(q, (0.5, 1.), (0., 0.4), [310.])
+        self.assertEqual(delg.tolist(), [np.inf])
+
+    def test_errors(self):
+        rng = np.random.RandomState(3)
+        energies = gamma_energies(rng, [300., 320.], 100., 100)
+        self.assertRaises(WhamError, Wham, energies, [300.])
+        self.assertRaises(WhamError, Wham, energies, [300., 0.])
+        self.assertRaises(WhamError, Wham, [energies[0], []], [300., 320.])
+        wham = Wham(energies, [300., 320.])
+        self.assertRaises(WhamError, wham.get_average, [energies[0]], [310.])
+        self.assertRaises(WhamError, wham.get_average, [energies[0], energies[1][:10]], [310.])
+
+
+if __name__ == '__main__':
+    unittest.main()